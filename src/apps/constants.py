@@ -9,6 +9,12 @@ from django.http import JsonResponse
 # Base Error Response
 ERROR_RESPONSE = {"status": "error", "message": "Something went wrong :("}
 
+# Rows per INSERT for `bulk_create`
+BULK_CREATE_BATCH_SIZE = 1000
+
+# Rows per chunk of the product files imported in parallel, smaller files are imported by a single worker
+PRODUCT_IMPORT_CHUNK_SIZE = 20000
+
 # Base Logger
 LOGGER = logging.getLogger(__name__)
 
@@ -0,0 +1,6 @@
+from django.contrib import admin
+
+from .models import ImportJob, ImportJobError
+
+admin.site.register(ImportJob)
+admin.site.register(ImportJobError)
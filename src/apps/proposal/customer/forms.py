@@ -17,6 +17,9 @@ class ImportCustomerCSVForm(forms.Form):
             }
         )
     )
+    detect_changes = forms.BooleanField(
+        required=False, help_text="List the added, changed and removed customers after the import."
+    )
 
     REQUIRED_COLUMNS = [
         "Internal Id",
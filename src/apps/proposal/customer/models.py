@@ -1,9 +1,9 @@
 from django.db import models
 
-from laurel.models import BaseModel
+from laurel.models import ImportedModel
 
 
-class Customer(BaseModel):
+class Customer(ImportedModel):
     internal_id = models.CharField(max_length=50, unique=True)
     customer_id = models.CharField(max_length=50, unique=True)
     name = models.CharField(max_length=255)
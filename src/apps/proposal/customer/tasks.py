@@ -1,25 +1,50 @@
-import os
-
-import pandas as pd
 from django.core.files.uploadedfile import InMemoryUploadedFile
 
 from apps.constants import LOGGER
+from apps.spreadsheet import SpreadsheetError, SpreadsheetReader
+from apps.upsert import bulk_upsert, removed_keys
 
 from .models import Customer
 
-
-def import_customer_from_xlsx(file: InMemoryUploadedFile) -> dict:
+# Customer fields set by the import, `customer_id` identifies the customer
+CUSTOMER_IMPORT_FIELDS = [
+    "internal_id",
+    "name",
+    "sales_rep",
+    "billing_address_1",
+    "billing_address_2",
+    "city",
+    "state",
+    "zip",
+    "country",
+]
+
+# File columns of the customer fields, used in the import errors
+CUSTOMER_IMPORT_COLUMNS = {
+    "customer_id": "ID",
+    "internal_id": "Internal ID",
+    "name": "Name",
+    "sales_rep": "Sales Rep",
+    "billing_address_1": "Billing Address 1",
+    "billing_address_2": "Billing Address 2",
+    "city": "Billing City",
+    "state": "Billing State/Province",
+    "zip": "Billing Zip",
+    "country": "Billing Country",
+}
+
+
+def import_customer_from_xlsx(file: InMemoryUploadedFile, detect_changes: bool = False) -> dict:
     """
     Imports customer data from an Excel or CSV file.
 
     :prams file (File): The uploaded file containing product data.
-    :return: A context dictionary with messages about created/updated products
-            or errors if the columns do not match or records are skipped.
+    :param detect_changes: Also return the IDs of the added, changed and removed customers in 'changes'.
+    :return: A context dictionary with the created/updated/unchanged customer counts and the skipped rows in
+            'errors' (see `RowError`), or an error if the columns do not match.
     """
 
-    file_extension = os.path.splitext(file.name)[1].lower()
-    context = {"messages": []}
-    skip_customers = []
+    context = {"errors": []}
 
     # Define the expected columns
     expected_columns = [
@@ -35,60 +60,58 @@ def import_customer_from_xlsx(file: InMemoryUploadedFile) -> dict:
         "Billing Country",
     ]
 
-    # Load the data from the file
+    # Open the file, the rows are read while they are imported
     try:
-        if file_extension == ".csv":
-            df = pd.read_csv(file)
-        elif file_extension in [".xlsx", ".xls"]:
-            df = pd.read_excel(file, sheet_name=0)
-            if len(pd.ExcelFile(file).sheet_names) > 1:
-                return {"error": "The file with multiple sheets won't be processed."}
-        else:
-            return {"error": "Unsupported file format."}
-    except pd.errors.EmptyDataError:
-        return {"error": "You are trying to upload an empty file."}
+        reader = SpreadsheetReader(file)
+    except SpreadsheetError as e:
+        return {"error": str(e)}
+
+    if reader.sheet_count > 1:
+        return {"error": "The file with multiple sheets won't be processed."}
 
-    # Check for empty DataFrame and validate columns
-    if df.empty:
+    # Check for empty file and validate columns
+    if reader.empty:
         return {"error": "You are trying to upload an empty file."}
 
-    df.columns = df.columns.str.strip()  # Clean up any whitespace in column names
-    if set(df.columns) != set(expected_columns):
+    if set(reader.columns) != set(expected_columns):
         return {"error": "The columns do not match the expected format."}
 
-    # Convert DataFrame to a list of dictionaries
-    customer_list = df.fillna("").to_dict(orient="records")
-
-    # Process each customer record
-    for record in customer_list:
-        try:
-            customer_id = record["ID"]
-            customer_data = {
-                "internal_id": record["Internal ID"],
-                "name": record["Name"],
-                "sales_rep": record["Sales Rep"],
-                "billing_address_1": record["Billing Address 1"],
-                "billing_address_2": record.get("Billing Address 2", ""),
-                "city": record["Billing City"],
-                "state": record["Billing State/Province"],
-                "zip": record["Billing Zip"],
-                "country": record["Billing Country"],
-            }
-
-            customer, created = Customer.objects.update_or_create(
-                customer_id=customer_id,
-                defaults=customer_data,
-            )
-
-            message = f"{'Created' if created else 'Updated'} customer: {customer_data['name']}"
-            context["messages"].append(message)
-
-        except Exception as e:
-            LOGGER.error(f"Error processing record {record['ID']}: {e}")
-            skip_customers.append(record)
+    customers = (
+        {
+            "customer_id": record["ID"],
+            "internal_id": record["Internal ID"],
+            "name": record["Name"],
+            "sales_rep": record["Sales Rep"],
+            "billing_address_1": record["Billing Address 1"],
+            "billing_address_2": record.get("Billing Address 2", ""),
+            "city": record["Billing City"],
+            "state": record["Billing State/Province"],
+            "zip": record["Billing Zip"],
+            "country": record["Billing Country"],
+        }
+        for record in reader
+    )
+
+    result = bulk_upsert(
+        Customer,
+        customers,
+        "customer_id",
+        CUSTOMER_IMPORT_FIELDS,
+        hash_field="import_hash",
+        row_number=lambda: reader.row_number,
+        columns=CUSTOMER_IMPORT_COLUMNS,
+    )
+    context.update(created=result["created"], updated=result["updated"], unchanged=result["unchanged"])
+    if detect_changes:
+        context["changes"] = {
+            "added": result["added"],
+            "changed": result["changed"],
+            "removed": removed_keys(Customer, "customer_id", result["keys"]),
+        }
+    context["errors"].extend(result["errors"])
 
     # Log skipped customers if any
-    if skip_customers:
-        LOGGER.info(f"Skipped customers: {skip_customers}")
+    if context["errors"]:
+        LOGGER.info(f"Skipped {len(context['errors']):,} customer rows")
 
     return context
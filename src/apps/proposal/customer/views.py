@@ -3,10 +3,11 @@ from django.http import JsonResponse
 from django.urls import reverse
 
 from apps.mixin import CustomDataTableMixin, FormViewMixin, ProposalViewMixin
+from apps.proposal.models import ImportJob
+from apps.proposal.tasks import start_import_job
 
 from .forms import ImportCustomerCSVForm
 from .models import Customer
-from .tasks import import_customer_from_xlsx
 
 
 class CustomerList(ProposalViewMixin):
@@ -82,18 +83,20 @@ class CustomerCreateFromCSVFormView(FormViewMixin):
 
     def form_valid(self, form):
         csv_file = form.cleaned_data["csv_file"]
-        response = import_customer_from_xlsx(csv_file)
+        job = start_import_job(
+            ImportJob.CUSTOMER, csv_file, self.request.user, detect_changes=form.cleaned_data["detect_changes"]
+        )
 
-        if response and response.get("error"):
-            form.add_error("csv_file", response["error"])
+        if job.status == ImportJob.FAILED:
+            form.add_error("csv_file", job.error)
             return self.render_to_response(self.get_context_data(form=form), status=201)
 
         return JsonResponse(
             {
+                **job.as_dict(),
                 "redirect": reverse("proposal_app:customer:customer-list"),
-                "message": "Customers imported successfully!",
                 "status": "success",
-                "code": 200,
+                "code": 202,
             }
         )
 
@@ -5,10 +5,11 @@ from django.views.generic import FormView, View
 from django_datatables_too.mixins import DataTableMixin
 
 from apps.mixin import ProposalViewMixin
+from apps.proposal.models import ImportJob
+from apps.proposal.tasks import start_import_job
 
 from .forms import ImportLabourCostCSVForm
 from .models import LabourCost
-from .tasks import import_labour_cost_from_xlsx
 
 
 class LabourCostList(ProposalViewMixin):
@@ -78,23 +79,22 @@ class LabourCostCreateFromCSVFormView(FormView):
         Handle a valid form submission.
 
         :param form: The submitted form instance with validated data.
-        :return: JsonResponse indicating success or an error.
+        :return: JsonResponse with the import job, or the form with the error.
         """
         csv_file = form.cleaned_data["csv_file"]
-        # print("File size:", csv_file.size)  # Log the size of the uploaded file for debugging
 
-        response = import_labour_cost_from_xlsx(csv_file)
+        job = start_import_job(ImportJob.LABOUR_COST, csv_file, self.request.user)
 
-        if "error" in response:
-            form.add_error("csv_file", response["error"])
+        if job.status == ImportJob.FAILED:
+            form.add_error("csv_file", job.error)
             return self.render_to_response(self.get_context_data(form=form), status=201)
 
         return JsonResponse(
             {
+                **job.as_dict(),
                 "redirect": reverse("proposal_app:labour_cost:labour-cost-list"),
-                "message": "Labor Cost imported successfully!",
                 "status": "success",
-                "code": 200,
+                "code": 202,
             }
         )
 
@@ -0,0 +1,56 @@
+# Generated by Django 4.2 on 2026-10-17 01:32
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('kind', models.CharField(choices=[('product', 'Products'), ('additional_material', 'Additional Materials'), ('customer', 'Customers'), ('vendor', 'Vendors'), ('task', 'Tasks'), ('labour_cost', 'Labor Costs')], max_length=50, verbose_name='Kind')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('success', 'Success'), ('failed', 'Failed')], default='pending', max_length=20, verbose_name='Status')),
+                ('file_name', models.CharField(max_length=255, verbose_name='File Name')),
+                ('file_path', models.CharField(help_text='Uploaded file in the default storage', max_length=255, verbose_name='File Path')),
+                ('options', models.JSONField(blank=True, default=dict, verbose_name='Options')),
+                ('created_count', models.IntegerField(default=0, verbose_name='Created')),
+                ('updated_count', models.IntegerField(default=0, verbose_name='Updated')),
+                ('unchanged_count', models.IntegerField(default=0, verbose_name='Unchanged')),
+                ('error_count', models.IntegerField(default=0, verbose_name='Errors')),
+                ('changes', models.JSONField(blank=True, null=True, verbose_name='Changes')),
+                ('error', models.TextField(blank=True, help_text='Why the whole file was rejected', null=True, verbose_name='Error')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Started At')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Finished At')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='import_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Import Job',
+            },
+        ),
+        migrations.CreateModel(
+            name='ImportJobError',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('row', models.IntegerField(blank=True, null=True, verbose_name='Row')),
+                ('column', models.CharField(blank=True, max_length=255, verbose_name='Column')),
+                ('reason', models.TextField(verbose_name='Reason')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='errors', to='proposal.importjob')),
+            ],
+            options={
+                'verbose_name': 'Import Job Error',
+                'ordering': ['id'],
+            },
+        ),
+    ]
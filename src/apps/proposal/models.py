@@ -0,0 +1,137 @@
+from typing import Optional
+
+from django.db import models
+from django.urls import reverse
+from django.utils.translation import gettext_lazy as _
+
+from apps.upsert import format_upsert_result
+from laurel.models import BaseModel
+
+
+class ImportJob(BaseModel):
+    """
+    A catalog import (products, additional materials, customers, vendors, tasks or labour costs) processed in
+    the background by the `run_import_job` Celery task.
+
+    The job records the counts and timing of the import, the invalid rows are stored in `ImportJobError`.
+    """
+
+    PRODUCT = "product"
+    ADDITIONAL_MATERIAL = "additional_material"
+    CUSTOMER = "customer"
+    VENDOR = "vendor"
+    TASK = "task"
+    LABOUR_COST = "labour_cost"
+
+    KIND_CHOICES = [
+        (PRODUCT, "Products"),
+        (ADDITIONAL_MATERIAL, "Additional Materials"),
+        (CUSTOMER, "Customers"),
+        (VENDOR, "Vendors"),
+        (TASK, "Tasks"),
+        (LABOUR_COST, "Labor Costs"),
+    ]
+
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCESS = "success"
+    FAILED = "failed"
+
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (SUCCESS, "Success"),
+        (FAILED, "Failed"),
+    ]
+
+    kind = models.CharField(_("Kind"), max_length=50, choices=KIND_CHOICES)
+    status = models.CharField(_("Status"), max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    file_name = models.CharField(_("File Name"), max_length=255)
+    file_path = models.CharField(_("File Path"), max_length=255, help_text="Uploaded file in the default storage")
+    options = models.JSONField(_("Options"), default=dict, blank=True)
+    created_by = models.ForeignKey(
+        "user.User",
+        on_delete=models.SET_NULL,
+        related_name="import_jobs",
+        blank=True,
+        null=True,
+    )
+    created_count = models.IntegerField(_("Created"), default=0)
+    updated_count = models.IntegerField(_("Updated"), default=0)
+    unchanged_count = models.IntegerField(_("Unchanged"), default=0)
+    error_count = models.IntegerField(_("Errors"), default=0)
+    changes = models.JSONField(_("Changes"), blank=True, null=True)
+    error = models.TextField(_("Error"), blank=True, null=True, help_text="Why the whole file was rejected")
+    started_at = models.DateTimeField(_("Started At"), blank=True, null=True)
+    finished_at = models.DateTimeField(_("Finished At"), blank=True, null=True)
+
+    @property
+    def duration(self) -> Optional[float]:
+        """Processing time in seconds, once the job is finished."""
+        if self.started_at and self.finished_at:
+            return (self.finished_at - self.started_at).total_seconds()
+        return None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (self.SUCCESS, self.FAILED)
+
+    def get_message(self) -> str:
+        """Summary of the job shown to the user."""
+        if self.status == self.FAILED:
+            return self.error or ""
+        if not self.finished:
+            return f"Importing {self.get_kind_display().lower()}, the table is refreshed once it is done."
+
+        result = {
+            "created": self.created_count,
+            "updated": self.updated_count,
+            "unchanged": self.unchanged_count,
+            "changes": self.changes,
+        }
+        message = f"{self.get_kind_display()} imported successfully! ({format_upsert_result(result)})"
+        if self.error_count:
+            message += f", {self.error_count:,} {'row' if self.error_count == 1 else 'rows'} skipped"
+        return message
+
+    def as_dict(self) -> dict:
+        """Status of the job returned by the import views."""
+        return {
+            "job_id": self.id,
+            "state": self.status,
+            "message": self.get_message(),
+            "created": self.created_count,
+            "updated": self.updated_count,
+            "unchanged": self.unchanged_count,
+            "error_count": self.error_count,
+            "changes": self.changes,
+            "duration": self.duration,
+            "status_url": reverse("proposal_app:import-job-status", args=[self.id]),
+            "download_url": reverse("proposal_app:import-job-download", args=[self.id]),
+        }
+
+    def __str__(self):
+        return f"{self.id} - {self.kind} - {self.status}"
+
+    class Meta:
+        verbose_name = "Import Job"
+
+
+class ImportJobError(models.Model):
+    """
+    An invalid row of an import job: its row number in the file, the column and the reason.
+
+    NOTE: A file can have an error on every row, so the table is kept compact (no timestamps).
+    """
+
+    job = models.ForeignKey(ImportJob, on_delete=models.CASCADE, related_name="errors")
+    row = models.IntegerField(_("Row"), blank=True, null=True)
+    column = models.CharField(_("Column"), max_length=255, blank=True)
+    reason = models.TextField(_("Reason"))
+
+    def __str__(self):
+        return f"{self.job_id} - {self.row} - {self.column}"
+
+    class Meta:
+        verbose_name = "Import Job Error"
+        ordering = ["id"]
@@ -11,6 +11,7 @@ from .models import (
     ProposalCreation,
     SelectTaskCode,
     TaskMapping,
+    TaskMappingRollup,
 )
 
 # Register your models here.
@@ -24,5 +25,6 @@ admin.site.register(GlueAndAdditionalMaterial)
 admin.site.register(PreliminaryMaterialList)
 admin.site.register(TaskMapping)
 admin.site.register(AssignedProduct)
+admin.site.register(TaskMappingRollup)
 admin.site.register(ProposalCreation)
 admin.site.register(Invoice)
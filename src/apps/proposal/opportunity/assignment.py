@@ -0,0 +1,76 @@
+"""
+Bulk assignment of the preliminary materials of an opportunity to a task mapping.
+
+The selected materials and their catalog products are resolved with two queries, the assigned products are
+inserted with one `bulk_create` in a transaction and the task rollup is refreshed once, instead of one lookup,
+one save and one rollup refresh per selected item.
+"""
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from apps.constants import ERROR_RESPONSE, LOGGER
+from apps.proposal.product.models import Product, display_name_key
+
+from .estimate_cache import bump_revision
+from .models import AssignedProduct, PreliminaryMaterialList, TaskMapping, TaskMappingRollup
+
+
+def assign_products(task_mapping: TaskMapping, item_numbers: list) -> dict:
+    """
+    Assign preliminary materials of the opportunity of a task mapping to the task.
+
+    The standard cost of each assigned product is the cost of the catalog product whose display name matches
+    the item number (see `Product.get_by_display_name`), 0 if there is none.
+
+    NOTE: Like the former one by one assignment, the valid items are assigned even when other items fail.
+
+    :param task_mapping: The task mapping the products are assigned to.
+    :param item_numbers: Item numbers of the selected preliminary materials.
+    :return: Dictionary with the ids of the `created` assigned products and the `errors`, a list of
+        `{"internal_id": item number, "error": message}`.
+    """
+    materials = {}
+    for material in PreliminaryMaterialList.objects.filter(
+        opportunity_id=task_mapping.opportunity_id, item_number__in=set(item_numbers)
+    ):
+        materials.setdefault(material.item_number, []).append(material)
+    catalog = Product.get_by_display_name(materials)
+
+    quantity_field = AssignedProduct._meta.get_field("quantity")
+    assigned_products, errors = [], []
+    for item_number in item_numbers:
+        if item_number not in materials:
+            errors.append({"internal_id": item_number, "error": "Product not found"})
+            continue
+        if len(materials[item_number]) > 1:
+            LOGGER.error(f"[assign_products] Several preliminary materials with item number {item_number}")
+            errors.append({"internal_id": item_number, "error": ERROR_RESPONSE["message"]})
+            continue
+
+        material = materials[item_number][0]
+        try:
+            quantity = quantity_field.to_python(material.combined_quantities_from_both_import)
+        except ValidationError:
+            errors.append({"internal_id": item_number, "error": "Invalid quantity"})
+            continue
+
+        product = catalog.get(display_name_key(item_number))
+        assigned_products.append(
+            AssignedProduct(
+                task_mapping=task_mapping,
+                quantity=quantity,
+                item_code=material.item_number,
+                description=material.description,
+                standard_cost=product.std_cost if product else 0,
+                is_assign=True,
+            )
+        )
+
+    with transaction.atomic():
+        # bulk_create doesn't send post_save, the rollup of the task is refreshed once for all the products
+        AssignedProduct.objects.bulk_create(assigned_products)
+        TaskMappingRollup.refresh(task_mapping.id)
+        bump_revision(pk=task_mapping.opportunity_id)
+
+    return {"created": [assigned_product.id for assigned_product in assigned_products], "errors": errors}
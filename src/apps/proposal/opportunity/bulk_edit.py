@@ -0,0 +1,131 @@
+"""
+Bulk edition of the fields of assigned products.
+
+The edited rows are parsed and validated first, then written with one `bulk_update` (a single `CASE` UPDATE per
+batch) in a transaction and the rollups of the edited tasks are refreshed once, instead of one lookup and one
+save per edited field.
+"""
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from apps.constants import BULK_CREATE_BATCH_SIZE
+
+from .estimate_cache import bump_revision
+from .models import AssignedProduct, TaskMappingRollup
+
+# Fields the rollup of a task mapping is calculated from, see `TaskMappingRollup.calculate`
+ROLLUP_SOURCE_FIELDS = ("quantity", "standard_cost", "vendor_quoted_cost")
+
+# Rollup fields returned as the totals of the edited tasks
+ROLLUP_TOTALS = ("total_quantity", "total_price", "total_unit_price", "total_percent")
+
+# Values the edit forms send for an empty field, the tables render a missing cost as "None"
+EMPTY_VALUES = ("", "None")
+
+
+def parse_rows(data: dict) -> list:
+    """
+    Group the `rows[<index>][<field>]` values of a form encoded request (as parsed by `urllib.parse.parse_qs`).
+
+    :param data: Parsed request body.
+    :return: The rows, a dictionary of stripped string values by field, ordered by index.
+    """
+    rows = {}
+    for key, value in data.items():
+        if key.startswith("rows["):
+            row_index = key.split("[")[1].split("]")[0]
+            field_name = key.split("[")[2].split("]")[0]
+            rows.setdefault(row_index, {})[field_name] = value[0].strip()
+
+    return [rows[index] for index in sorted(rows, key=lambda index: int(index) if index.isdigit() else index)]
+
+
+def clean_value(field_name: str, value):
+    """
+    Convert an edited value to the type of its assigned product field and validate it.
+
+    :param field_name: Name of the `AssignedProduct` field.
+    :param value: Submitted value, usually a string.
+    :return: The typed value.
+    :raises ValidationError: If the value is not valid for the field.
+    """
+    field = AssignedProduct._meta.get_field(field_name)
+    if isinstance(value, str) and value.strip() in EMPTY_VALUES:
+        value = None
+    return field.clean(value, None)
+
+
+def bulk_edit_assigned_products(rows: list, fields: tuple, id_field: str = "id") -> dict:
+    """
+    Update some fields of several assigned products at once.
+
+    NOTE: Nothing is written when a row is invalid, the response lists every invalid value instead. The fields
+    missing from a row keep their current value.
+
+    :param rows: Edited rows, dictionaries with the id of the assigned product and the new field values.
+    :param fields: Names of the fields that can be edited, the other values of the rows are ignored.
+    :param id_field: Key of the assigned product id in the rows.
+    :return: Dictionary with the ids of the `updated` assigned products, the `errors`, a list of
+        `{"id": assigned product id, "field": field name, "error": message}`, and the recomputed rollup `totals` of
+        the edited task mappings, by task mapping id.
+    """
+    changes, errors = {}, []
+    for row in rows:
+        row_id = row.get(id_field)
+        if not row_id:
+            # Rows that are not saved yet, e.g. the empty row of a task
+            continue
+
+        try:
+            row_id = int(row_id)
+        except (TypeError, ValueError):
+            errors.append({"id": row_id, "field": id_field, "error": "Invalid id"})
+            continue
+
+        values = changes.setdefault(row_id, {})
+        for field_name in fields:
+            if field_name not in row:
+                continue
+            try:
+                values[field_name] = clean_value(field_name, row[field_name])
+            except ValidationError as e:
+                errors.append({"id": row_id, "field": field_name, "error": " ".join(e.messages)})
+
+    changes = {row_id: values for row_id, values in changes.items() if values}
+    assigned_products = AssignedProduct.objects.in_bulk(changes)
+    errors.extend(
+        {"id": row_id, "field": id_field, "error": "Product not found"}
+        for row_id in changes
+        if row_id not in assigned_products
+    )
+    if errors:
+        return {"updated": [], "errors": errors, "totals": {}}
+
+    updated_fields = [field_name for field_name in fields if any(field_name in values for values in changes.values())]
+    now = timezone.now()
+    for row_id, values in changes.items():
+        for field_name, value in values.items():
+            setattr(assigned_products[row_id], field_name, value)
+        assigned_products[row_id].updated_at = now
+
+    task_mapping_ids = {assigned_product.task_mapping_id for assigned_product in assigned_products.values()}
+    with transaction.atomic():
+        if updated_fields:
+            # bulk_update doesn't send post_save, the rollups of the edited tasks are refreshed once
+            AssignedProduct.objects.bulk_update(
+                assigned_products.values(),
+                updated_fields + ["updated_at"],
+                batch_size=BULK_CREATE_BATCH_SIZE,
+            )
+            if set(updated_fields).intersection(ROLLUP_SOURCE_FIELDS):
+                for task_mapping_id in task_mapping_ids:
+                    TaskMappingRollup.refresh(task_mapping_id)
+            bump_revision(task_mapping_opportunity__id__in=task_mapping_ids)
+
+    totals = {
+        rollup.task_mapping_id: {field_name: round(getattr(rollup, field_name), 2) for field_name in ROLLUP_TOTALS}
+        for rollup in TaskMappingRollup.objects.filter(task_mapping_id__in=task_mapping_ids)
+    }
+    return {"updated": sorted(assigned_products), "errors": [], "totals": totals}
@@ -0,0 +1,528 @@
+"""
+Estimate engine for the Task Mapping and Generate Estimate stages.
+
+The engine loads every `TaskMapping` of an opportunity once, sums the cost of
+the assigned products per task from a single query and then computes the
+per-task figures (labor cost/sell/GP, material cost/MU/GP, sales tax, ...) with
+`compute_figures`, one task at a time in exact decimal arithmetic rounded half
+up to whole cents like the estimate workbooks. The `TaskMapping` properties are
+thin accessors over this engine.
+
+The grand totals are kept in a cached `EstimateSummary`, shared by the estimate
+table and the KPI breakdowns.
+"""
+
+from decimal import ROUND_HALF_UP, Decimal
+
+import numpy as np
+from django.db.models import Case, F, FloatField, OuterRef, Q, QuerySet, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, NullIf, Round
+
+from .estimate_cache import get_or_compute
+from .models import AssignedProduct, TaskMapping
+
+# Product cost: `vendor_quoted_cost * quantity` if a quoted cost is set, otherwise `standard_cost * quantity`
+PRODUCT_COST_EXPRESSION = Case(
+    When(
+        Q(vendor_quoted_cost__isnull=False) & ~Q(vendor_quoted_cost=0),
+        then=F("vendor_quoted_cost") * F("quantity"),
+    ),
+    default=F("standard_cost") * F("quantity"),
+    output_field=FloatField(),
+)
+
+CENT = Decimal("0.01")
+UNIT = Decimal("1")
+ZERO = Decimal("0")
+
+
+def is_labor_task(task_mapping: TaskMapping) -> bool:
+    """Return True when the linked task description contains "labor" (`task__description__icontains="labor"`)."""
+    task = task_mapping.task
+    return bool(task and task.description and "labor" in task.description.lower())
+
+
+def is_freight_task(task_mapping: TaskMapping) -> bool:
+    """Return True for freight tasks (`code__icontains="FRT"` or `task__description__icontains="freight"`)."""
+    task = task_mapping.task
+    if task_mapping.code and "frt" in task_mapping.code.lower():
+        return True
+    return bool(task and task.description and "freight" in task.description.lower())
+
+
+def parse_tax_rate(tax_rate) -> float:
+    """
+    Parse the opportunity tax rate (e.g. "25.00%") into a float.
+
+    :param tax_rate: Tax rate stored on the opportunity.
+    :return: The tax rate as a float, or None if it can't be parsed.
+    """
+    try:
+        return float(tax_rate.strip("%"))
+    except (AttributeError, ValueError, TypeError):
+        return None
+
+
+def to_float(value) -> float:
+    """Convert a nullable number to a float, NaN if it is None."""
+    return np.nan if value is None else float(value)
+
+
+def to_decimal(value):
+    """
+    Convert a stored number to a `Decimal`, None if it is None or NaN.
+
+    NOTE: A float is converted from its shortest representation, the value as entered (e.g. `1.005` and not
+    `1.00499999999999989...`), so the amounts are exact before they are multiplied.
+    """
+    if value is None:
+        return None
+    if isinstance(value, Decimal):
+        return value
+    value = float(value)
+    return None if np.isnan(value) else Decimal(repr(value))
+
+
+def round_half_up(value: Decimal) -> int:
+    """Round a `Decimal` to the nearest integer, the halves away from zero like the ROUND of the estimate workbooks."""
+    return int(value.quantize(UNIT, rounding=ROUND_HALF_UP))
+
+
+def cents_to_decimal(cents) -> Decimal:
+    """Convert an amount in cents to a `Decimal` with 2 decimal places."""
+    return Decimal(int(cents)).scaleb(-2)
+
+
+def percent_of(value: Decimal, total: Decimal) -> Decimal:
+    """Percentage of a total with 2 decimal places, 0 if the total is 0."""
+    if not total:
+        return Decimal("0.00")
+    return (value / total * 100).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def weighted_percent(percents: np.ndarray, weights: np.ndarray) -> Decimal:
+    """
+    Average of percentages weighted by the amounts they apply to, e.g. the labor GP % of the tasks by labor cost.
+
+    :param percents: Array of percentages, NaN when not set (counted as 0).
+    :param weights: Array of the amounts, in cents.
+    :return: The average with 2 decimal places, the plain average if the amounts are all 0.
+    """
+    if not len(percents):
+        return Decimal("0.00")
+    percents = np.nan_to_num(percents)
+    if weights.sum():
+        average = (percents * weights).sum() / weights.sum()
+    else:
+        average = percents.mean()
+    return Decimal(repr(float(average))).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def compute_figures(labor_cost, mat_cost, labor_gp_percent, mat_gp_percent, tax_rate) -> dict:
+    """
+    Compute the estimate figures of several tasks.
+
+    The costs and percentages are converted to `Decimal` (see `to_decimal`) and each figure is computed in exact
+    decimal arithmetic and rounded half up to a whole number of cents once, so the sums of the figures are exact.
+
+    NOTE: The rounded figures are computed one task at a time with `Decimal` (a scalar loop, not vectorized): the
+    percentages have any number of decimal places, so the products don't fit exactly in integer cents. Only the
+    figures summed from them (`mat_sell`, `mat_tax_labor`, `acre`) are computed over the int64 arrays of cents.
+
+    NOTE:
+        labor_gp = labor_cost * (labor_gp_percent / 100)
+        labor_sell = labor_cost + labor_gp
+        mat_gp = mat_cost * (mat_gp_percent / 100)
+        mat_plus_mu = mat_cost + (mat_cost * (mat_gp_percent / 100)), rounded to whole dollars
+        sales_tax = mat_plus_mu * (tax_rate / 100)
+        mat_sell = mat_plus_mu + sales_tax
+        mat_tax_labor = mat_sell + labor_sell + sales_tax
+        comb_gp = (mat_sell + labor_sell) / (mat_cost + labor_cost) * 100
+        acre = mat_tax_labor / mat_gp_percent
+
+    :param labor_cost: Labor costs of the tasks, in dollars.
+    :param mat_cost: Material costs of the tasks, in dollars.
+    :param labor_gp_percent: Labor GP percentages of the tasks, None or NaN when not set (no labor sell and GP).
+    :param mat_gp_percent: Material GP percentages of the tasks, None or NaN when not set (no material MU and GP).
+    :param tax_rate: Tax rate of the opportunity, None when not set (no sales tax).
+    :return: A dictionary of arrays by figure name, the amounts in cents (int64), `comb_gp` and `acre` as floats.
+    """
+    tax_rate = to_decimal(tax_rate)
+    names = ("labor_cost", "labor_sell", "labor_gp", "mat_cost", "mat_plus_mu", "mat_gp", "sales_tax")
+    rows = []
+    for task_labor_cost, task_mat_cost, labor_percent, mat_percent in zip(
+        labor_cost, mat_cost, labor_gp_percent, mat_gp_percent
+    ):
+        # Amounts in cents
+        task_labor_cost = round_half_up(to_decimal(task_labor_cost) * 100)
+        task_mat_cost = round_half_up(to_decimal(task_mat_cost) * 100)
+        labor_percent = to_decimal(labor_percent)
+        mat_percent = to_decimal(mat_percent)
+
+        labor_gp = labor_sell = mat_gp = mat_plus_mu = sales_tax = 0
+        if labor_percent is not None:
+            labor_gp = round_half_up(task_labor_cost * labor_percent / 100)
+            labor_sell = task_labor_cost + labor_gp
+        if mat_percent is not None:
+            mat_gp = round_half_up(task_mat_cost * mat_percent / 100)
+            mat_plus_mu = round_half_up((task_mat_cost + task_mat_cost * mat_percent / 100) / 100) * 100
+        if tax_rate is not None:
+            sales_tax = round_half_up(mat_plus_mu * tax_rate / 100)
+        rows.append((task_labor_cost, labor_sell, labor_gp, task_mat_cost, mat_plus_mu, mat_gp, sales_tax))
+
+    figures = dict(zip(names, np.array(rows, dtype=np.int64).reshape(-1, len(names)).T))
+    figures["mat_sell"] = figures["mat_plus_mu"] + figures["sales_tax"]
+    figures["mat_tax_labor"] = figures["mat_sell"] + figures["labor_sell"] + figures["sales_tax"]
+
+    cost = figures["mat_cost"] + figures["labor_cost"]
+    sale = figures["mat_sell"] + figures["labor_sell"]
+    figures["comb_gp"] = np.array(
+        [float(percent_of(Decimal(int(value)), Decimal(int(total)))) for value, total in zip(sale, cost)], dtype=float
+    )
+    mat_gp_percent = np.array([to_float(percent) for percent in mat_gp_percent], dtype=float)
+    has_acre = ~np.isnan(mat_gp_percent) & (np.nan_to_num(mat_gp_percent) != 0)
+    figures["acre"] = np.where(has_acre, figures["mat_tax_labor"] / 100 / np.where(has_acre, mat_gp_percent, 1.0), 0.0)
+    return figures
+
+
+def figure_expressions(tax_rate: float) -> dict:
+    """
+    SQL expressions of the figures of a task mapping (see `compute_figures`) over the task rollups.
+
+    NOTE: They order the task mappings by a figure in the database, the displayed figures are the engine ones.
+
+    :param tax_rate: Tax rate of the opportunity, None when not set.
+    :return: A dictionary of expressions by figure name, for `TaskMapping` querysets.
+    """
+    labor_tasks = TaskMapping.objects.filter(opportunity=OuterRef("opportunity"), task__description__icontains="labor")
+
+    def labor_total(task_mappings: QuerySet):
+        total = task_mappings.order_by().values("opportunity").annotate(total=Sum("rollup__total_price"))
+        return Coalesce(Subquery(total.values("total")[:1], output_field=FloatField()), Value(0.0))
+
+    linked_labor = labor_tasks.filter(assign_to=OuterRef("code")).exclude(assign_to="")
+    own_labor = labor_tasks.filter(Q(id=OuterRef("id")) | Q(code=OuterRef("code"))).filter(
+        Q(assign_to__isnull=True) | Q(assign_to="")
+    )
+    labor_cost = Round(
+        Case(
+            When(linked_task__isnull=False, then=labor_total(linked_labor)),
+            When(description__icontains="labor", then=labor_total(own_labor)),
+            default=Value(0.0),
+            output_field=FloatField(),
+        ),
+        2,
+    )
+    mat_cost = Round(
+        Case(
+            When(task__description__icontains="labor", then=Value(0.0)),
+            default=Coalesce(F("rollup__total_price"), Value(0.0)),
+            output_field=FloatField(),
+        ),
+        2,
+    )
+
+    labor_rate = Coalesce(F("labor_gp_percent"), Value(0.0)) / Value(100.0)
+    labor_gp = Round(labor_cost * labor_rate, 2)
+    labor_sell = Case(
+        When(labor_gp_percent__isnull=True, then=Value(0.0)), default=labor_cost + labor_gp, output_field=FloatField()
+    )
+    mat_rate = Coalesce(F("mat_gp_percent"), Value(0.0)) / Value(100.0)
+    mat_gp = Round(mat_cost * mat_rate, 2)
+    mat_plus_mu = Case(
+        When(mat_gp_percent__isnull=True, then=Value(0.0)),
+        default=Round(mat_cost + mat_cost * mat_rate),
+        output_field=FloatField(),
+    )
+    sales_tax = Round(mat_plus_mu * Value((tax_rate or 0.0) / 100), 2)
+    mat_sell = mat_plus_mu + sales_tax
+    comb_gp = Coalesce(
+        Round((mat_sell + labor_sell) * Value(100.0) / NullIf(mat_cost + labor_cost, Value(0.0)), 2), Value(0.0)
+    )
+
+    return {
+        "labor_cost": labor_cost,
+        "labor_sell": labor_sell,
+        "labor_gp": labor_gp,
+        "mat_cost": mat_cost,
+        "mat_plus_mu": mat_plus_mu,
+        "mat_gp": mat_gp,
+        "sales_tax": sales_tax,
+        "mat_sell": mat_sell,
+        "mat_tax_labor": mat_sell + labor_sell + sales_tax,
+        "comb_gp": comb_gp,
+    }
+
+
+class EstimateEngine:
+    """
+    Compute the estimate figures of every task mapping of an opportunity.
+
+    Usage::
+
+        engine = EstimateEngine.for_document(document_number)
+        engine.figures[task_mapping.id]["mat_sell"]
+        engine.get_totals()
+    """
+
+    def __init__(self, task_mappings: QuerySet):
+        """
+        :param task_mappings: Queryset of the task mappings of a single opportunity.
+        """
+        self.task_mappings = list(task_mappings.select_related("task", "opportunity"))
+        self.costs = self._get_task_costs(task_mappings)
+        self.tax_rate = parse_tax_rate(self.task_mappings[0].opportunity.tax_rate) if self.task_mappings else None
+
+        self.labor_tasks = [task for task in self.task_mappings if is_labor_task(task)]
+        self.labor_costs = [self._labor_cost(task) for task in self.task_mappings]
+        self.freight = np.array([is_freight_task(task) for task in self.task_mappings], dtype=bool)
+        self.percents = {
+            field_name: np.array([to_float(getattr(task, field_name)) for task in self.task_mappings], dtype=float)
+            for field_name in ("labor_gp_percent", "mat_gp_percent", "s_and_h")
+        }
+        self.cents = compute_figures(
+            [labor_cost or ZERO for labor_cost in self.labor_costs],
+            [self._mat_cost(task) for task in self.task_mappings],
+            self.percents["labor_gp_percent"],
+            self.percents["mat_gp_percent"],
+            self.tax_rate,
+        )
+
+        self.figures = {}
+        for index, task in enumerate(self.task_mappings):
+            self.figures[task.id] = self._task_figures(task, index)
+            task._estimate = self.figures[task.id]
+
+    @classmethod
+    def for_document(cls, document_number: str) -> "EstimateEngine":
+        """Build the engine for the opportunity with the given document number."""
+        return cls(TaskMapping.objects.filter(opportunity__document_number=document_number))
+
+    @classmethod
+    def for_opportunity(cls, opportunity_id: int) -> "EstimateEngine":
+        """Build the engine for the opportunity with the given id."""
+        return cls(TaskMapping.objects.filter(opportunity_id=opportunity_id))
+
+    @staticmethod
+    def _get_task_costs(task_mappings: QuerySet) -> dict:
+        """
+        Sum the assigned product cost per task mapping, from a single query.
+
+        NOTE: The product costs are summed as `Decimal` in Python (see `to_decimal`), a sum of the float products in
+        the database would carry their binary representation error into the rounding of the figures.
+
+        :param task_mappings: Queryset of task mappings.
+        :return: A dictionary of `{task_mapping_id: total_cost}`, the totals as `Decimal`.
+        """
+        costs = {}
+        rows = (
+            AssignedProduct.objects.filter(task_mapping__in=task_mappings)
+            .values_list("task_mapping_id", "quantity", "standard_cost", "vendor_quoted_cost")
+            .order_by()
+        )
+        for task_mapping_id, quantity, standard_cost, vendor_quoted_cost in rows:
+            # `vendor_quoted_cost * quantity` if a quoted cost is set, otherwise `standard_cost * quantity`
+            unit_cost = vendor_quoted_cost if vendor_quoted_cost else standard_cost
+            if quantity is None or unit_cost is None:
+                continue
+            costs[task_mapping_id] = costs.get(task_mapping_id, ZERO) + to_decimal(unit_cost) * to_decimal(quantity)
+        return costs
+
+    def annotate(self, task_mappings) -> list:
+        """
+        Attach the computed figures to the given task mapping instances so the
+        `TaskMapping` properties don't hit the database.
+
+        :param task_mappings: Iterable of task mappings belonging to this opportunity.
+        :return: A list of the task mappings.
+        """
+        task_mappings = list(task_mappings)
+        for task in task_mappings:
+            if task.id in self.figures:
+                task._estimate = self.figures[task.id]
+        return task_mappings
+
+    def _labor_cost(self, task_mapping: TaskMapping):
+        """
+        Labor cost of the labor tasks linked to (or owned by) the given task mapping, None if the task mapping has
+        no labor.
+        """
+        if task_mapping.linked_task_id:
+            total_price = ZERO
+            for task in self.labor_tasks:
+                if task.assign_to == task_mapping.code and task.assign_to:
+                    total_price += self.costs.get(task.id, ZERO)
+            return total_price
+
+        if task_mapping.description and "labor" in task_mapping.description.lower():
+            total_price = ZERO
+            for task in self.labor_tasks:
+                if (task.id == task_mapping.id or task.code == task_mapping.code) and not task.assign_to:
+                    total_price += self.costs.get(task.id, ZERO)
+            return total_price
+
+        return None
+
+    def _mat_cost(self, task_mapping: TaskMapping) -> Decimal:
+        """Material cost of the products assigned to a non labor task mapping."""
+        if is_labor_task(task_mapping):
+            return ZERO
+        return self.costs.get(task_mapping.id, ZERO)
+
+    def _task_figures(self, task_mapping: TaskMapping, index: int) -> dict:
+        """
+        Figures of one task mapping, as returned by the `TaskMapping` properties.
+
+        NOTE: The figures keep the types the templates render: the figures of an unset percentage or tax rate are
+        an integer 0 and `mat_plus_mu` is a whole number of dollars.
+
+        :param task_mapping: The task mapping.
+        :param index: Index of the task mapping in `self.task_mappings`.
+        :return: A dictionary of figures by name.
+        """
+        labor_set = task_mapping.labor_gp_percent is not None
+        mat_set = task_mapping.mat_gp_percent is not None
+        tax_set = self.tax_rate is not None
+
+        def amount(name: str):
+            return int(self.cents[name][index]) / 100
+
+        def dollars(name: str) -> int:
+            return int(self.cents[name][index]) // 100
+
+        mat_sell = amount("mat_sell") if tax_set else dollars("mat_sell")
+        mat_tax_labor = amount("mat_tax_labor") if tax_set or labor_set else dollars("mat_tax_labor")
+        has_cost = self.cents["labor_cost"][index] + self.cents["mat_cost"][index] != 0
+        has_acre = mat_set and task_mapping.mat_gp_percent != 0
+
+        return {
+            "labor_cost": 0 if self.labor_costs[index] is None else amount("labor_cost"),
+            "labor_sell": amount("labor_sell") if labor_set else 0,
+            "labor_gp": amount("labor_gp") if labor_set else 0,
+            "mat_cost": amount("mat_cost"),
+            "mat_plus_mu": dollars("mat_plus_mu"),
+            "mat_gp": amount("mat_gp") if mat_set else 0,
+            "sales_tax": amount("sales_tax") if tax_set else 0,
+            "mat_sell": mat_sell,
+            "mat_tax_labor": mat_tax_labor,
+            "comb_gp": float(self.cents["comb_gp"][index]) if has_cost else 0,
+            "acre": float(self.cents["acre"][index]) if has_acre else 0,
+        }
+
+    def get_totals(self) -> dict:
+        """
+        Calculate the grand totals of the estimate table (freight tasks excluded).
+
+        The amounts are exact sums of the rounded task figures. The percentage totals are the averages of the task
+        percentages weighted by the cost they apply to, and the combined GP is the one of the total sale and cost.
+
+        :return: A dictionary of `Decimal` totals with 2 decimal places, keyed like `GenerateEstimate._get_total`.
+        """
+        included = ~self.freight
+
+        def total(name: str) -> Decimal:
+            return cents_to_decimal(self.cents[name][included].sum())
+
+        labor_cost = self.cents["labor_cost"][included]
+        mat_cost = self.cents["mat_cost"][included]
+        totals = {
+            "total_labor_cost": total("labor_cost"),
+            "total_labor_gp_percent": weighted_percent(self.percents["labor_gp_percent"][included], labor_cost),
+            "total_labor_gp": total("labor_gp"),
+            "total_labor_sell": total("labor_sell"),
+            "total_mat_cost": total("mat_cost"),
+            "total_mat_gp_percent": weighted_percent(self.percents["mat_gp_percent"][included], mat_cost),
+            "total_mat_gp": total("mat_gp"),
+            "total_mat_mu": total("mat_plus_mu"),
+            "total_sales_tax": total("sales_tax"),
+            "total_s_and_h": weighted_percent(self.percents["s_and_h"][included], mat_cost),
+            "total_mat_sell": total("mat_sell"),
+            "total_mat_tax_labor": total("mat_tax_labor"),
+        }
+        totals["total_cost"] = totals["total_labor_cost"] + totals["total_mat_cost"]
+        totals["total_sale"] = totals["total_labor_sell"] + totals["total_mat_sell"]
+        totals["total_gp"] = totals["total_mat_gp"] + totals["total_labor_gp"]
+        totals["total_gp_per"] = totals["total_sale"] - totals["total_cost"]
+        totals["total_comb_gp"] = percent_of(totals["total_sale"], totals["total_cost"])
+        totals["total_gp_percent"] = percent_of(totals["total_gp"], totals["total_sale"])
+
+        return totals
+
+
+class EstimateSummary:
+    """
+    Grand totals of the estimate of an opportunity, shared by the estimate table and the KPI breakdowns.
+
+    The summary is computed once by the `EstimateEngine` and kept in the estimate cache until the estimate of the
+    opportunity changes (see `estimate_cache.py`), so the KPI breakdowns opened after the estimate table don't
+    query the database.
+
+    Usage::
+
+        summary = EstimateSummary.for_document(document_number)
+        summary.cost["total_cost"]
+    """
+
+    def __init__(self, totals: dict):
+        """
+        :param totals: Totals of the estimate, see `EstimateEngine.get_totals`.
+        """
+        self.totals = totals
+
+    @classmethod
+    def for_document(cls, document_number: str, engine: EstimateEngine = None) -> "EstimateSummary":
+        """
+        Get the summary of the opportunity with the given document number, computed if it isn't cached.
+
+        :param document_number: The unique identifier for the opportunity.
+        :param engine: Estimate engine of the opportunity, built if needed and not provided.
+        :return: The estimate summary.
+        """
+        return get_or_compute(
+            "summary",
+            document_number,
+            lambda: cls((engine or EstimateEngine.for_document(document_number)).get_totals()),
+        )
+
+    def formatted(self) -> dict:
+        """Totals formatted for the estimate table, e.g. "1,234.50"."""
+        return {key: f"{value:,.2f}" for key, value in self.totals.items()}
+
+    @property
+    def cost(self) -> dict:
+        """Total cost breakdown."""
+        return {
+            "total_labor_cost": self.totals["total_labor_cost"],
+            "total_mat_cost": self.totals["total_mat_cost"],
+            "total_cost": self.totals["total_cost"],
+        }
+
+    @property
+    def sale(self) -> dict:
+        """Total sale breakdown."""
+        return {
+            "total_labor_sale": self.totals["total_labor_sell"],
+            "total_mat_sale": self.totals["total_mat_sell"],
+            "total_sale": self.totals["total_sale"],
+        }
+
+    @property
+    def gp(self) -> dict:
+        """Total gross profit breakdown."""
+        return {
+            "total_mat_gp": self.totals["total_mat_gp"],
+            "total_labor_gp": self.totals["total_labor_gp"],
+            "total_gp": self.totals["total_gp"],
+        }
+
+    @property
+    def gp_percent(self) -> dict:
+        """Total gross profit percentage breakdown."""
+        return {
+            "total_gp": self.totals["total_gp"],
+            "total_sell": self.totals["total_sale"],
+            "total_mat_gp": self.totals["total_mat_gp"],
+            "total_labor_gp": self.totals["total_labor_gp"],
+            "total_gp_per": self.totals["total_gp_per"],
+            "total_gp_percent": self.totals["total_gp_percent"],
+        }
@@ -0,0 +1,101 @@
+"""
+Versioned cache of the estimate data of an opportunity (task mapping tables, estimate totals, proposal totals,
+final document data).
+
+The entries are keyed by `(document_number, revision)`, the revision being `Opportunity.estimate_revision`. The
+signals of the models the estimate is computed from bump the revision (see `signals.py`), so the next reads use new
+keys and the entries of the previous revisions simply expire. The current revision is read from the database on
+every lookup (one query on the `(document_number, estimate_revision)` index), so a bump is seen right away by every process.
+
+The `estimate_cache_accessed` signal is sent on every lookup, it's the hook for the hit/miss metrics::
+
+    @receiver(estimate_cache_accessed)
+    def count_estimate_cache_lookups(sender, name, document_number, revision, hit, **kwargs):
+        ...
+"""
+
+from typing import Callable
+
+from django.core.cache import cache
+from django.db.models import F
+from django.dispatch import Signal
+
+from apps.constants import LOGGER
+
+from .models import Opportunity
+
+# Seconds an entry is kept, the entries of the previous revisions are never read again
+CACHE_TIMEOUT = 60 * 60 * 24
+
+# Sent on every lookup with the `name` of the data, the `document_number`, the `revision` and whether it was a `hit`
+estimate_cache_accessed = Signal()
+
+_MISSING = object()
+
+
+def data_key(name: str, document_number: str, revision: int) -> str:
+    """Cache key of some estimate data of an opportunity at a revision."""
+    return f"estimate:{name}:{document_number}:{revision}"
+
+
+def get_revision(document_number: str):
+    """
+    Get the current estimate revision of an opportunity.
+
+    :param document_number: The unique identifier for the opportunity.
+    :return: The revision, None if the opportunity doesn't exist.
+    """
+    return (
+        Opportunity.objects.filter(document_number=document_number)
+        .values_list("estimate_revision", flat=True)
+        .first()
+    )
+
+
+def bump_revision(**filters) -> None:
+    """
+    Increment the estimate revision of the opportunities matching the filters.
+
+    NOTE: Bulk writes (`bulk_create`, `bulk_update`, `QuerySet.update`) don't send the model signals and must call
+    this themselves.
+
+    :param filters: `Opportunity` lookups, e.g. `task_mapping_opportunity__id=task_mapping_id`.
+    """
+    Opportunity.objects.filter(**filters).update(estimate_revision=F("estimate_revision") + 1)
+
+
+def get_or_compute(name: str, document_number: str, compute: Callable):
+    """
+    Get some estimate data of an opportunity from the cache, computed and cached on a miss.
+
+    NOTE: The data is computed without the cache when the cache is unavailable.
+
+    :param name: Name of the data, part of the cache key.
+    :param document_number: The unique identifier for the opportunity.
+    :param compute: Function computing the data, without arguments. The data must be picklable.
+    :return: The data.
+    """
+    try:
+        revision = get_revision(document_number)
+        if revision is None:
+            return compute()
+
+        key = data_key(name, document_number, revision)
+        value = cache.get(key, _MISSING)
+    except Exception as e:
+        LOGGER.error(f"[estimate_cache][get_or_compute] {name} {document_number}: {e}")
+        return compute()
+
+    hit = value is not _MISSING
+    estimate_cache_accessed.send(
+        sender=Opportunity, name=name, document_number=document_number, revision=revision, hit=hit
+    )
+    if hit:
+        return value
+
+    value = compute()
+    try:
+        cache.set(key, value, CACHE_TIMEOUT)
+    except Exception as e:
+        LOGGER.error(f"[estimate_cache][get_or_compute] {name} {document_number}: {e}")
+    return value
@@ -0,0 +1,86 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from apps.proposal.opportunity.models import Opportunity, TaskMapping, TaskMappingRollup
+
+
+class Command(BaseCommand):
+    help = "Rebuild (or verify) the task mapping rollups of one or more opportunities"
+
+    def add_arguments(self, parser):
+        parser.add_argument("document_numbers", nargs="*", help="Document numbers of the opportunities")
+        parser.add_argument("--all", action="store_true", help="Process every opportunity")
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            help="Only compare the stored rollups with the assigned products, don't write anything",
+        )
+
+    def handle(self, *args, **options):
+        document_numbers = options["document_numbers"]
+
+        if options["all"]:
+            opportunities = Opportunity.objects.all()
+        elif document_numbers:
+            opportunities = Opportunity.objects.filter(document_number__in=document_numbers)
+            missing = set(document_numbers) - set(opportunities.values_list("document_number", flat=True))
+            if missing:
+                raise CommandError(f"Opportunity not found: {', '.join(sorted(missing))}")
+        else:
+            raise CommandError("Pass one or more document numbers or --all")
+
+        mismatches = 0
+
+        for opportunity in opportunities.order_by("document_number"):
+            task_mappings = TaskMapping.objects.filter(opportunity=opportunity).select_related("rollup")
+
+            if options["verify"]:
+                mismatches += self.verify(opportunity, task_mappings)
+                continue
+
+            with transaction.atomic():
+                for task_mapping in task_mappings:
+                    TaskMappingRollup.refresh(task_mapping.id)
+
+            self.stdout.write(f"{opportunity.document_number}: rebuilt {len(task_mappings)} task rollups")
+
+        if mismatches:
+            raise CommandError(f"{mismatches} task rollups are out of date")
+
+        self.stdout.write(self.style.SUCCESS("Done"))
+
+    def verify(self, opportunity: Opportunity, task_mappings) -> int:
+        """
+        Compare the stored rollups of an opportunity with freshly calculated values.
+
+        :param opportunity: Opportunity to verify.
+        :param task_mappings: Task mappings of the opportunity.
+        :return: The number of missing or out of date rollups.
+        """
+        mismatches = 0
+
+        for task_mapping in task_mappings:
+            expected = TaskMappingRollup.calculate(task_mapping.id)
+
+            try:
+                rollup = task_mapping.rollup
+            except TaskMappingRollup.DoesNotExist:
+                mismatches += 1
+                self.stdout.write(self.style.WARNING(f"{opportunity.document_number}: task {task_mapping.id} has no rollup"))
+                continue
+
+            for field in TaskMappingRollup.ROLLUP_FIELDS:
+                if round(getattr(rollup, field), 6) != round(expected[field], 6):
+                    mismatches += 1
+                    self.stdout.write(
+                        self.style.WARNING(
+                            f"{opportunity.document_number}: task {task_mapping.id} {field} is "
+                            f"{getattr(rollup, field)}, expected {expected[field]}"
+                        )
+                    )
+                    break
+
+        if not mismatches:
+            self.stdout.write(f"{opportunity.document_number}: {len(task_mappings)} task rollups are up to date")
+
+        return mismatches
@@ -0,0 +1,31 @@
+# Generated by Django 4.2 on 2026-10-17 01:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opportunity', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskMappingRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('product_count', models.IntegerField(default=0, verbose_name='Product Count')),
+                ('total_quantity', models.FloatField(default=0.0, verbose_name='Total Quantity')),
+                ('total_price', models.FloatField(default=0.0, verbose_name='Total Price')),
+                ('total_unit_price', models.FloatField(default=0.0, verbose_name='Total Unit Price')),
+                ('total_percent', models.FloatField(default=0.0, verbose_name='Total Gross Profit Percentage')),
+                ('task_mapping', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='rollup', to='opportunity.taskmapping')),
+            ],
+            options={
+                'verbose_name': 'Task Mapping Rollup',
+            },
+        ),
+    ]
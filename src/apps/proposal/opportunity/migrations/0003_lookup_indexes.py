@@ -0,0 +1,40 @@
+# Generated by Django 4.2 on 2026-10-17 01:42
+
+from django.db import migrations, models
+
+
+def create_trigram_index(apps, schema_editor):
+    """Trigram index for the `item_code__icontains` searches, PostgreSQL only (pg_trgm)."""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS assigned_product_item_code_trgm_idx '
+        'ON opportunity_assignedproduct USING gin (UPPER(item_code::text) gin_trgm_ops)'
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS assigned_product_item_code_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opportunity', '0002_taskmappingrollup'),
+        # pg_trgm extension
+        ('product', '0003_product_display_name_key'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='assignedproduct',
+            index=models.Index(fields=['task_mapping', 'item_code'], name='opportunity_task_ma_120b5b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='preliminarymateriallist',
+            index=models.Index(fields=['opportunity', 'item_number'], name='opportunity_opportu_1935bf_idx'),
+        ),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-17 01:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opportunity', '0003_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='opportunity',
+            name='estimate_revision',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Estimate Revision'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-17 02:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opportunity', '0004_opportunity_estimate_revision'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='opportunity',
+            index=models.Index(fields=['document_number', 'estimate_revision'], name='opportunity_documen_c73111_idx'),
+        ),
+    ]
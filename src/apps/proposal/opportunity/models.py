@@ -3,10 +3,11 @@ import random
 from datetime import datetime, timedelta
 
 from azure.storage.blob import BlobSasPermissions, BlobServiceClient, generate_blob_sas
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
 from dotenv import load_dotenv
 
+from apps.constants import BULK_CREATE_BATCH_SIZE
 from apps.proposal.customer.models import Customer
 from apps.proposal.task.models import Task
 from laurel.models import BaseModel
@@ -89,10 +90,25 @@ class Opportunity(BaseModel):
     project = models.CharField(_("Project"), max_length=255, blank=True, null=True)
     tax_rate = models.CharField(_("Tax Rate"), max_length=50, default="25.00%", blank=True, null=True)
     term_and_condition = models.JSONField(_("Term & Condition"), blank=True, null=True)
+    # Bumped when the estimate data changes, part of the estimate cache keys (see `estimate_cache.py`)
+    estimate_revision = models.PositiveIntegerField(_("Estimate Revision"), default=0, editable=False)
 
     def __str__(self):
         return f"{self.document_number} - {self.customer}"
 
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        # The estimate revision is only written by `bump_revision`, the value of the instance may be outdated, so
+        # the UPDATE of `save()` leaves it out whatever the `update_fields`
+        values = [value for value in values if value[0].name != "estimate_revision"]
+        return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Tax rate as loaded, the estimate revision is bumped when it changes (see `signals.py`)
+        instance._loaded_tax_rate = instance.__dict__.get("tax_rate")
+        return instance
+
     def get_current_stage_constant(self):
         stage_mapping = {
             self.STAGE_1: "STAGE_1",
@@ -108,6 +124,10 @@ class Opportunity(BaseModel):
 
     class Meta:
         verbose_name = "Proposal Opportunities"
+        indexes = [
+            # Revision lookup of the estimate cache, on every cached read
+            models.Index(fields=["document_number", "estimate_revision"]),
+        ]
 
 
 class SelectTaskCode(BaseModel):
@@ -242,6 +262,9 @@ class PreliminaryMaterialList(BaseModel):
 
     class Meta:
         verbose_name = "Proposal Preliminary Material"
+        indexes = [
+            models.Index(fields=["opportunity", "item_number"]),
+        ]
 
 
 class TaskMapping(BaseModel):
@@ -271,64 +294,27 @@ class TaskMapping(BaseModel):
             return f"{self.id} - {self.opportunity.document_number} - {self.code}"
         return f"{self.id} - {self.opportunity.document_number} - {self.task.name}"
 
+    @property
+    def estimate(self) -> dict:
+        """
+        Estimate figures of this task mapping computed by the `EstimateEngine`.
+
+        NOTE:
+            Views rendering many task mappings should build one `EstimateEngine` per opportunity and
+            `annotate` the instances, otherwise the figures are computed for this instance on first access.
+        """
+        if getattr(self, "_estimate", None) is None:
+            from .estimate import EstimateEngine
+
+            EstimateEngine.for_opportunity(self.opportunity_id).annotate([self])
+        return getattr(self, "_estimate", None) or {}
+
     @property
     def labor_cost(self):
         """
-        Calculate the labor cost based on assigned products for tasks related to this TaskMapping instance.
-        """
-        if self.linked_task:
-            task_mappings = TaskMapping.objects.filter(
-                opportunity=self.opportunity, task__description__icontains="labor"
-            )
-
-            # Initialize total calculations
-            total_quantity = 0
-            total_price = 0.0
-            total_percent = 0.0
-
-            for task in task_mappings:
-                if task.assign_to == self.code and task.assign_to:
-                    assigned_products = AssignedProduct.objects.filter(task_mapping_id=task.id)
-                    total_quantity += sum(product.quantity for product in assigned_products)
-                    total_price += sum(
-                        (
-                            product.vendor_quoted_cost * product.quantity
-                            if product.vendor_quoted_cost
-                            else product.standard_cost * product.quantity
-                        )
-                        for product in assigned_products
-                    )
-                    total_percent += sum(product.gross_profit_percentage for product in assigned_products)
-
-            return round(total_price, 2)
-
-        elif not self.linked_task and self.description and "labor" in self.description.lower():
-
-            task_mappings = TaskMapping.objects.filter(
-                opportunity=self.opportunity, task__description__icontains="labor"
-            ).filter(models.Q(id=self.id) | models.Q(code=self.code))
-
-            # Initialize total calculations
-            total_quantity = 0
-            total_price = 0.0
-            total_percent = 0.0
-
-            for task in task_mappings:
-                if not task.assign_to:
-                    assigned_products = AssignedProduct.objects.filter(task_mapping_id=task.id)
-                    total_quantity += sum(product.quantity for product in assigned_products)
-                    total_price += sum(
-                        (
-                            product.vendor_quoted_cost * product.quantity
-                            if product.vendor_quoted_cost
-                            else product.standard_cost * product.quantity
-                        )
-                        for product in assigned_products
-                    )
-                    total_percent += sum(product.gross_profit_percentage for product in assigned_products)
-            return round(total_price, 2)
-
-        return 0
+        Calculate the labor cost based on assigned products for labor tasks related to this TaskMapping instance.
+        """
+        return self.estimate.get("labor_cost", 0)
 
     @property
     def labor_sell(self):
@@ -338,58 +324,21 @@ class TaskMapping(BaseModel):
         NOTE:
             Formula : labor_cost + (labor_cost * (labor_gp_percent / 100))
         """
-        if self.labor_cost is not None and self.labor_gp_percent is not None:
-            try:
-                labor_cost = float(self.labor_cost)
-                labor_gp_percent = float(self.labor_gp_percent) / 100
-                # if (1 - labor_gp_percent) != 0:
-                # return round(labor_cost / (1 - labor_gp_percent), 2)
-                return round(labor_cost + (labor_cost * (labor_gp_percent)), 2)
-            except (ValueError, ZeroDivisionError):
-                return 0
-        return 0
+        return self.estimate.get("labor_sell", 0)
 
     @property
     def labor_gp(self):
         """
         Calculate `Labor GP $` as the difference between `labor_sell` and `labor_cost`.
         """
-        try:
-            labor_gp = float(self.labor_gp_percent / 100)
-            labor_cost = float(self.labor_cost)
-            return round(labor_cost * labor_gp, 2)
-        except ValueError:
-            return 0
+        return self.estimate.get("labor_gp", 0)
 
     @property
     def mat_cost(self):
         """
-        Calculate the mat cost based on assigned products for tasks related to this TaskMapping instance.
+        Calculate the mat cost based on assigned products for this TaskMapping instance.
         """
-        task_mappings = TaskMapping.objects.filter(opportunity=self.opportunity)
-        filtered_task_mappings = task_mappings.exclude(task__description__icontains="labor")
-
-        assigned_products = AssignedProduct.objects.filter(task_mapping_id=self.id)
-
-        total_quantity = 0
-        total_price = 0.0
-        total_percent = 0.0
-
-        for task in filtered_task_mappings:
-            task_assigned_products = assigned_products.filter(task_mapping_id=task.id)
-
-            total_quantity += sum(product.quantity for product in task_assigned_products)
-            total_price += sum(
-                (
-                    product.vendor_quoted_cost * product.quantity
-                    if product.vendor_quoted_cost
-                    else product.standard_cost * product.quantity
-                )
-                for product in task_assigned_products
-            )
-            total_percent += sum(product.gross_profit_percentage for product in task_assigned_products)
-
-        return round(total_price, 2)
+        return self.estimate.get("mat_cost", 0)
 
     @property
     def mat_plus_mu(self):
@@ -399,56 +348,31 @@ class TaskMapping(BaseModel):
         NOTE:
             Formula: mat_plus_mu = mat_cost + (mat_cost * (mat_gp_percent / 100))
         """
-        if self.mat_gp_percent is not None:
-            try:
-                mat_cost = float(self.mat_cost)
-                mat_gp_percent = float(self.mat_gp_percent) / 100
-                # if (1 - mat_gp_percent) != 0:
-                #     return round(mat_cost / (1 - mat_gp_percent), 2)
-                return round(mat_cost + (mat_cost * (mat_gp_percent)))
-            except (ValueError, ZeroDivisionError):
-                return 0
-        return 0
+        return self.estimate.get("mat_plus_mu", 0)
 
     @property
     def mat_gp(self):
         """
         Calculate `MAT GP $` as the difference between `mat_plus_mu` and `mat_cost`.
         """
-        try:
-            mat_cost = float(self.mat_cost)
-            mat_gp_percent = float(self.mat_gp_percent) / 100
-            return round(mat_cost * mat_gp_percent, 2)
-        except ValueError:
-            return 0
+        return self.estimate.get("mat_gp", 0)
 
     @property
     def sales_tax(self):
         """
-        Calculate `Sales Tax` as 25% of `mat_plus_mu`.
+        Calculate `Sales Tax` based on `mat_plus_mu` and the opportunity tax rate.
 
         NOTE:
             Formula: mat_plus_mu * (tax_rate / 100)
         """
-        try:
-            tax_rate = self.opportunity.tax_rate.strip("%")
-            tax_rate = float(tax_rate)
-
-            # return round(self.mat_plus_mu * tax_rate, 2)
-            return round(self.mat_plus_mu * (tax_rate / 100), 2)
-
-        except (ValueError, TypeError):
-            return 0
+        return self.estimate.get("sales_tax", 0)
 
     @property
     def mat_sell(self):
         """
         Calculate `MAT sell` as the sum of `mat_plus_mu` and `sales_tax`.
         """
-        try:
-            return round(self.mat_plus_mu + self.sales_tax, 2)
-        except (ValueError, TypeError):
-            return 0
+        return self.estimate.get("mat_sell", 0)
 
     @property
     def mat_tax_labor(self):
@@ -458,10 +382,7 @@ class TaskMapping(BaseModel):
         NOTE:
             Formula: mat_sell + labor_sell + sales_tax
         """
-        try:
-            return round(self.mat_sell + self.labor_sell + self.sales_tax, 2)
-        except (ValueError, TypeError):
-            return 0
+        return self.estimate.get("mat_tax_labor", 0)
 
     @property
     def comb_gp(self):
@@ -471,25 +392,14 @@ class TaskMapping(BaseModel):
         NOTE:
             Formula: (mat_sell + labor_sell) / (mat_cost + labor_cost) * 100
         """
-        try:
-            # total_gp = self.mat_gp + self.labor_gp
-            # total_cost = self.labor_sell + self.mat_plus_mu
-            # return round((total_gp / total_cost) * 100, 2) if total_cost != 0 else 0
-            return round((self.mat_sell + self.labor_sell) / (self.mat_cost + self.labor_cost) * 100, 2)
-        except (ValueError, ZeroDivisionError):
-            return 0
+        return self.estimate.get("comb_gp", 0)
 
     @property
     def acre(self):
         """
         Calculate `$/Acre` based on `mat_tax_labor` and `mat_gp_percent`.
         """
-        if self.mat_gp_percent is not None:
-            try:
-                return self.mat_tax_labor / float(self.mat_gp_percent) if float(self.mat_gp_percent) != 0 else 0
-            except (ValueError, ZeroDivisionError):
-                return 0
-        return 0
+        return self.estimate.get("acre", 0)
 
     class Meta:
         verbose_name = "Proposal Task Mapping"
@@ -537,11 +447,137 @@ class AssignedProduct(BaseModel):
         gross_profit_percentage_sum = (self.gross_profit / self.sell) * 100
         return round(gross_profit_percentage_sum, 2)
 
+    def save(self, *args, **kwargs):
+        # Save the row and refresh its task mapping rollup (post_save signal) in the same transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.id} - {self.task_mapping.id}"
 
     class Meta:
         verbose_name = "Proposal Assigned Product"
+        indexes = [
+            models.Index(fields=["task_mapping", "item_code"]),
+        ]
+
+
+class TaskMappingRollup(BaseModel):
+    """
+    Totals of the products assigned to a task mapping.
+
+    The row is refreshed by the `AssignedProduct` signals, so the Task Mapping screens read one row per
+    task instead of summing every assigned product on each request. Values are stored unrounded and
+    rounded when displayed.
+    """
+
+    task_mapping = models.OneToOneField(TaskMapping, on_delete=models.CASCADE, related_name="rollup")
+    product_count = models.IntegerField(_("Product Count"), default=0)
+    total_quantity = models.FloatField(_("Total Quantity"), default=0.0)
+    total_price = models.FloatField(_("Total Price"), default=0.0)
+    total_unit_price = models.FloatField(_("Total Unit Price"), default=0.0)
+    total_percent = models.FloatField(_("Total Gross Profit Percentage"), default=0.0)
+
+    ROLLUP_FIELDS = ("product_count", "total_quantity", "total_price", "total_unit_price", "total_percent")
+
+    @staticmethod
+    def calculate(task_mapping_id: int) -> dict:
+        """
+        Sum the assigned products of a task mapping.
+
+        NOTE:
+            unit_price = vendor_quoted_cost if vendor_quoted_cost else standard_cost
+            total_price = sum(unit_price * quantity)
+            total_percent = sum(gross_profit_percentage)
+
+        :param task_mapping_id: Id of the task mapping.
+        :return: A dictionary of the rollup field values.
+        """
+        return TaskMappingRollup.calculate_many([task_mapping_id])[task_mapping_id]
+
+    @staticmethod
+    def calculate_many(task_mapping_ids: list) -> dict:
+        """
+        Sum the assigned products of several task mappings, fetched in a single query (see `calculate`).
+
+        :param task_mapping_ids: Ids of the task mappings.
+        :return: A dictionary of `{task_mapping_id: rollup field values}`, with zero totals for the task mappings
+            without products.
+        """
+        rollups = {
+            task_mapping_id: {
+                "product_count": 0,
+                "total_quantity": 0.0,
+                "total_price": 0.0,
+                "total_unit_price": 0.0,
+                "total_percent": 0.0,
+            }
+            for task_mapping_id in task_mapping_ids
+        }
+
+        for product in AssignedProduct.objects.filter(task_mapping_id__in=list(rollups)):
+            values = rollups[product.task_mapping_id]
+            quantity = product.quantity or 0.0
+            unit_price = product.vendor_quoted_cost if product.vendor_quoted_cost else (product.standard_cost or 0.0)
+
+            values["product_count"] += 1
+            values["total_quantity"] += quantity
+            values["total_price"] += unit_price * quantity
+            values["total_unit_price"] += unit_price
+            try:
+                values["total_percent"] += product.gross_profit_percentage
+            except (TypeError, ZeroDivisionError):
+                pass
+
+        return rollups
+
+    @classmethod
+    def refresh(cls, task_mapping_id: int, create: bool = True) -> None:
+        """
+        Recalculate the rollup of a task mapping.
+
+        NOTE: The task mapping row is locked (`select_for_update`) until the rollup is written, so two concurrent
+        refreshes of the same task can't write the totals they read before the other one's products.
+
+        :param task_mapping_id: Id of the task mapping.
+        :param create: Create the rollup if it doesn't exist yet. Only existing rows are updated otherwise,
+            which is what the delete signal needs while the task mapping itself is being deleted.
+        """
+        with transaction.atomic():
+            list(TaskMapping.objects.select_for_update().filter(id=task_mapping_id).values_list("id", flat=True))
+            values = cls.calculate(task_mapping_id)
+            if create:
+                cls.objects.update_or_create(task_mapping_id=task_mapping_id, defaults=values)
+            else:
+                cls.objects.filter(task_mapping_id=task_mapping_id).update(**values)
+
+    @classmethod
+    def ensure(cls, task_mappings) -> None:
+        """
+        Build the missing rollups of the given task mappings (e.g. tasks without products or created before the
+        table existed), in a constant number of queries.
+
+        :param task_mappings: Queryset of task mappings.
+        """
+        missing = list(task_mappings.filter(rollup__isnull=True).values_list("id", flat=True))
+        if not missing:
+            return
+
+        # `ignore_conflicts` skips the rollups created meanwhile by the `AssignedProduct` signals
+        cls.objects.bulk_create(
+            [
+                cls(task_mapping_id=task_mapping_id, **values)
+                for task_mapping_id, values in cls.calculate_many(missing).items()
+            ],
+            batch_size=BULK_CREATE_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+
+    def __str__(self):
+        return f"{self.id} - {self.task_mapping_id}"
+
+    class Meta:
+        verbose_name = "Task Mapping Rollup"
 
 
 class ProposalCreation(BaseModel):
@@ -593,5 +629,23 @@ class Invoice(BaseModel):
 
         super().save(*args, **kwargs)
 
+    @classmethod
+    def create_missing(cls, opportunity_ids: list) -> int:
+        """
+        Create the invoice of the opportunities that don't have one yet, like `generate_invoice_details` does on
+        save, for opportunities written without signals (e.g. by the bulk import).
+
+        :param opportunity_ids: Ids of the opportunities.
+        :return: The number of invoices created.
+        """
+        existing = set(cls.objects.filter(opportunity_id__in=opportunity_ids).values_list("opportunity_id", flat=True))
+        invoices = [
+            cls(opportunity_id=opportunity_id, invoice_number=f"INV-{random.randint(1, 999999)}")
+            for opportunity_id in dict.fromkeys(opportunity_ids)
+            if opportunity_id not in existing
+        ]
+        cls.objects.bulk_create(invoices, batch_size=BULK_CREATE_BATCH_SIZE)
+        return len(invoices)
+
     class Meta:
         verbose_name = "Proposal Invoice"
@@ -1,16 +1,20 @@
 import random
 
 from django.db.models import Q
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 from apps.constants import LOGGER
+from apps.proposal.opportunity.estimate_cache import bump_revision
 from apps.proposal.opportunity.models import (
+    AssignedProduct,
     Document,
     Invoice,
     Opportunity,
+    ProposalCreation,
     SelectTaskCode,
     TaskMapping,
+    TaskMappingRollup,
 )
 
 SAVING_FLAG = False
@@ -114,3 +118,80 @@ def sync_task_description_value(sender, instance, created, **kwargs):
             select_task_code.save()
         except Exception as e:
             LOGGER.info(f"-- An error occurred while sync data with select task code -- {e}")
+
+
+@receiver(post_save, sender=AssignedProduct)
+def refresh_task_mapping_rollup(sender, instance, created, **kwargs):
+    """
+    Refresh the rollup of the task mapping when an assigned product is created or updated.
+
+    Args:
+        sender: The model class that sent the signal (AssignedProduct).
+        instance: The actual instance of AssignedProduct that was saved.
+        created: Boolean indicating if a new record was created.
+        **kwargs: Additional keyword arguments..
+    """
+    TaskMappingRollup.refresh(instance.task_mapping_id)
+
+
+@receiver(post_delete, sender=AssignedProduct)
+def refresh_task_mapping_rollup_on_delete(sender, instance, **kwargs):
+    """
+    Refresh the rollup of the task mapping when an assigned product is deleted.
+
+    NOTE: Only an existing rollup is updated, the task mapping itself may be deleted in the same cascade.
+
+    Args:
+        sender: The model class that sent the signal (AssignedProduct).
+        instance: The actual instance of AssignedProduct that was deleted.
+        **kwargs: Additional keyword arguments..
+    """
+    TaskMappingRollup.refresh(instance.task_mapping_id, create=False)
+
+
+@receiver(post_save, sender=Opportunity)
+def bump_opportunity_estimate_revision(sender, instance, created, **kwargs):
+    """
+    Bump the estimate revision of an opportunity when its tax rate changed.
+
+    Args:
+        sender: The model class that sent the signal (Opportunity).
+        instance: The actual instance of Opportunity that was saved.
+        created: Boolean indicating if a new record was created.
+        **kwargs: Additional keyword arguments..
+    """
+    if not created and instance.tax_rate != getattr(instance, "_loaded_tax_rate", instance.tax_rate):
+        bump_revision(pk=instance.pk)
+    instance._loaded_tax_rate = instance.tax_rate
+
+
+@receiver(post_save, sender=TaskMapping)
+@receiver(post_delete, sender=TaskMapping)
+@receiver(post_save, sender=ProposalCreation)
+@receiver(post_delete, sender=ProposalCreation)
+@receiver(post_save, sender=Invoice)
+@receiver(post_delete, sender=Invoice)
+def bump_estimate_revision(sender, instance, **kwargs):
+    """
+    Bump the estimate revision of the opportunity of a saved or deleted task mapping, proposal or invoice.
+
+    Args:
+        sender: The model class that sent the signal (TaskMapping, ProposalCreation or Invoice).
+        instance: The actual instance that was saved or deleted.
+        **kwargs: Additional keyword arguments..
+    """
+    bump_revision(pk=instance.opportunity_id)
+
+
+@receiver(post_save, sender=AssignedProduct)
+@receiver(post_delete, sender=AssignedProduct)
+def bump_assigned_product_estimate_revision(sender, instance, **kwargs):
+    """
+    Bump the estimate revision of the opportunity of a saved or deleted assigned product.
+
+    Args:
+        sender: The model class that sent the signal (AssignedProduct).
+        instance: The actual instance of AssignedProduct that was saved or deleted.
+        **kwargs: Additional keyword arguments..
+    """
+    bump_revision(task_mapping_opportunity__id=instance.task_mapping_id)
@@ -1,14 +1,39 @@
-import os
 from datetime import datetime
 from decimal import Decimal
 
-import pandas as pd
+from celery import shared_task
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.db import transaction
 
 from apps.constants import LOGGER
-from apps.proposal.opportunity.views.task_mapping import TaskMappingData
-
-from .models import Opportunity
+from apps.proposal.opportunity.views.proposal_creation import TaskMappingTable
+from apps.spreadsheet import SpreadsheetError, SpreadsheetReader
+from apps.upsert import bulk_upsert, format_upsert_result
+
+from .models import Invoice, Opportunity
+
+# Opportunity fields set by the import, `internal_id` (the primary key) identifies the opportunity
+OPPORTUNITY_IMPORT_FIELDS = [
+    "document_number",
+    "sales_rep",
+    "location",
+    "opportunity_class",
+    "title",
+    "ranch_address",
+    "opportunity_status",
+    "projected_total",
+    "expected_margin",
+    "margin_amount",
+    "win_probability",
+    "expected_close",
+    "opportunity_notes",
+    "scope",
+    "designer",
+    "estimator",
+    "pump_electrical_designer",
+    "design_estimation_note",
+]
 
 
 def import_opportunity_from_xlsx(file: InMemoryUploadedFile) -> dict:
@@ -16,11 +41,10 @@ def import_opportunity_from_xlsx(file: InMemoryUploadedFile) -> dict:
     Imports opportunity data from an Excel or CSV file.
 
     :prams file (File): The uploaded file containing product data.
-    :return: A context dictionary with messages about created/updated products
-            or errors if the columns do not match or records are skipped.
+    :return: A context dictionary with the created/updated/unchanged opportunity counts, or an error if the
+            columns do not match or a record can't be saved.
     """
 
-    file_extension = os.path.splitext(file.name)[1]
     context = {"messages": []}
     skip_opportunity = []
 
@@ -51,61 +75,29 @@ def import_opportunity_from_xlsx(file: InMemoryUploadedFile) -> dict:
     ]
 
     try:
-        if file_extension == ".csv":
-            df = pd.read_csv(file)
-        elif file_extension == ".xlsx" or file_extension == ".xls":
-            excel_file = pd.ExcelFile(file)
-            if len(excel_file.sheet_names) > 1:
-                return {"error": "The file with multiple sheets won't be processed"}
-
-            df = pd.read_excel(excel_file, sheet_name=0)
-        else:
-            return {"error": "Unsupported file format."}
-    except ImportError as e:
-        return {"error": f"Failed to process the file: {e}. Please ensure all dependencies are installed."}
-    except pd.errors.EmptyDataError:
-        return {"error": "You are trying to upload an empty file therefore it won't be processed."}
+        reader = SpreadsheetReader(file)
+    except SpreadsheetError as e:
+        return {"error": str(e)}
 
-    if df.empty:
-        return {"error": "You are trying to upload an empty file therefore it won't be processed."}
+    if reader.sheet_count > 1:
+        return {"error": "The file with multiple sheets won't be processed"}
 
-    df = df.fillna("")
-    opportunity_list = df.to_dict(orient="records")
-    keys = opportunity_list[0].keys()
+    if reader.empty:
+        return {"error": "You are trying to upload an empty file therefore it won't be processed."}
 
-    keys_list = sorted(keys)
-    columns_list_sorted = sorted(columns_list)
+    if sorted(reader.columns) == sorted(columns_list):
 
-    if keys_list == columns_list_sorted:
-        for record in opportunity_list:
-            try:
+        def opportunities():
+            for record in reader:
                 internal_id = record["Internal Id"]
-                sales_rep = record["Sales Rep"]
-                record["Customer"]
-                location = record["Location"]
-                opportunity_class = record["Class"]
                 document_number = record["Document Number"]
-                title = record["Title"]
-                ranch_address = record["Ranch Address"]
-                opportunity_status = record["Opportunity Status"]
-                projected_total = record["Projected Total"]
-                expected_margin = record["Expected Margin"]
-                margin_amount = record["Margin Amount"]
-                win_probability = record["Win Probability"]
                 expected_close = record.get("Expected Close")
                 if isinstance(expected_close, str):
                     try:
                         expected_close = datetime.strptime(expected_close, "%Y-%m-%d").strftime("%Y-%m-%d")
                     except ValueError:
-                        expected_close = ""
-                        return {"error": "Please ensure all dates are in the format YYYY-MM-DD."}
-
-                opportunity_notes = record["Opportunity Notes"]
-                scope = record["Scope"]
-                designer = record["Designer"]
-                estimator = record["Estimator"]
-                pump_electrical_designer = record["Pump & Electrical Designer"]
-                design_estimation_note = record["Design/Estimation Note"]
+                        # The whole import is rejected
+                        raise SpreadsheetError("Please ensure all dates are in the format YYYY-MM-DD.")
 
                 # Check if all required fields are present
                 if not internal_id:
@@ -113,44 +105,54 @@ def import_opportunity_from_xlsx(file: InMemoryUploadedFile) -> dict:
                     skip_opportunity.append(record)
                     continue
 
-                opportunity, created = Opportunity.objects.update_or_create(
-                    document_number=document_number,
-                    defaults={
-                        "internal_id": internal_id,
-                        "sales_rep": sales_rep,
-                        "location": location,
-                        "opportunity_class": opportunity_class,
-                        "title": title,
-                        "ranch_address": ranch_address,
-                        "opportunity_status": opportunity_status,
-                        "projected_total": projected_total,
-                        "expected_margin": expected_margin,
-                        "margin_amount": margin_amount,
-                        "win_probability": win_probability,
-                        "expected_close": expected_close,
-                        "opportunity_notes": opportunity_notes,
-                        "scope": scope,
-                        "designer": designer,
-                        "estimator": estimator,
-                        "pump_electrical_designer": pump_electrical_designer,
-                        "design_estimation_note": design_estimation_note,
-                    },
+                yield {
+                    "internal_id": internal_id,
+                    "document_number": document_number,
+                    "sales_rep": record["Sales Rep"],
+                    "location": record["Location"],
+                    "opportunity_class": record["Class"],
+                    "title": record["Title"],
+                    "ranch_address": record["Ranch Address"],
+                    "opportunity_status": record["Opportunity Status"],
+                    "projected_total": record["Projected Total"],
+                    "expected_margin": record["Expected Margin"],
+                    "margin_amount": record["Margin Amount"],
+                    "win_probability": record["Win Probability"],
+                    "expected_close": expected_close,
+                    "opportunity_notes": record["Opportunity Notes"],
+                    "scope": record["Scope"],
+                    "designer": record["Designer"],
+                    "estimator": record["Estimator"],
+                    "pump_electrical_designer": record["Pump & Electrical Designer"],
+                    "design_estimation_note": record["Design/Estimation Note"],
+                }
+
+        with transaction.atomic():
+            try:
+                result = bulk_upsert(
+                    Opportunity,
+                    opportunities(),
+                    "internal_id",
+                    OPPORTUNITY_IMPORT_FIELDS,
+                    row_number=lambda: reader.row_number,
                 )
+            except SpreadsheetError as e:
+                transaction.set_rollback(True)
+                return {"error": str(e)}
 
-                if created:
-                    LOGGER.info(f"Created new Opportunity: {document_number}")
-                    context["messages"].append(f"Created new Opportunity: {document_number}")
-                else:
-                    LOGGER.info(f"Updated existing Opportunity: {document_number}")
-                    context["messages"].append(f"Updated existing Opportunity: {document_number}")
+            # The upsert sends no `post_save`, create the invoices `generate_invoice_details` would have
+            Invoice.create_missing(result["added"])
 
-            except Exception as e:
-                LOGGER.error(f"Error processing record: {e}")
-                skip_opportunity.append(record)
-                return {"error": e}
+        if result["errors"]:
+            row, column, error = result["errors"][0]
+            LOGGER.error(f"Error processing opportunity on row {row} ({column}): {error}")
+            return {"error": f"Error processing opportunity on row {row} ({column}): {error}"}
 
-            if skip_opportunity:
-                LOGGER.info(f"Skipped records: {skip_opportunity}")
+        LOGGER.info(f"Imported opportunities: {format_upsert_result(result)}")
+        context.update(created=result["created"], updated=result["updated"], unchanged=result["unchanged"])
+
+        if skip_opportunity:
+            LOGGER.info(f"Skipped records: {skip_opportunity}")
 
         return context
 
@@ -160,22 +162,40 @@ def import_opportunity_from_xlsx(file: InMemoryUploadedFile) -> dict:
 
 def generate_task_mapping_table(opportunity):
     """Generate Task Mapping table"""
-    total_tasks = TaskMappingData._get_total_tasks(opportunity.document_number)
-    task_mapping_list = TaskMappingData._get_tasks(opportunity.document_number)
-    task_mapping_labor_list = TaskMappingData._get_labour_tasks(opportunity.document_number)
-    grand_total = TaskMappingData._get_task_total(opportunity.document_number)
-    labor_task_total = TaskMappingData._get_labor_task_total(opportunity.document_number)
-
-    data = {
-        "total_tasks": total_tasks,
-        "task_mapping_list": task_mapping_list,
-        "task_mapping_labor_list": task_mapping_labor_list,
-        "grand_total": grand_total,
-        "labor_task_total": labor_task_total,
-        "opportunity": opportunity,
-    }
+    return TaskMappingTable.generate_table(opportunity)
 
-    return data
+
+@shared_task(bind=True)
+def process_cad_file(self, file_name: str, document_number: str) -> dict:
+    """
+    Generate the Material List, Glue & Additional Material List and Preliminary Material List of an opportunity
+    from a CAD file.
+
+    NOTE: The job state is "PROGRESS" while it runs, with the current `step` and `progress` percentage in its meta.
+
+    :param file_name: Name of the uploaded CAD file in the default storage, it is deleted once processed.
+    :param document_number: Document number for the associated opportunity.
+    :return: A dictionary with the success message, the `mains_manifold` glue rows and the `flex_risers` rows.
+    """
+    from apps.proposal.opportunity.views.upload_cad_file import UploadCADFile
+
+    def on_progress(step: str, progress: int):
+        if not self.request.is_eager:
+            self.update_state(state="PROGRESS", meta={"step": step, "progress": progress})
+
+    try:
+        with default_storage.open(file_name, "rb") as uploaded_file:
+            summary = UploadCADFile().process_cad_file(uploaded_file, document_number, on_progress=on_progress)
+    except Exception as e:
+        LOGGER.error(f"[process_cad_file] {document_number}: {e}")
+        raise
+    finally:
+        default_storage.delete(file_name)
+
+    return {
+        "message": "Generated Material list, Glue & Additional Material List and Preliminary Material List successfully",
+        **summary,
+    }
 
 
 def format_number(number: Decimal) -> str:
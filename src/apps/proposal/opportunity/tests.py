@@ -1 +1,908 @@
-# Create your tests here.
+import datetime
+import json
+import re
+from decimal import Decimal
+from random import Random
+import tempfile
+import tracemalloc
+from pathlib import Path
+from unittest import mock, skipUnless
+
+import openpyxl
+import pandas as pd
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, connection
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from kombu.exceptions import OperationalError
+
+from apps.constants import ERROR_RESPONSE
+from apps.proposal.opportunity import tasks
+from apps.proposal.opportunity.assignment import assign_products
+from apps.proposal.opportunity.bulk_edit import bulk_edit_assigned_products
+from apps.proposal.opportunity.estimate import EstimateEngine, compute_figures, round_half_up, to_decimal
+from apps.proposal.opportunity.estimate_cache import bump_revision, get_or_compute, get_revision
+from apps.proposal.opportunity.models import (
+    AssignedProduct,
+    Invoice,
+    MaterialList,
+    Opportunity,
+    PreliminaryMaterialList,
+    ProposalCreation,
+    TaskMapping,
+    TaskMappingRollup,
+)
+from apps.proposal.opportunity.tasks import import_opportunity_from_xlsx
+from apps.proposal.opportunity.views.proposal_creation import TaskMappingData
+from apps.proposal.opportunity.views.upload_cad_file import JOINTS_PER_PINT, UploadCADFile
+from apps.proposal.product.tests import create_product, explain
+from apps.proposal.task.models import Task
+from laurel.celery import app as celery_app
+
+# Example bid workbooks and the figures of their bid items, read from the workbooks into `ESTIMATE_EXAMPLES_FILE`
+EXAMPLE_BIDS = sorted((settings.BASE_DIR / "example_bids").glob("Example [1-5]*.xlsx"))
+ESTIMATE_EXAMPLES_FILE = Path(__file__).parent / "testdata" / "estimate_examples.json"
+
+# Figures of the bid items of the example bids, as computed by the workbooks, see `read_example_bid`: the labor
+# and material cost and sale price (the material one with the sales tax), and the step of the `CEILING` of the
+# sale prices
+EXAMPLE_FIGURES = ("labor_cost", "labor_sell", "mat_cost", "mat_sell", "rounding")
+CEILING_PATTERN = re.compile(r"=CEILING\(I\d+/\(1-H\d+\),(?P<step>[\d.]+)\)")
+
+
+def create_opportunity(document_number: str = "DOC-1", **fields) -> Opportunity:
+    """Create an opportunity with the required fields filled."""
+    defaults = {
+        "internal_id": 1,
+        "sales_rep": "Sales Rep",
+        "location": "Location",
+        "opportunity_class": "Class",
+        "title": "Title",
+        "opportunity_status": "Open",
+        "projected_total": "0",
+        "expected_margin": 0.0,
+        "margin_amount": "0",
+        "expected_close": datetime.date(2025, 1, 1),
+    }
+    defaults.update(fields)
+    return Opportunity.objects.create(document_number=document_number, **defaults)
+
+
+class EstimateRevisionTests(TestCase):
+    """Revision of the estimate cache, see `apps.proposal.opportunity.estimate_cache`."""
+
+    def setUp(self):
+        cache.clear()
+        self.opportunity = create_opportunity()
+
+    def test_save_keeps_revision(self):
+        stale = Opportunity.objects.get(pk=self.opportunity.pk)
+        bump_revision(pk=self.opportunity.pk)
+        revision = get_revision("DOC-1")
+
+        stale.title = "New Title"
+        stale.save()
+        self.assertIsInstance(stale.estimate_revision, int)
+
+        self.opportunity.refresh_from_db()
+        self.assertEqual(self.opportunity.title, "New Title")
+        # Not reverted to the revision loaded with the stale instance
+        self.assertGreaterEqual(self.opportunity.estimate_revision, revision)
+        self.assertGreater(revision, stale.estimate_revision)
+
+    def test_save_semantics(self):
+        def update_sql(**kwargs) -> str:
+            with CaptureQueriesContext(connection) as context:
+                self.opportunity.save(**kwargs)
+            return next(query["sql"] for query in context.captured_queries if query["sql"].startswith("UPDATE"))
+
+        self.assertNotIn('"sales_rep"', update_sql(update_fields=["title"]))
+        self.assertIn('"sales_rep"', update_sql())
+        self.assertNotIn('"estimate_revision"', update_sql())
+
+        # Without update_fields, a save of a deleted row inserts it again like any model
+        Opportunity.objects.filter(pk=self.opportunity.pk).delete()
+        self.opportunity.save()
+        self.assertTrue(Opportunity.objects.filter(pk=self.opportunity.pk).exists())
+
+    def test_bump_is_read_from_database(self):
+        self.assertEqual(get_or_compute("data", "DOC-1", lambda: "first"), "first")
+        self.assertEqual(get_or_compute("data", "DOC-1", lambda: "second"), "first")
+
+        # A bump by another process, which doesn't touch the cache of this one
+        Opportunity.objects.filter(pk=self.opportunity.pk).update(estimate_revision=5)
+        self.assertEqual(get_revision("DOC-1"), 5)
+        self.assertEqual(get_or_compute("data", "DOC-1", lambda: "second"), "second")
+
+    def test_unknown_opportunity(self):
+        self.assertIsNone(get_revision("UNKNOWN"))
+        self.assertEqual(get_or_compute("data", "UNKNOWN", lambda: "computed"), "computed")
+
+
+def count_queries(function) -> int:
+    """Run a function and return the number of database queries it made."""
+    with CaptureQueriesContext(connection) as context:
+        function()
+    return len(context)
+
+
+def read_example_bid(path: Path) -> tuple:
+    """
+    Read an example bid workbook from its "Bid Schedule" sheet: the project tax rate, the labor and material cost
+    and margin of every bid item, and the `EXAMPLE_FIGURES` the workbook computed for them.
+
+    :param path: Path of the workbook.
+    :return: A tuple of a dictionary of `compute_figures` arguments (the numbers as `Decimal`, the margins as
+        percentages of the sale price) and of the list of the figures of every bid item.
+    """
+    sheet = openpyxl.load_workbook(path, data_only=True, read_only=True)["Bid Schedule"]
+    formulas = openpyxl.load_workbook(path, read_only=True)["Bid Schedule"]
+    inputs = {"labor_cost": [], "mat_cost": [], "labor_gp_percent": [], "mat_gp_percent": [], "tax_rate": None}
+    labor, materials = [], []
+    items = False
+    for row, formula_row in zip(
+        sheet.iter_rows(min_col=2, max_col=10, values_only=True),
+        formulas.iter_rows(min_col=2, max_col=10, values_only=True),
+    ):
+        description, total, margin, cost = row[1], row[5], row[6], row[7]
+        if margin == "Project Tax Rate" and isinstance(row[5], (int, float)):
+            inputs["tax_rate"] = to_decimal(row[5]) * 100
+        elif description == "BID SCHEDULE ITEMS":
+            items = True
+        elif items and description == "Labor":
+            inputs["labor_cost"].append(to_decimal(cost or 0))
+            inputs["labor_gp_percent"].append(to_decimal(margin) * 100)
+            labor.append([row[8] or 0, total or 0])
+        elif items and description == "Materials":
+            inputs["mat_cost"].append(to_decimal(cost or 0))
+            inputs["mat_gp_percent"].append(to_decimal(margin) * 100)
+            step = float(CEILING_PATTERN.fullmatch(formula_row[4])["step"])
+            materials.append([row[8] or 0, total or 0, int(step) if step.is_integer() else step])
+    return inputs, [labor_figures + material_figures for labor_figures, material_figures in zip(labor, materials)]
+
+
+def markup_percent(margin_percent: Decimal) -> Decimal:
+    """Convert a margin on the sale price to the GP percentage on the cost that gives the same sale price."""
+    return margin_percent / (100 - margin_percent) * 100
+
+
+class EstimateExampleTests(SimpleTestCase):
+    """
+    Figures of the estimate engine for the costs, margins and tax rates of the example bid workbooks.
+
+    The expected figures are the ones computed by the workbooks, pinned in `testdata/estimate_examples.json`.
+
+    NOTE: Deliberate differences with the workbooks:
+        - The workbooks price with a margin on the sale price (`CEILING(cost / (1 - margin), 1)`), the engine with
+          a GP percentage on the cost, so the margins are converted with `markup_percent`.
+        - The workbooks round the sale prices up to a step (`CEILING`, $1 to $100), the engine rounds the labor
+          sell half up to cents and the material plus markup half up to whole dollars.
+        - The workbooks don't round the sales tax, the engine rounds it half up to cents.
+    """
+
+    def test_workbook_figures(self):
+        self.assertTrue(EXAMPLE_BIDS)
+        expected = json.loads(ESTIMATE_EXAMPLES_FILE.read_text())
+        self.assertEqual(sorted(expected), [path.name for path in EXAMPLE_BIDS])
+        for path in EXAMPLE_BIDS:
+            with self.subTest(example=path.name):
+                self.assertEqual(read_example_bid(path)[1], expected[path.name])
+
+    def test_example_bids(self):
+        expected = json.loads(ESTIMATE_EXAMPLES_FILE.read_text())
+        for path in EXAMPLE_BIDS:
+            inputs = read_example_bid(path)[0]
+            inputs["labor_gp_percent"] = [markup_percent(percent) for percent in inputs["labor_gp_percent"]]
+            inputs["mat_gp_percent"] = [markup_percent(percent) for percent in inputs["mat_gp_percent"]]
+            figures = compute_figures(**inputs)
+            tax = 1 + (inputs["tax_rate"] or Decimal(0)) / 100
+
+            for index, workbook in enumerate(expected[path.name]):
+                with self.subTest(example=path.name, item=index + 1):
+                    labor_cost, labor_sell, mat_cost, mat_sell, step = (to_decimal(value) * 100 for value in workbook)
+                    self.assertEqual(figures["labor_cost"][index], round_half_up(labor_cost))
+                    self.assertEqual(figures["mat_cost"][index], round_half_up(mat_cost))
+                    # Rounded up to the step by the workbook, to cents by the engine
+                    self.assertTrue(0 <= labor_sell - figures["labor_sell"][index] < step)
+                    # Rounded up to the step by the workbook, half up to dollars by the engine, then taxed
+                    difference = mat_sell - figures["mat_sell"][index]
+                    self.assertTrue(-50 * tax - 1 < difference < step * tax + 1)
+
+    def test_rounding(self):
+        figures = compute_figures(
+            labor_cost=[10.05, 0.0],
+            mat_cost=[68.505, 1.0],
+            labor_gp_percent=[50.0, None],
+            mat_gp_percent=[10.0, 0.0],
+            tax_rate=7.25,
+        )
+        # Halves rounded away from zero on the decimal values, the float 68.505 is 68.50499999999999...
+        self.assertEqual(figures["labor_gp"].tolist(), [503, 0])
+        self.assertEqual(figures["mat_cost"].tolist(), [6851, 100])
+        self.assertEqual(figures["mat_plus_mu"].tolist(), [7500, 100])
+        self.assertEqual(figures["sales_tax"].tolist(), [544, 7])
+        self.assertEqual(figures["comb_gp"].tolist(), [121.59, 107.0])
+
+
+class EstimateEngineTests(TestCase):
+    """Figures of the task mappings of an opportunity, see `apps.proposal.opportunity.estimate.EstimateEngine`."""
+
+    def test_product_costs_are_decimal(self):
+        opportunity = create_opportunity(tax_rate="7.25%")
+        task_mapping = TaskMapping.objects.create(opportunity=opportunity, code="MAT", mat_gp_percent=0.0)
+        # 3 * 22.835 is 68.50499999999999 as floats
+        AssignedProduct.objects.create(task_mapping=task_mapping, quantity=3, standard_cost=22.835)
+        AssignedProduct.objects.create(task_mapping=task_mapping, quantity=2, standard_cost=1.0, vendor_quoted_cost=0)
+
+        figures = EstimateEngine.for_opportunity(opportunity.pk).figures[task_mapping.id]
+        self.assertEqual(figures["mat_cost"], 70.51)
+        self.assertEqual(figures["mat_plus_mu"], 71)
+        self.assertEqual(figures["sales_tax"], 5.15)
+
+
+class TaskMappingRollupTests(TestCase):
+    """Rollups of the products of the task mappings, see `apps.proposal.opportunity.models.TaskMappingRollup`."""
+
+    def create_task_mappings(self, opportunity: Opportunity, count: int) -> list:
+        """Create task mappings with two products each, and delete their rollups."""
+        task_mappings = []
+        for index in range(count):
+            task_mapping = TaskMapping.objects.create(opportunity=opportunity, code=f"TASK-{index}")
+            AssignedProduct.objects.create(task_mapping=task_mapping, quantity=2, standard_cost=1.5)
+            AssignedProduct.objects.create(
+                task_mapping=task_mapping, quantity=1, standard_cost=1.5, vendor_quoted_cost=4
+            )
+            task_mappings.append(task_mapping)
+        TaskMappingRollup.objects.filter(task_mapping__in=task_mappings).delete()
+        return task_mappings
+
+    def test_ensure(self):
+        opportunity = create_opportunity()
+        task_mappings = self.create_task_mappings(opportunity, 2)
+        product_less = TaskMapping.objects.create(opportunity=opportunity, code="EMPTY")
+
+        TaskMappingRollup.ensure(TaskMapping.objects.filter(opportunity=opportunity))
+
+        rollup = TaskMappingRollup.objects.get(task_mapping=task_mappings[0])
+        self.assertEqual((rollup.product_count, rollup.total_quantity, rollup.total_price), (2, 3.0, 7.0))
+        self.assertEqual(TaskMappingRollup.calculate(task_mappings[1].id)["total_unit_price"], 5.5)
+        self.assertEqual(TaskMappingRollup.objects.get(task_mapping=product_less).product_count, 0)
+
+    def test_ensure_query_count(self):
+        opportunity = create_opportunity("DOC-1", internal_id=1)
+        self.create_task_mappings(opportunity, 1)
+        queries = count_queries(lambda: TaskMappingRollup.ensure(TaskMapping.objects.filter(opportunity=opportunity)))
+
+        opportunity = create_opportunity("DOC-10", internal_id=10)
+        self.create_task_mappings(opportunity, 10)
+        with self.assertNumQueries(queries):
+            TaskMappingRollup.ensure(TaskMapping.objects.filter(opportunity=opportunity))
+        self.assertEqual(TaskMappingRollup.objects.filter(task_mapping__opportunity=opportunity).count(), 10)
+
+    def test_refresh_locks_task_mapping(self):
+        task_mapping = self.create_task_mappings(create_opportunity(), 1)[0]
+
+        select_for_update = QuerySet.select_for_update
+        with mock.patch.object(QuerySet, "select_for_update", autospec=True, side_effect=select_for_update) as lock:
+            with CaptureQueriesContext(connection) as context:
+                TaskMappingRollup.refresh(task_mapping.id)
+
+        # The task mapping is locked first, then the rollup by update_or_create
+        self.assertEqual(lock.call_args_list[0].args[0].model, TaskMapping)
+        if connection.features.has_select_for_update:
+            locks = [query["sql"] for query in context.captured_queries if "FOR UPDATE" in query["sql"]]
+            self.assertIn(TaskMapping._meta.db_table, locks[0])
+        rollup = TaskMappingRollup.objects.get(task_mapping=task_mapping)
+        self.assertEqual((rollup.product_count, rollup.total_quantity, rollup.total_price), (2, 3.0, 7.0))
+
+
+class AssignProductsTests(TestCase):
+    """Bulk assignment of preliminary materials to a task, see `apps.proposal.opportunity.assignment`."""
+
+    def setUp(self):
+        self.opportunity = create_opportunity()
+        self.task_mapping = TaskMapping.objects.create(opportunity=self.opportunity, code="TASK")
+        create_product(1, display_name="p-1", std_cost="1.50")
+
+    def create_materials(self, *materials):
+        """Create preliminary materials of the opportunity from `(item number, combined quantity)` pairs."""
+        PreliminaryMaterialList.objects.bulk_create(
+            PreliminaryMaterialList(
+                opportunity=self.opportunity,
+                item_number=item_number,
+                combined_quantities_from_both_import=quantity,
+                description=f"Material {item_number}",
+                category="",
+            )
+            for item_number, quantity in materials
+        )
+
+    def test_assign(self):
+        self.create_materials(("P-1", "2"), ("P-2", "3.5"))
+        revision = get_revision("DOC-1")
+
+        result = assign_products(self.task_mapping, ["P-1", "P-2"])
+
+        self.assertEqual(len(result["created"]), 2)
+        self.assertEqual(result["errors"], [])
+        self.assertEqual(
+            sorted(self.task_mapping.assigned_products.values_list("item_code", "quantity", "standard_cost")),
+            [("P-1", 2.0, 1.5), ("P-2", 3.5, 0.0)],
+        )
+        rollup = TaskMappingRollup.objects.get(task_mapping=self.task_mapping)
+        self.assertEqual((rollup.product_count, rollup.total_quantity, rollup.total_price), (2, 5.5, 3.0))
+        self.assertEqual(get_revision("DOC-1"), revision + 1)
+
+    def test_errors(self):
+        self.create_materials(("P-1", "2"), ("BAD", "many"), ("DUP", "1"), ("DUP", "1"))
+
+        result = assign_products(self.task_mapping, ["UNKNOWN", "BAD", "DUP", "P-1"])
+
+        self.assertEqual(
+            result["errors"],
+            [
+                {"internal_id": "UNKNOWN", "error": "Product not found"},
+                {"internal_id": "BAD", "error": "Invalid quantity"},
+                {"internal_id": "DUP", "error": ERROR_RESPONSE["message"]},
+            ],
+        )
+        # The valid items are assigned anyway
+        self.assertEqual(list(self.task_mapping.assigned_products.values_list("item_code", flat=True)), ["P-1"])
+        self.assertEqual(TaskMappingRollup.objects.get(task_mapping=self.task_mapping).product_count, 1)
+
+    def test_query_count(self):
+        self.create_materials(*((f"P-{index}", "1") for index in range(20)))
+        queries = count_queries(lambda: assign_products(self.task_mapping, ["P-0", "P-1"]))
+
+        task_mapping = TaskMapping.objects.create(opportunity=self.opportunity, code="OTHER")
+        with self.assertNumQueries(queries):
+            assign_products(task_mapping, [f"P-{index}" for index in range(20)])
+        self.assertEqual(TaskMappingRollup.objects.get(task_mapping=task_mapping).product_count, 20)
+
+
+class BulkEditTests(TestCase):
+    """Bulk edition of assigned products, see `apps.proposal.opportunity.bulk_edit`."""
+
+    FIELDS = ("quantity", "vendor_quoted_cost", "comment")
+
+    def setUp(self):
+        self.opportunity = create_opportunity()
+        self.task_mapping = TaskMapping.objects.create(opportunity=self.opportunity, code="TASK")
+        self.products = [
+            AssignedProduct.objects.create(task_mapping=self.task_mapping, quantity=1, standard_cost=2.0)
+            for _ in range(20)
+        ]
+
+    def test_edit(self):
+        revision = get_revision("DOC-1")
+
+        result = bulk_edit_assigned_products(
+            [
+                {"id": str(self.products[0].id), "quantity": "4"},
+                {"id": str(self.products[1].id), "vendor_quoted_cost": "3", "comment": "Quoted"},
+                {"id": "", "quantity": "5"},
+            ],
+            self.FIELDS,
+        )
+
+        self.assertEqual(result["updated"], [self.products[0].id, self.products[1].id])
+        self.assertEqual(result["errors"], [])
+        # 18 products of 1 x 2.0, 4 x 2.0 and 1 x 3.0
+        self.assertEqual(result["totals"][self.task_mapping.id]["total_price"], 47.0)
+        self.assertEqual(TaskMappingRollup.objects.get(task_mapping=self.task_mapping).total_quantity, 23.0)
+        self.assertEqual(AssignedProduct.objects.get(id=self.products[1].id).comment, "Quoted")
+        self.assertEqual(get_revision("DOC-1"), revision + 1)
+
+    def test_errors(self):
+        revision = get_revision("DOC-1")
+
+        result = bulk_edit_assigned_products(
+            [
+                {"id": "999999", "quantity": "4"},
+                {"id": "abc", "quantity": "4"},
+                {"id": str(self.products[0].id), "quantity": "four"},
+                {"id": str(self.products[1].id), "quantity": "6"},
+            ],
+            self.FIELDS,
+        )
+
+        self.assertEqual(result["updated"], [])
+        self.assertEqual(
+            [(error["id"], error["field"]) for error in result["errors"]],
+            [("abc", "id"), (self.products[0].id, "quantity"), (999999, "id")],
+        )
+        self.assertEqual(result["errors"][2]["error"], "Product not found")
+        # Nothing is written when a row is invalid
+        self.assertEqual(AssignedProduct.objects.get(id=self.products[1].id).quantity, 1)
+        self.assertEqual(TaskMappingRollup.objects.get(task_mapping=self.task_mapping).total_quantity, 20.0)
+        self.assertEqual(get_revision("DOC-1"), revision)
+
+    def test_query_count(self):
+        def edit(products: list):
+            bulk_edit_assigned_products([{"id": str(product.id), "quantity": "2"} for product in products], self.FIELDS)
+
+        queries = count_queries(lambda: edit(self.products[:2]))
+        with self.assertNumQueries(queries):
+            edit(self.products)
+        self.assertEqual(TaskMappingRollup.objects.get(task_mapping=self.task_mapping).total_quantity, 40.0)
+
+
+class OpportunityQueryCountTests(TestCase):
+    """The task mapping and proposal pages make the same number of queries whatever the number of tasks."""
+
+    def setUp(self):
+        self.client.force_login(get_user_model().objects.create(email="estimator@example.com"))
+
+    def create_opportunity(self, task_count: int) -> Opportunity:
+        """Create an opportunity with product, labor and empty tasks, all in a proposal group."""
+        opportunity = create_opportunity(f"DOC-{task_count}", internal_id=task_count)
+        for index in range(task_count):
+            description = ("Mainline", "Labor for mainline", "Valves")[index % 3]
+            task = Task.objects.create(
+                internal_id=task_count * 100 + index, name=f"{task_count}-{index}", description=description
+            )
+            task_mapping = TaskMapping.objects.create(opportunity=opportunity, task=task, code=task.name)
+            if index % 3 != 2:
+                AssignedProduct.objects.create(task_mapping=task_mapping, quantity=2, standard_cost=1.5, is_select=True)
+            ProposalCreation.objects.create(
+                opportunity=opportunity, group_name=f"Group {index % 2}", task_mapping=task_mapping
+            )
+        TaskMappingRollup.ensure(opportunity.task_mapping_opportunity.all())
+        return opportunity
+
+    def assertConstantQueries(self, url_name: str):
+        """Assert the page of an opportunity with 12 tasks makes as many queries as with 1 task, uncached."""
+        url = reverse(url_name, args=[self.create_opportunity(1).document_number])
+        cache.clear()
+        queries = count_queries(lambda: self.assertEqual(self.client.get(url).status_code, 200))
+
+        url = reverse(url_name, args=[self.create_opportunity(12).document_number])
+        cache.clear()
+        with self.assertNumQueries(queries):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_opportunity_detail(self):
+        self.assertConstantQueries("proposal_app:opportunity:opportunity-detail")
+
+    def test_proposal_table(self):
+        self.assertConstantQueries("proposal_app:opportunity:render-proposal-table")
+
+    def test_task_mapping_tables(self):
+        self.create_opportunity(1)
+        self.create_opportunity(12)
+        # The missing rollups are built too
+        TaskMappingRollup.objects.all().delete()
+        with self.assertNumQueries(count_queries(lambda: TaskMappingData._build_task_mapping_tables("DOC-1"))):
+            tables = TaskMappingData._build_task_mapping_tables("DOC-12")
+
+        self.assertEqual(tables["total_tasks"], 12)
+        self.assertEqual(len(tables["task_mapping_labor_list"]), 4)
+        self.assertEqual(tables["grand_total"], {"grand_total_price": 12.0, "grand_total_quantity": 8.0})
+
+
+OPPORTUNITY_COLUMNS = (
+    "Internal Id,Sales Rep,Customer,Location,Class,Document Number,Title,Ranch Address,Opportunity Status,"
+    "Projected Total,Expected Margin,Margin Amount,Win Probability,Expected Close,Opportunity Notes,Scope,Designer,"
+    "Estimator,Pump & Electrical Designer,Design/Estimation Note"
+)
+
+
+def opportunity_file(*rows: str) -> SimpleUploadedFile:
+    """Opportunity export with the given `internal id,document number,expected close` rows."""
+    lines = [OPPORTUNITY_COLUMNS]
+    for row in rows:
+        internal_id, document_number, expected_close = row.split(",")
+        lines.append(
+            f"{internal_id},Rep,,Location,Class,{document_number},Title,,Open,100,0.25,25,50,{expected_close},,,,,,"
+        )
+    return SimpleUploadedFile("opportunities.csv", "\n".join(lines).encode())
+
+
+class ImportOpportunityTests(TestCase):
+    """Import of the opportunity export, see `import_opportunity_from_xlsx`."""
+
+    def setUp(self):
+        self.client.force_login(get_user_model().objects.create(email="estimator@example.com"))
+
+    def test_invoices(self):
+        result = import_opportunity_from_xlsx(opportunity_file("1,DOC-1,2025-01-01", "2,DOC-2,2025-02-01"))
+        self.assertEqual((result["created"], result["updated"]), (2, 0))
+        self.assertEqual(sorted(Invoice.objects.values_list("opportunity_id", flat=True)), [1, 2])
+
+        # Re-importing doesn't add invoices
+        result = import_opportunity_from_xlsx(opportunity_file("1,DOC-1,2025-01-02", "3,DOC-3,2025-03-01"))
+        self.assertEqual((result["created"], result["updated"]), (1, 1))
+        self.assertEqual(sorted(Invoice.objects.values_list("opportunity_id", flat=True)), [1, 2, 3])
+
+        # The pages reading the invoice of a new opportunity
+        response = self.client.get(reverse("proposal_app:opportunity:opportunity-detail", args=["DOC-3"]))
+        self.assertEqual(response.status_code, 200)
+
+    def test_batch_fallback(self):
+        bulk_create = QuerySet.bulk_create
+        batches = []
+
+        def failing_bulk_create(queryset, objs, *args, **kwargs):
+            batches.append(len(objs))
+            if len(batches) == 1:
+                raise DatabaseError("value too long")
+            return bulk_create(queryset, objs, *args, **kwargs)
+
+        # The rows of a failed batch are written one by one, the same way and without signals
+        with mock.patch.object(QuerySet, "bulk_create", failing_bulk_create):
+            result = import_opportunity_from_xlsx(opportunity_file("1,DOC-1,2025-01-01", "2,DOC-2,2025-02-01"))
+
+        self.assertEqual(batches[:3], [2, 1, 1])
+        self.assertEqual((result["created"], result["updated"]), (2, 0))
+        self.assertEqual(sorted(Invoice.objects.values_list("opportunity_id", flat=True)), [1, 2])
+
+    def test_invalid_date(self):
+        result = import_opportunity_from_xlsx(opportunity_file("1,DOC-1,2025-01-01", "2,DOC-2,01/02/2025"))
+        self.assertEqual(result, {"error": "Please ensure all dates are in the format YYYY-MM-DD."})
+        self.assertFalse(Opportunity.objects.exists())
+        self.assertFalse(Invoice.objects.exists())
+
+
+class MaterialListTests(SimpleTestCase):
+    """Material List of a CAD file, see `UploadCADFile.generate_material_list`."""
+
+    def test_aggregate_items(self):
+        cad_file = ContentFile(
+            b'2,"PIPE 2"" SW",P-2\r\n3,"ELBOW 1""",E-1\r\nnot a row\r\n5,"PIPE 2"" SW",P-2\r\nx,CAP,C-1'
+        )
+        material_list = UploadCADFile().generate_material_list(cad_file)
+
+        self.assertEqual(material_list["Item Number"], ["P-2", "E-1", "C-1"])
+        self.assertEqual(material_list["Description"], ['PIPE 2" SW', 'ELBOW 1"', "CAP"])
+        self.assertEqual(material_list["Quantity"], [7.0, 3.0, 0.0])
+        self.assertEqual(material_list["Line Quantities"][0], {2.0: 1, 5.0: 1})
+        self.assertEqual(material_list["Last Quantities"], {"P-2": 5.0, "E-1": 3.0, "C-1": 0.0})
+
+    def test_large_file(self):
+        lines = 200_000
+        cad_file = ContentFile(
+            b"".join(
+                b'%d,"FITTING %d"" X 1""",ITEM-%d\r\n' % (index % 7, index % 50, index % 50) for index in range(lines)
+            )
+        )
+
+        tracemalloc.start()
+        try:
+            material_list = UploadCADFile().generate_material_list(cad_file)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(len(material_list["Item Number"]), 50)
+        self.assertEqual(sum(sum(counts.values()) for counts in material_list["Line Quantities"]), lines)
+        self.assertEqual(sum(material_list["Quantity"]), sum(index % 7 for index in range(lines)))
+        # Only the distinct items are kept, not the 200,000 lines of the file
+        self.assertLess(peak, cad_file.size // 5)
+
+
+def baseline_mains_manifold(df, pipe_size: float, joints_per_pint: float) -> dict:
+    """The previous `calculate_mains_manifold` of one pipe size, filtering the DataFrame once per fitting."""
+
+    def quantity(column: str, pattern: str):
+        return df[df[column].str.contains(pattern, case=False, na=False)]["Quantity"].sum()
+
+    solvent_weld_pipe_sum = df[
+        df["form1"].str.contains(f"PIPE.*{pipe_size} SW", case=False, na=False)
+        | df["form1"].str.contains(f"PIPE.*{pipe_size} BE", case=False, na=False)
+    ]["Quantity"].sum()
+    cross_joints_sum = (quantity("form4", f"CRO {pipe_size}") + quantity("CROSS", f"{pipe_size}")) * 2
+    tee_joints_sum = quantity("form4", f"TEE {pipe_size}") * 2 + quantity("Tee's", f"{pipe_size}")
+    elbow_coupler_rb_rc_joints_sum = (
+        quantity("form4", f"ELB {pipe_size}") * 2
+        + quantity("form4", f"COU {pipe_size}") * 2
+        + sum(quantity("form4", f"{fitting} {pipe_size}") for fitting in ("RED", "FLA", "CAP", "FA", "MA"))
+        + quantity("RED BUSH & COUPS", f"{pipe_size}")
+    )
+    total_joints = (solvent_weld_pipe_sum / 20) + cross_joints_sum + tee_joints_sum + elbow_coupler_rb_rc_joints_sum
+    return {
+        "Pipe Size": pipe_size,
+        "Solvent Weld Pipe": solvent_weld_pipe_sum,
+        "Cross Joints": cross_joints_sum,
+        "Tee Joints": tee_joints_sum,
+        "Elbow, Coupler, RB, RC Joints": elbow_coupler_rb_rc_joints_sum,
+        "TOTAL JOINTS": total_joints,
+        "JOINTS PER PINT": joints_per_pint,
+        "PINTS": round(total_joints / joints_per_pint, 1),
+        "Thrust Block # Conc. Bags": 0,
+    }
+
+
+# Descriptions of CAD lines whose sizes are easy to miscount: inch marks, fractions, sizes inside other sizes
+# ("2" in "24", "2.5" matching "2x5"), lower case, several fittings and blanks
+TRICKY_DESCRIPTIONS = [
+    'PIPE 2" SW',
+    'pipe class 200 2.5" be',
+    'PIPE 24" SW 12" BE',
+    "PIPE 18x7 SW",
+    'PVC PIPE 3/4" SW',
+    'PIPE\n2" SW',
+    'CROSS 2" X 2" X 1"',
+    'TEE 2-1/2" X 2" SOC',
+    'ELBOW 90 4" SOC',
+    'COUPLING 6"',
+    'REDUCER BUSHING 3" X 2"',
+    'RED BUSH 2-1/2" X 1-1/2"',
+    'FLANGE ADAPTER 8" FMA 10"',
+    'CAP 15" SOC',
+    'MALE ADAPTER 2" MPT',
+    'FEMALE ADAPTER 21" FPT',
+    'CROSS 20" SOC Tee 20"',
+    "FLEX RISER 1/2 X 12",
+    "",
+    " ",
+    '"',
+    '""',
+    "2",
+    "TEE",
+]
+
+
+def baseline_forms(row: pd.Series) -> pd.Series:
+    """The previous per-row `apply_transformations`."""
+    description = row["Description"]
+    form1 = description.replace('"', "")
+    if '"' in description:
+        quote_index = description.find('"')
+        form2 = description[:3] + description[quote_index - 2 : quote_index]
+        form3 = description[quote_index - 5 : quote_index].replace("  ", " ")
+    else:
+        form2 = description[:3]
+        form3 = description
+    if " " in form3:
+        space_index = form3.find(" ")
+        form4 = description[:3] + " " + form3[space_index + 1 : space_index + 11].strip()
+    else:
+        form4 = description[:3]
+    return pd.Series([form1, form2, form3, form4], index=["form1", "form2", "form3", "form4"])
+
+
+def baseline_additional_columns(row: pd.Series) -> pd.Series:
+    """The previous per-row `calculate_additional_columns`."""
+    description, form1, form3 = row["Description"], row["form1"], row["form3"]
+    if "TEE" in description:
+        if "X " in description:
+            start_index = description.find("X ") + 2
+            tee_value = description[start_index : start_index + 4].strip()
+        else:
+            tee_value = description.split(" ")[-1].strip()
+    else:
+        tee_value = "ERR"
+    if "RED BUSH" in description:
+        red_bush_value = description.split("X ")[-1].split("SPXS")[0].strip()
+    elif "RED COUP" in description:
+        red_bush_value = description.split("X ")[-1].strip()
+    else:
+        red_bush_value = "IFERR"
+    if "CROSS" in form1:
+        if "X " in form1:
+            start_index = form1.find("X ") + 2
+            cross_value = form1[start_index : start_index + 4].strip()
+        elif " " in form3:
+            space_index = form3.find(" ")
+            cross_value = form3[space_index + 1 : space_index + 4].strip()
+        else:
+            cross_value = "ERR"
+    else:
+        cross_value = "ERR"
+    return pd.Series(
+        [tee_value, red_bush_value, cross_value, description[:14].strip()],
+        index=["Tee's", "RED BUSH & COUPS", "CROSS", "Hose"],
+    )
+
+
+class MaterialListColumnsTests(SimpleTestCase):
+    """
+    Columns of the Material List DataFrame, see `UploadCADFile.apply_transformations` and
+    `UploadCADFile.calculate_additional_columns`.
+    """
+
+    def assertMatchesBaseline(self, descriptions: list):
+        """Assert the columns of the descriptions are the ones of the previous per-row implementation."""
+        view = UploadCADFile()
+        df = pd.DataFrame({"Quantity": 1.0, "Description": descriptions, "Item Number": "ITEM"})
+        expected = df.apply(baseline_forms, axis=1)
+        forms = view.apply_transformations(df)
+        pd.testing.assert_frame_equal(forms, expected)
+
+        df[["form1", "form2", "form3", "form4"]] = forms
+        pd.testing.assert_frame_equal(
+            view.calculate_additional_columns(df), df.apply(baseline_additional_columns, axis=1)
+        )
+
+    def test_tricky_descriptions(self):
+        self.assertMatchesBaseline(
+            TRICKY_DESCRIPTIONS
+            + [
+                'a"',
+                '"abc',
+                'ab"c',
+                'abcd"',
+                'abcde"',
+                'X "',
+                'TEE 2" X 1-1/2" SOC',
+                'TEE 2"X 1"',
+                "TEE 1/2",
+                'RED BUSH 2" X 1-1/2" SPXS',
+                'RED COUP 2" X 1"',
+                "CROSS 2 X 2",
+                'CROSS 2"',
+                "CROSS",
+                'PIPE  2"  SW',
+                'PIPE "2" X "3"',
+                'TEE\n2" X\n1"',
+                "    ",
+                "\t",
+            ]
+        )
+
+    def test_random_descriptions(self):
+        random = Random(4)
+        characters = ['"', " ", "  ", "X ", "TEE", "CROSS", "RED BUSH", "RED COUP", "SPXS", "1/2", "2", "-", "A"]
+        self.assertMatchesBaseline(
+            ["".join(random.choice(characters) for _ in range(random.randint(0, 8))) for _ in range(2000)]
+        )
+
+
+class MainsManifoldTests(SimpleTestCase):
+    """Glue of the mains & manifold, see `UploadCADFile.calculate_mains_manifold`."""
+
+    def material_list_df(self, descriptions: list, quantities: list):
+        """Build the material list DataFrame of the descriptions like `UploadCADFile.process_cad_file`."""
+        view = UploadCADFile()
+        df = pd.DataFrame(
+            {
+                "Quantity": quantities,
+                "Description": descriptions,
+                "Item Number": [f"ITEM-{index}" for index in range(len(descriptions))],
+            }
+        )
+        df[["form1", "form2", "form3", "form4"]] = view.apply_transformations(df)
+        df[["Tee's", "RED BUSH & COUPS", "CROSS", "Hose"]] = view.calculate_additional_columns(df)
+        return df
+
+    def assertMatchesBaseline(self, df):
+        """Assert the rows of every pipe size are the ones of the previous implementation."""
+        rows = UploadCADFile().calculate_mains_manifold(df, JOINTS_PER_PINT)
+
+        self.assertEqual([row["Pipe Size"] for row in rows], list(JOINTS_PER_PINT))
+        for row, (pipe_size, joints_per_pint) in zip(rows, JOINTS_PER_PINT.items()):
+            expected = baseline_mains_manifold(df, pipe_size, joints_per_pint)
+            self.assertEqual(row.keys(), expected.keys())
+            for key, value in expected.items():
+                self.assertAlmostEqual(row[key], value, places=9, msg=f"{key} of pipe size {pipe_size}")
+
+    def test_tricky_descriptions(self):
+        df = self.material_list_df(TRICKY_DESCRIPTIONS, [index + 1 for index in range(len(TRICKY_DESCRIPTIONS))])
+        self.assertMatchesBaseline(df)
+        # Not only zeros
+        self.assertGreater(sum(row["TOTAL JOINTS"] for row in UploadCADFile().calculate_mains_manifold(df, {2: 30})), 0)
+
+    def test_random_descriptions(self):
+        random = Random(5)
+        words = ["PIPE", "SW", "BE", "CROSS", "TEE", "ELBOW", "COUPLING", "RED", "BUSH", "FLANGE", "CAP", "FMA", "X"]
+        sizes = ['2"', '2-1/2"', "3/4", '18.7"', "24", "1", "10", "12", "5", "6"]
+        descriptions = [" ".join(random.choice(words + sizes) for _ in range(random.randint(0, 6))) for _ in range(500)]
+        df = self.material_list_df(descriptions, [random.choice([0, 1, 2.5, 7]) for _ in descriptions])
+        self.assertMatchesBaseline(df)
+
+
+def override_celery(**options):
+    """
+    Override `CELERY_` settings of the Celery app until the returned callback restores them.
+
+    NOTE: The Celery app reads the Django settings once, so `override_settings` doesn't reach it.
+    """
+    previous = {name: celery_app.conf[name.removeprefix("CELERY_").lower()] for name in options}
+    celery_app.conf.update(options)
+    return lambda: celery_app.conf.update(previous)
+
+
+class UploadCADFileTests(TestCase):
+    """Upload of a CAD file processed by the `process_cad_file` task, see `UploadCADFile.post`."""
+
+    def setUp(self):
+        create_opportunity()
+        self.client.force_login(get_user_model().objects.create(email="estimator@example.com"))
+
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        storage = override_settings(
+            DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage", MEDIA_ROOT=media_root.name
+        )
+        storage.enable()
+        self.addCleanup(storage.disable)
+        # No worker nor Redis server in the tests, the tasks run in process or are queued in memory
+        self.addCleanup(override_celery(CELERY_TASK_ALWAYS_EAGER=True, CELERY_BROKER_URL="memory://"))
+
+    def upload(self):
+        cad_file = SimpleUploadedFile("design.txt", b'2,"PIPE 2"" SW",P-2\r\n3,"ELBOW 1""",E-1\r\n5,"PIPE 2"" SW",P-2')
+        return self.client.post(
+            reverse("proposal_app:opportunity:upload-cad-file"), {"file": cad_file, "document_number": "DOC-1"}
+        )
+
+    def assertFileDeleted(self):
+        """Assert the stored CAD file was deleted once processed."""
+        _, file_names = default_storage.listdir("cad_files/DOC-1")
+        self.assertEqual(file_names, [])
+
+    def test_upload(self):
+        with mock.patch.object(tasks.process_cad_file, "delay", wraps=tasks.process_cad_file.delay) as delay:
+            response = self.upload()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("successfully", response.json()["message"])
+        self.assertEqual([row["Pipe Size"] for row in response.json()["mains_manifold"]], list(JOINTS_PER_PINT))
+        self.assertEqual(len(response.json()["flex_risers"]), 3)
+        # One Material List row per line, the Preliminary Material List has the quantity of the last line of an item
+        self.assertEqual(
+            sorted(MaterialList.objects.values_list("item_number", "quantity")), [("E-1", 3), ("P-2", 2), ("P-2", 5)]
+        )
+        self.assertEqual(
+            sorted(PreliminaryMaterialList.objects.values_list("item_number", "irricad_imported_quantities")),
+            [("E-1", "3.0"), ("P-2", "5.0")],
+        )
+        delay.assert_called_once()
+        file_name, document_number = delay.call_args.args
+        self.assertEqual(document_number, "DOC-1")
+        self.assertFalse(default_storage.exists(file_name))
+
+    def test_upload_without_broker(self):
+        with mock.patch.object(tasks.process_cad_file, "delay", side_effect=OperationalError("Connection refused")):
+            response = self.upload()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(MaterialList.objects.count(), 3)
+        self.assertFileDeleted()
+
+    def test_upload_failed(self):
+        MaterialList.objects.create(opportunity_id=1, quantity=1, description="Previous", item_number="X-1")
+
+        with mock.patch("apps.proposal.opportunity.views.upload_cad_file.UploadCADFile.save_material_lists") as save:
+            save.side_effect = ValueError("Invalid row")
+            response = self.upload()
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(list(MaterialList.objects.values_list("item_number", flat=True)), ["X-1"])
+        self.assertFileDeleted()
+
+    def test_status(self):
+        restore = override_celery(CELERY_TASK_ALWAYS_EAGER=False)
+        try:
+            response = self.upload()
+        finally:
+            restore()
+
+        self.assertEqual(response.status_code, 202)
+        status_url = response.json()["status_url"]
+        self.assertNotIn(response.json()["job_id"], status_url)
+        self.assertEqual(self.client.get(status_url).json()["state"], "PENDING")
+
+        # The job is only visible to the user who uploaded the file
+        job_url = reverse("proposal_app:opportunity:upload-cad-file-status", args=[response.json()["job_id"]])
+        self.assertEqual(self.client.get(job_url).status_code, 404)
+        self.client.force_login(get_user_model().objects.create(email="other@example.com"))
+        self.assertEqual(self.client.get(status_url).status_code, 404)
+
+
+@skipUnless(connection.vendor == "postgresql", "PostgreSQL indexes")
+class LookupIndexTests(TestCase):
+    """Indexes of the item code lookups (migration 0003)."""
+
+    def test_item_code_trigram(self):
+        task_mapping = TaskMapping.objects.create(opportunity=create_opportunity(), code="MAT")
+        AssignedProduct.objects.create(task_mapping=task_mapping, item_code="PVC ELBOW 2")
+
+        plan = explain(AssignedProduct.objects.filter(item_code__icontains="elbow"))
+        self.assertIn("assigned_product_item_code_trgm_idx", plan)
@@ -78,6 +78,11 @@ urlpatterns = [
     ),
     # Upload CAD file
     path("upload-cad-file", upload_cad_file.UploadCADFile.as_view(), name="upload-cad-file"),
+    path(
+        "upload-cad-file/status/<str:token>",
+        upload_cad_file.UploadCADFileStatus.as_view(),
+        name="upload-cad-file-status",
+    ),
     # Material List
     path(
         "material-list/<str:document_number>/ajax",
@@ -142,6 +147,7 @@ urlpatterns = [
         "assign-task-labor/<str:document_number>", task_mapping.AssignTaskLaborView.as_view(), name="assign-task-labor"
     ),
     path("update-sequence", task_mapping.UpdateSequenceView.as_view(), name="update-sequence"),
+    path("task-fragment/<int:task_id>", task_mapping.TaskFragmentView.as_view(), name="task-fragment"),
     # Proposal Creation
     path(
         "<str:document_number>/create-proposal/ajax",
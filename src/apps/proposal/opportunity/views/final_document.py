@@ -2,10 +2,9 @@
 Final Document Stage Views
 """
 
-from django.db.models import QuerySet
-
-from apps.proposal.product.models import Product
+from apps.proposal.product.models import Product, display_name_key
 
+from ..estimate_cache import get_or_compute
 from ..models import AssignedProduct, TaskMapping
 
 
@@ -13,59 +12,71 @@ class FinalDocument:
     """
     A class for handling final document generation and data retrieval,
     including material master data and cost variances.
+
+    NOTE: The assigned products are served from the estimate cache (see `estimate_cache.py`).
     """
 
     @staticmethod
-    def _get_new_material_master_data(document_number: str) -> QuerySet:
+    def _get_new_material_master_data(document_number: str) -> list:
         """
         Retrieve new material master data for the given document number.
 
         :param document_number: The unique identifier for the opportunity.
-        :return: A queryset of assigned products that are not assigned.
+        :return: A list of assigned products that are not assigned.
         """
-        task_mapping_ids = TaskMapping.objects.filter(opportunity__document_number=document_number).values_list(
-            "id", flat=True
-        )
 
-        new_material_master_data = AssignedProduct.objects.filter(
-            task_mapping__id__in=task_mapping_ids, is_assign=False
-        )
-        return new_material_master_data
+        def get_new_material_master_data():
+            task_mapping_ids = TaskMapping.objects.filter(opportunity__document_number=document_number).values_list(
+                "id", flat=True
+            )
+            return list(AssignedProduct.objects.filter(task_mapping__id__in=task_mapping_ids, is_assign=False))
+
+        return get_or_compute("new_material_master_data", document_number, get_new_material_master_data)
 
     @staticmethod
-    def _get_cost_variances_data(document_number: str) -> QuerySet:
+    def _get_cost_variances_data(document_number: str) -> list:
         """
         Retrieve cost variances data for the given document number.
 
         :param document_number: The unique identifier for the opportunity.
-        :return: A queryset of assigned products with vendor quoted costs.
+        :return: A list of assigned products with vendor quoted costs.
         """
-        task_mapping_ids = TaskMapping.objects.filter(opportunity__document_number=document_number).values_list(
-            "id", flat=True
-        )
 
-        cost_variances_data = AssignedProduct.objects.filter(
-            task_mapping__id__in=task_mapping_ids, vendor_quoted_cost__isnull=False, vendor_quoted_cost__gt=0.0
-        )
-        return cost_variances_data
+        def get_cost_variances_data():
+            task_mapping_ids = TaskMapping.objects.filter(opportunity__document_number=document_number).values_list(
+                "id", flat=True
+            )
+            return list(
+                AssignedProduct.objects.filter(
+                    task_mapping__id__in=task_mapping_ids, vendor_quoted_cost__isnull=False, vendor_quoted_cost__gt=0.0
+                )
+            )
+
+        return get_or_compute("cost_variances_data", document_number, get_cost_variances_data)
 
     @staticmethod
     def _get_netsuite_extract_data(document_number: str) -> list:
         """
         Retrieve a list of assigned products for the given document number.
 
+        NOTE: Only the assigned products are cached, their catalog internal ids are looked up on every call since
+        the catalog is imported independently of the opportunity.
+
         :param document_number: The unique identifier for the opportunity.
         :return: A list of assigned products associated with the opportunity.
         """
-        task_mapping_objs = TaskMapping.objects.filter(opportunity__document_number=document_number)
 
-        assigned_products = AssignedProduct.objects.filter(task_mapping__in=task_mapping_objs)
+        def get_assigned_products():
+            task_mapping_objs = TaskMapping.objects.filter(opportunity__document_number=document_number)
+            return list(
+                AssignedProduct.objects.filter(task_mapping__in=task_mapping_objs).select_related("task_mapping")
+            )
+
+        assigned_products = get_or_compute("netsuite_extract_data", document_number, get_assigned_products)
+        products = Product.get_by_display_name(assigned_product.item_code for assigned_product in assigned_products)
         assigned_products_data = []
         for assigned_product in assigned_products:
-            code = assigned_product.item_code
-            product = Product.objects.filter(
-                display_name=code,
-            ).first()
+            product = products.get(display_name_key(assigned_product.item_code))
             assigned_products_data.append(
                 {"assigned_product": assigned_product, "internal_id": product.internal_id if product else "-"}
             )
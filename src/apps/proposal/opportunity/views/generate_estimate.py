@@ -1,11 +1,9 @@
 import urllib.parse
-from decimal import Decimal, InvalidOperation
 from typing import Any, Dict
 
-from django.db.models import Q, QuerySet
+from django.db.models import Q, QuerySet, Sum
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
-from django.urls import reverse
 
 from apps.constants import LOGGER
 from apps.mixin import (
@@ -15,11 +13,38 @@ from apps.mixin import (
     TemplateViewMixin,
 )
 
-from ..models import AssignedProduct, TaskMapping
-from ..tasks import format_number
+from ..estimate import PRODUCT_COST_EXPRESSION, EstimateEngine, EstimateSummary, figure_expressions, parse_tax_rate
+from ..estimate_cache import bump_revision, get_or_compute
+from ..models import AssignedProduct, Opportunity, TaskMapping, TaskMappingRollup
 
 
 class TaskProductDataView(CustomDataTableMixin):
+    """
+    Server side data of the estimate table of the Select Task Code stage.
+
+    Only the requested page is returned, as ids, labels and numbers: the cells are rendered by the DataTables column
+    renderers. The figures are read from the estimate cache and the ordering on a figure is done in the database
+    (see `figure_expressions`), so the response doesn't grow with the opportunity.
+    """
+
+    # Columns ordered by their own field, the figure columns are ordered by their SQL expression
+    ORDER_FIELDS = ("code", "description", "labor_gp_percent", "mat_gp_percent")
+
+    # Figures of a row, see `EstimateEngine`
+    FIGURES = (
+        "labor_cost",
+        "labor_gp",
+        "labor_sell",
+        "mat_cost",
+        "mat_gp",
+        "mat_plus_mu",
+        "sales_tax",
+        "mat_sell",
+        "mat_tax_labor",
+        "comb_gp",
+    )
+
+    engine = None
 
     def get_queryset(self):
         document_number = self.kwargs.get("document_number")
@@ -29,7 +54,7 @@ class TaskProductDataView(CustomDataTableMixin):
             Q(task__description__icontains="Freight")
         )
         # Q(linked_task__isnull=False, task__description__icontains="labor") |
-        return qs.exclude(code__icontains="FRT")
+        return qs.exclude(code__icontains="FRT").select_related("task")
 
     def filter_queryset(self, qs):
         """Return the list of items for this view."""
@@ -42,168 +67,110 @@ class TaskProductDataView(CustomDataTableMixin):
             )
         return qs
 
-    def _get_code(self, obj):
-        """Get code details."""
-        task_name = obj.code if obj.task is None else obj.task.name
-
-        # Construct the URL dynamically using reverse
-        url = reverse("proposal_app:opportunity:update-estimation-products-ajax", args=[obj.id])
-
-        # Now format the HTML with proper values
-        code = f"""
-        <a hx-get="{url}"
-            data-url="{url}"
-            class="htmx-trigger-btn-task-prod"
-            hx-target="#task-content"
-            hx-trigger="click"
-            data-toggle="modal"
-            data-target="#showProduct"
-            data-backdrop="false">
-            <ins>{task_name}</ins>
-        </a>
-        """
-        return code
-
-    def _get_description(self, obj):
-        """Generate the HTML for the description with a clickable link."""
-        et = obj  # Or whatever object has the `et` property
-
-        if et.task is None:
-            task_description = f"{et.code} : {et.description}"
-        else:
-            task_description = f"{et.task.name} : {et.task.description}"
-
-        # Construct the URL dynamically using reverse
-        url = reverse("proposal_app:opportunity:update-estimation-products-ajax", args=[et.id])
-
-        # Now format the HTML with the proper values
-        description = f"""
-            <a hx-get="{url}"
-            data-url="{url}"
-            class="htmx-trigger-btn-task-prod"
-            hx-target="#task-content"
-            hx-trigger="click"
-            data-toggle="modal"
-            data-target="#showProduct"
-            data-backdrop="false">
-                <ins>{task_description}</ins>
-            </a>
-        """
-        return description
-
-    def _labor_gp_percent(self, obj):
-        """Generate the HTML for the labor gp percent."""
-        et = obj
-
-        labor_gp_percent = f"""
-            <input type="text" class="form-control btn-outline-warning labor_gp_percent" value="{et.labor_gp_percent}">
-        """
-        return labor_gp_percent
-
-    def _labor_gp_percent_data(self, obj):
-        return obj.labor_gp_percent if obj.labor_gp_percent else 0
-
-    def _mat_gp_percent(self, obj):
-        """Generate the HTML for the mat gp percent."""
-        et = obj
-        mat_gp_percent = f"""
-            <input type="text" class="form-control btn-outline-warning mat_gp_percent" value="{ et.mat_gp_percent }">"""
-        return mat_gp_percent
-
-    def _mat_gp_percent_data(self, obj):
-        return obj.mat_gp_percent if obj.mat_gp_percent else 0
-    
-    def frt_total(self, obj):
-        if not obj or not hasattr(obj, "opportunity") or not obj.opportunity:
-            return 0
-
-        task_mappings = TaskMapping.objects.filter(opportunity__document_number=obj.opportunity.document_number)
-        
-        if task_mappings.exists():
-            filtered_task_mappings = task_mappings.filter(task__description__icontains="Freight")
-            task_mapping_ids = task_mappings.values_list("id", flat=True)
-        else:
-            return 0
+    def get_ordering(self, qs):
+        """
+        Order by the requested columns, then by id so the pages are stable.
+
+        NOTE: The columns that are neither a field nor a figure are not orderable and ignored.
+        """
+        expressions = None
+        ordering = []
+        for key in self.order:
+            order_by = self.build_order_by(key)
+            column = order_by.lstrip("-")
+            if column not in self.ORDER_FIELDS:
+                if expressions is None:
+                    # The figures are computed from the rollups, the tasks without one would sort as 0
+                    TaskMappingRollup.ensure(
+                        TaskMapping.objects.filter(opportunity__document_number=self.kwargs.get("document_number"))
+                    )
+                    expressions = figure_expressions(self._get_tax_rate())
+                if column not in expressions:
+                    continue
+                qs = qs.annotate(**{f"order_{column}": expressions[column]})
+                order_by = order_by.replace(column, f"order_{column}")
+            ordering.append(order_by)
+        return qs.order_by(*ordering, "id")
+
+    def _get_tax_rate(self) -> float:
+        """Tax rate of the opportunity."""
+        tax_rate = (
+            Opportunity.objects.filter(document_number=self.kwargs.get("document_number"))
+            .values_list("tax_rate", flat=True)
+            .first()
+        )
+        return parse_tax_rate(tax_rate)
 
-        try:
-            assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids).order_by("sequence")
-        except Exception as e:
-            LOGGER.error(f"Exception : {e}")
-            assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids)
-
-        total_price = 0  
-        for task in filtered_task_mappings:
-            task_assigned_products = assigned_products.filter(task_mapping_id=task.id)
-            total_price += sum(
-                (   
-                    product.vendor_quoted_cost * product.quantity
-                    if product.vendor_quoted_cost
-                    else product.standard_cost * product.quantity
-                )
-                for product in task_assigned_products
+    def _get_figures(self) -> dict:
+        """
+        Get the figures of every task mapping of the opportunity by task mapping id, from the estimate cache.
+
+        :return: A dictionary of figures by task mapping id.
+        """
+        document_number = self.kwargs.get("document_number")
+
+        def get_engine_figures():
+            self.engine = EstimateEngine.for_document(document_number)
+            return self.engine.figures
+
+        return get_or_compute("task_figures", document_number, get_engine_figures)
+
+    @staticmethod
+    def frt_total(document_number: str) -> float:
+        """
+        Get the cost of the products assigned to the freight tasks of an opportunity, from the estimate cache.
+
+        :param document_number: The unique identifier for the opportunity.
+        :return: The total cost.
+        """
+
+        def get_freight_total():
+            freight_products = AssignedProduct.objects.filter(
+                task_mapping__opportunity__document_number=document_number,
+                task_mapping__task__description__icontains="Freight",
             )
-        
-        return total_price
+            return freight_products.aggregate(total=Sum(PRODUCT_COST_EXPRESSION))["total"] or 0
 
+        return get_or_compute("freight_total", document_number, get_freight_total)
 
     def prepare_results(self, qs):
         """
-        This method formats the queryset into the structure that DataTables expects.
-        Each row of data is a list of values corresponding to the columns in the table.
+        Format the task mappings of the page into the rows DataTables expects.
+
+        :param qs: Page of task mappings.
+        :return: A list of `{"id", "code", "description", "labor_gp_percent", "mat_gp_percent", <figures>}` rows.
         """
-        data = []
-        items_list = []
+        figures = self._get_figures()
 
-        item = False
+        data = []
         for item in qs:
-            items_list.append(item)
-            
+            if item.task is None:
+                code, description = item.code, f"{item.code} : {item.description}"
+            else:
+                code, description = item.task.name, f"{item.task.name} : {item.task.description}"
+
+            item_figures = figures.get(item.id, {})
             data.append(
                 {
-                    "code": self._get_code(item),
-                    "description": self._get_description(item),
-                    "labor_cost": format_number(item.labor_cost),
-                    "labor_gp_percent": self._labor_gp_percent(item),
-                    "labor_gp": format_number(item.labor_gp),
-                    "labor_sell": format_number(item.labor_sell),
-                    "mat_cost": format_number(item.mat_cost),
-                    "mat_gp_percent": self._mat_gp_percent(item),
-                    "mat_gp": format_number(item.mat_gp),
-                    "mat_plus_mu": format_number(item.mat_plus_mu),
-                    "sales_tax": format_number(item.sales_tax),
-                    "mat_sell": format_number(item.mat_sell),
-                    "mat_tax_labor": format_number(item.mat_tax_labor),
-                    "comb_gp": item.comb_gp,
-                    "labor_gp_percent_data": self._labor_gp_percent_data(item),  # type : ignore
-                    "mat_gp_percent_data": self._mat_gp_percent_data(item),  # type : ignore
+                    "id": item.id,
+                    "code": code,
+                    "description": description,
+                    "labor_gp_percent": item.labor_gp_percent,
+                    "mat_gp_percent": item.mat_gp_percent,
+                    **{name: item_figures.get(name, 0) for name in self.FIGURES},
                 }
             )
-        
-        last_item = items_list[-1] if items_list else None
-        data.append({
-            "code": "FRT",
-            "description": "FRT: Freight",
-            "labor_cost": "",
-            "labor_gp_percent": "",
-            "labor_gp": "",
-            "labor_sell": "",
-            "mat_cost": "",
-            "mat_gp_percent": "",
-            "mat_gp": "",
-            "mat_plus_mu": "",
-            "sales_tax": "",
-            "mat_sell": "",
-            "mat_tax_labor": "",
-            "comb_gp": "",
-            "labor_gp_percent_data": self._labor_gp_percent_data(item) if item else 0,  # type : ignore
-            "mat_gp_percent_data": self._mat_gp_percent_data(item) if item else 0,  # type : ignore
-            "frt_total": self.frt_total(last_item),
-            # "is_freight": "Freight" in (item.task.description if item.task else ""),            
-        })
         return data
 
     def get(self, request, *args, **kwargs):
+        """
+        Return the page of the estimate table, with the freight total and the grand totals of the estimate.
+        """
+        document_number = self.kwargs.get("document_number")
         context_data = self.get_context_data(request)
+        context_data["frt_total"] = self.frt_total(document_number)
+        totals = EstimateSummary.for_document(document_number, self.engine).totals
+        context_data["total"] = {key: float(value) for key, value in totals.items()}
         return JsonResponse(context_data)
 
 
@@ -224,17 +191,14 @@ class GenerateEstimateTable(ProposalViewMixin):
         context = super().get_context_data(**kwargs)
         document_number = self.kwargs["document_number"]
 
-        # Fetch task mappings excluding and including labor descriptions
-        context["estimation_table"] = TaskMapping.objects.filter(opportunity__document_number=document_number).exclude(
-            task__description__icontains="labor"
-        )
+        engine = EstimateEngine.for_document(document_number)
 
-        context["estimation_table_labor"] = TaskMapping.objects.filter(
-            opportunity__document_number=document_number
-        ).filter(task__description__icontains="labor", assign_to__isnull=True)
+        # Fetch task mappings excluding and including labor descriptions
+        context["estimation_table"] = GenerateEstimate._get_task_products(document_number, engine)
+        context["estimation_table_labor"] = GenerateEstimate._get_task_labor(document_number, engine)
 
         # Calculate totals and add to context
-        context["total"] = GenerateEstimate._get_total(document_number)
+        context["total"] = GenerateEstimate._get_total(document_number, engine)
         context["document_number"] = document_number
         return context
 
@@ -319,7 +283,6 @@ class UpdateEstimationTable(CustomViewMixin):
         :param data: Parsed request data containing update information.
         """
         document_number = data.get("document_number", [None])[0]
-        print(f"document_number {type(document_number)}: {document_number}")
         update_fields = {
             "labor_gp_percent": data.get("labor_gp_percent", [None])[0],
             "mat_gp_percent": data.get("mat_gp_percent", [None])[0],
@@ -331,6 +294,7 @@ class UpdateEstimationTable(CustomViewMixin):
 
         if update_data:
             task_mapping_objs.update(**update_data)
+            bump_revision(document_number=document_number)
             _text = ", ".join(update_data.keys()).replace("_", " ").replace("percent", "%").title()
             self._message = f"{_text} Updated Successfully"
             self._code = 200
@@ -361,93 +325,47 @@ class UpdateEstimationTable(CustomViewMixin):
 class GenerateEstimate:
 
     @staticmethod
-    def _get_task_products(document_number: str) -> QuerySet:
+    def _get_task_products(document_number: str, engine: EstimateEngine = None) -> list:
         """
         Retrieve task mappings for products associated with the given document number.
 
         :param document_number: The unique identifier for the opportunity.
-        :return: A queryset of task mappings excluding those with 'labor' in the description.
+        :param engine: Estimate engine of the opportunity, built if not provided.
+        :return: A list of task mappings excluding those with 'labor' in the description.
         """
         qs = TaskMapping.objects.filter(opportunity__document_number=document_number).exclude(
             task__description__icontains="labor"
         )
-
-        return qs
+        engine = engine or EstimateEngine.for_document(document_number)
+        return engine.annotate(qs.select_related("task"))
 
     @staticmethod
-    def _get_task_labor(document_number: str) -> QuerySet:
+    def _get_task_labor(document_number: str, engine: EstimateEngine = None) -> list:
         """
         Retrieve task mappings for labor associated with the given document number.
 
         :param document_number: The unique identifier for the opportunity.
-        :return: A queryset of task mappings that include 'labor' in the description.
+        :param engine: Estimate engine of the opportunity, built if not provided.
+        :return: A list of task mappings that include 'labor' in the description.
         """
         qs = TaskMapping.objects.filter(opportunity__document_number=document_number).filter(
             task__description__icontains="labor", assign_to__isnull=True
         )
-        return qs
+        engine = engine or EstimateEngine.for_document(document_number)
+        return engine.annotate(qs.select_related("task"))
 
     @staticmethod
-    def _get_total(document_number: str) -> dict:
+    def _get_total(document_number: str, engine: EstimateEngine = None) -> dict:
         """
         Calculate the total costs associated with the given document number.
 
+        NOTE: The totals come from the cached `EstimateSummary` shared with the KPI breakdowns.
+
         :param document_number: The unique identifier for the opportunity.
+        :param engine: Estimate engine of the opportunity, built if the summary isn't cached and not provided.
         :return: A dictionary with total labor and material costs, and total cost.
         """
-        task_mapping_qs = TaskMapping.objects.filter(opportunity__document_number=document_number).exclude(Q(code__icontains="FRT") | Q(task__description__icontains="freight"))
-        
-        totals = {
-            "total_labor_cost": Decimal("0.00"),
-            "total_labor_gp_percent": Decimal("0.00"),
-            "total_labor_gp": Decimal("0.00"),
-            "total_labor_sell": Decimal("0.00"),
-            "total_mat_cost": Decimal("0.00"),
-            "total_mat_gp_percent": Decimal("0.00"),
-            "total_mat_gp": Decimal("0.00"),
-            "total_mat_mu": Decimal("0.00"),
-            "total_sales_tax": Decimal("0.00"),
-            "total_s_and_h": Decimal("0.00"),
-            "total_mat_sell": Decimal("0.00"),
-            "total_mat_tax_labor": Decimal("0.00"),
-            "total_comb_gp": Decimal("0.00"),
-        }
-        total_cost = Decimal("0.00")
-        for task in task_mapping_qs:
-            totals["total_labor_cost"] += round(Decimal(task.labor_cost or "0.0"), 2)
-            try:
-                labor_gp_percent = Decimal(task.labor_gp_percent or "0.0")
-            except (ValueError, InvalidOperation):
-                labor_gp_percent = Decimal("0.0")
-            totals["total_labor_gp_percent"] = round(labor_gp_percent, 2)
-            totals["total_labor_gp"] += round(Decimal(task.labor_gp or "0.0"), 2)
-            totals["total_labor_sell"] += round(Decimal(task.labor_sell or "0.0"), 2)
-            totals["total_mat_cost"] += round(Decimal(task.mat_cost or "0.0"), 2)
-            totals["total_mat_gp_percent"] = round(Decimal(task.mat_gp_percent if task.mat_gp_percent else "0.0"), 2)
-            totals["total_mat_gp"] += round(Decimal(task.mat_gp or "0.0"), 2)
-            totals["total_mat_mu"] += round(Decimal(task.mat_plus_mu or "0.0"), 2)
-            totals["total_sales_tax"] += round(Decimal(task.sales_tax or "0.0"), 2)
-            totals["total_s_and_h"] = round(Decimal(task.s_and_h or "0.0"), 2)
-            totals["total_mat_sell"] += round(Decimal(task.mat_sell or "0.0"), 2)
-            totals["total_mat_tax_labor"] += round(Decimal(task.mat_tax_labor or "0.0"), 2)
-            totals["total_comb_gp"] += round(Decimal(task.comb_gp or "0.0"), 2)
-            total_cost += Decimal(task.labor_cost or "0.0") + Decimal(task.mat_cost or "0.0")
-            
-        totals["total_cost"] = totals["total_labor_cost"] + totals["total_mat_cost"]
-        totals["total_sale"] = totals["total_labor_sell"] + totals["total_mat_sell"]
-        totals["total_gp"] = totals["total_mat_gp"] + totals["total_labor_gp"]
-        totals["total_gp_per"] = totals["total_sale"] - total_cost  
-
-        if totals["total_sale"] != 0:
-            totals["total_gp_percent"] = (totals["total_gp"] / totals["total_sale"]) * 100
-
-        else:
-            totals["total_gp_percent"] = Decimal("0.00")
-
-        for key, value in totals.items():
-            totals[key] = f"{value:,.2f}"
-
-        return totals
+        return EstimateSummary.for_document(document_number, engine).formatted()
 
 
 # KPI
@@ -465,19 +383,7 @@ class TotalCostBreakdown(TemplateViewMixin):
         :param document_number: The unique identifier for the opportunity.
         :return: A dictionary with total labor and material costs, and total cost.
         """
-        task_mapping_qs = TaskMapping.objects.filter(opportunity__document_number=document_number).exclude(Q(code__icontains="FRT") | Q(task__description__icontains="freight"))
-        totals = {
-            "total_labor_cost": Decimal("0.00"),
-            "total_mat_cost": Decimal("0.00"),
-        }
-
-        for task in task_mapping_qs:
-            totals["total_labor_cost"] += Decimal(task.labor_cost or "0.0")
-            totals["total_mat_cost"] += Decimal(task.mat_cost or "0.0")
-
-        totals["total_cost"] = totals["total_labor_cost"] + totals["total_mat_cost"]
-
-        return totals
+        return EstimateSummary.for_document(document_number).cost
 
     def get_context_data(self, **kwargs: Any) -> Dict[str, Any]:
         """
@@ -506,18 +412,7 @@ class TotalSaleBreakdown(TemplateViewMixin):
         :param document_number: The unique identifier for the opportunity.
         :return: A dictionary with total labor sales, material sales, and overall total sales.
         """
-        task_mapping_qs = TaskMapping.objects.filter(opportunity__document_number=document_number).exclude(Q(code__icontains="FRT") | Q(task__description__icontains="freight"))
-        totals = {
-            "total_labor_sale": Decimal("0.00"),
-            "total_mat_sale": Decimal("0.00"),
-        }
-
-        for task in task_mapping_qs:
-            totals["total_labor_sale"] += Decimal(task.labor_sell or "0.0")
-            totals["total_mat_sale"] += Decimal(task.mat_sell or "0.0")
-
-        totals["total_sale"] = totals["total_labor_sale"] + totals["total_mat_sale"]
-        return totals
+        return EstimateSummary.for_document(document_number).sale
 
     def get_context_data(self, **kwargs: Any) -> Dict[str, Any]:
         """
@@ -546,23 +441,7 @@ class TotalGPBreakdown(TemplateViewMixin):
         :param document_number: The unique identifier for the opportunity.
         :return: A dictionary with total labor GP, material GP, and overall total GP.
         """
-        task_mapping_qs = TaskMapping.objects.filter(opportunity__document_number=document_number).exclude(Q(code__icontains="FRT") | Q(task__description__icontains="freight"))
-        print('task_mapping_qs: ||||TotalGPBreakdown|||||||||| ', task_mapping_qs)
-
-        totals = {
-            "total_sale": Decimal("0.00"),
-            "total_cost": Decimal("0.00"),
-            "total_mat_gp": Decimal("0.00"),
-            "total_labor_gp": Decimal("0.00"),
-        }
-
-        for task in task_mapping_qs:
-            totals["total_mat_gp"] += Decimal(task.mat_gp or "0.0")
-            totals["total_labor_gp"] += Decimal(task.labor_gp or "0.0")
-
-        totals["total_gp"] = totals["total_mat_gp"] + totals["total_labor_gp"]
-
-        return totals
+        return EstimateSummary.for_document(document_number).gp
 
     def get_context_data(self, **kwargs: Any) -> Dict[str, Any]:
         """
@@ -590,38 +469,8 @@ class TotalGPPerBreakdown(TemplateViewMixin):
 
         :param document_number: The unique identifier for the opportunity.
         :return: A dictionary with total labor GP%, material GP%, combined GP%, and overall GP%.
-        :raises ZeroDivisionError: if the value not divided by the number.
         """
-        task_mapping_qs = TaskMapping.objects.filter(opportunity__document_number=document_number).exclude(Q(code__icontains="FRT") | Q(task__description__icontains="freight"))
-        print('task_mapping_qs:-------------------- ', task_mapping_qs)
-
-        total_cost = 0
-        totals = {
-            "total_gp": Decimal("0.00"),
-            "total_sell": Decimal("0.00"),
-            "total_mat_gp": Decimal("0.00"),
-            "total_labor_gp": Decimal("0.00"),
-        }
-
-        for task in task_mapping_qs:
-            totals["total_sell"] += Decimal(task.labor_sell or "0.0") + Decimal(task.mat_sell or "0.0")
-            total_cost += Decimal(task.labor_cost or "0.0") + Decimal(task.mat_cost or "0.0")
-            totals["total_mat_gp"] += Decimal(task.mat_gp or "0.0")
-            totals["total_labor_gp"] += Decimal(task.labor_gp or "0.0")
-
-        totals["total_gp"] = totals["total_mat_gp"] + totals["total_labor_gp"]
-        totals["total_gp_per"] = totals["total_sell"] - total_cost
-        
-        try:
-            if totals["total_sell"] == Decimal("0.00"):
-                totals["total_gp_percent"] = Decimal("0.00")
-            else:
-                totals["total_gp_percent"] = (totals["total_gp"] / totals["total_sell"]) * 100
-
-        except (ZeroDivisionError, InvalidOperation):
-            totals["total_gp_percent"] = Decimal("0.00")
-
-        return totals
+        return EstimateSummary.for_document(document_number).gp_percent
 
     def get_context_data(self, **kwargs: Any) -> Dict[str, Any]:
         """
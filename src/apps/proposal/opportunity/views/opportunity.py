@@ -21,13 +21,13 @@ from apps.mixin import (
 )
 from apps.proposal.opportunity.models import TaskMapping
 
+from ..estimate import EstimateEngine
 from ..forms import ImportOpportunityCSVForm
 from ..models import Document, Invoice, Opportunity
 from ..tasks import import_opportunity_from_xlsx
 from .final_document import FinalDocument
 from .generate_estimate import GenerateEstimate
-from .proposal_creation import ProposalCreationData
-from .task_mapping import TaskMappingData
+from .proposal_creation import ProposalCreationData, TaskMappingData
 
 # Opportunity View Start
 
@@ -355,16 +355,13 @@ class OpportunityDetail(ProposalDetailViewMixin):
 
         # Task Mapping
         context['document_number']=document_number
-        context["total_tasks"] = TaskMappingData._get_total_tasks(document_number)
-        context["task_mapping_list"] = TaskMappingData._get_tasks(document_number)
-        context["task_mapping_labor_list"] = TaskMappingData._get_labour_tasks(document_number)
-        context["grand_total"] = TaskMappingData._get_task_total(document_number)
-        context["labor_task_total"] = TaskMappingData._get_labor_task_total(document_number)
+        context.update(TaskMappingData._get_task_mapping_tables(document_number))
 
         # Generate Estimation
-        context["task_product_list"] = GenerateEstimate._get_task_products(document_number)
-        context["task_labor_list"] = GenerateEstimate._get_task_labor(document_number)
-        context["total"] = GenerateEstimate._get_total(document_number)
+        engine = EstimateEngine.for_document(document_number)
+        context["task_product_list"] = GenerateEstimate._get_task_products(document_number, engine)
+        context["task_labor_list"] = GenerateEstimate._get_task_labor(document_number, engine)
+        context["total"] = GenerateEstimate._get_total(document_number, engine)
 
         # Proposal creation
         context["grouped_proposals"] = ProposalCreationData._get_proposal_creation(document_number)
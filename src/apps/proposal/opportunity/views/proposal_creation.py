@@ -8,6 +8,8 @@ from django.template.loader import render_to_string
 from apps.constants import ERROR_RESPONSE, LOGGER
 from apps.mixin import ViewMixin
 
+from ..estimate import EstimateEngine, is_labor_task
+from ..estimate_cache import bump_revision, get_or_compute
 from ..models import (
     AssignedProduct,
     Invoice,
@@ -15,6 +17,7 @@ from ..models import (
     ProposalCreation,
     SelectTaskCode,
     TaskMapping,
+    TaskMappingRollup,
 )
 
 
@@ -81,19 +84,17 @@ class CreateProposalView(ViewMixin):
                 for task in task_instances
             ]
             ProposalCreation.objects.bulk_create(proposals)
+            bump_revision(pk=opportunity.pk)
 
+            # NOTE: The task mapping table doesn't show the proposal groups, only the proposal table is re-rendered
             data = ProposalTable.generate_table(opportunity)
-            data2 = TaskMappingTable.generate_table(opportunity)
-            # Render the updated HTML for the task mapping table
             html = render(request, "proposal/opportunity/stage/proposal_creation/based_on_task.html", data)
-            html2 = render(request, "proposal/opportunity/stage/task_mapping/task_table.html", data2)
 
             return JsonResponse(
                 {
                     "modal_to_close": "modelSelectTask",
                     "message": "Proposal created successfully!",
                     "html": html.content.decode("utf-8"),
-                    "html2": html2.content.decode("utf-8"),
                     "code": 201,
                 },
                 status=201,
@@ -195,6 +196,7 @@ class UpdateGroupName(ViewMixin):
                 opportunity__document_number=document_number, id__in=id_list
             )
             updated_count = proposal_creation_obj.update(group_name=group_name)
+            bump_revision(document_number=document_number)
 
             if updated_count == 0:
                 LOGGER.error("No proposals were found for the given IDs.")
@@ -219,12 +221,17 @@ class ProposalCreationData:
         """
         Retrieves proposals by document number and organizes them by group.
 
+        NOTE: The task totals are computed by one `EstimateEngine` for the opportunity, not by task.
+
         :param document_number: The document number to filter proposals.
         :return: A dictionary with grouped proposals, task totals, and assigned products.
         """
-        qs = ProposalCreation.objects.filter(opportunity__document_number=document_number).prefetch_related(
-            Prefetch("task_mapping__assigned_products")
+        qs = (
+            ProposalCreation.objects.filter(opportunity__document_number=document_number)
+            .select_related("task_mapping__task")
+            .prefetch_related(Prefetch("task_mapping__assigned_products"))
         )
+        engine = EstimateEngine.for_document(document_number)
 
         # Group proposals by their group name and count them
         grouped_proposals = qs.values("group_name").annotate(count=Count("id"))
@@ -246,7 +253,8 @@ class ProposalCreationData:
 
             # Fetch assigned products for the task
             assigned_products = proposal.task_mapping.assigned_products.all()
-            task_object = proposal.task_mapping
+            task_object = engine.annotate([proposal.task_mapping])[0]
+            value = ProposalCreationData._calculate_product_value(task_object)
 
             filtered_assigned_products = []
 
@@ -254,8 +262,6 @@ class ProposalCreationData:
                 if product.is_select:  # Only include selected products
                     filtered_assigned_products.append(product)
 
-                value = ProposalCreationData._calculate_product_value(task_object)
-
                 result[group_name]["task_totals"][task_object] = value
                 result[group_name]["main_total"] += value
 
@@ -291,6 +297,18 @@ class ProposalCreationData:
 
     @staticmethod
     def _get_proposal_totals(document_number: str) -> dict:
+        """
+        Get the proposal totals of a document number from the estimate cache, see `_calculate_proposal_totals`.
+
+        :param document_number: The document number used to filter proposals and invoices.
+        :return: A dictionary with the grand total price and final total price (including taxes).
+        """
+        return get_or_compute(
+            "proposal_totals", document_number, lambda: ProposalCreationData._calculate_proposal_totals(document_number)
+        )
+
+    @staticmethod
+    def _calculate_proposal_totals(document_number: str) -> dict:
         """
         Calculates total quantities, prices, and costs for proposals linked to a document number.
 
@@ -300,15 +318,16 @@ class ProposalCreationData:
         invoice = Invoice.objects.get(opportunity__document_number=document_number)
         proposal_creations = ProposalCreation.objects.filter(opportunity__document_number=document_number)
 
-        task_mappings = TaskMapping.objects.filter(id__in=proposal_creations.values_list("task_mapping_id", flat=True))
-
-        task_mapping_ids = task_mappings.values_list("id", flat=True)
-        assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids)
+        # Products of the proposal tasks, fetched once and grouped by task
+        assigned_products = defaultdict(list)
+        for product in AssignedProduct.objects.filter(
+            task_mapping_id__in=proposal_creations.values_list("task_mapping_id", flat=True)
+        ):
+            assigned_products[product.task_mapping_id].append(product)
 
         tasks_with_products = {}
 
-        for task in task_mappings:
-            task_assigned_products = assigned_products.filter(task_mapping_id=task.id)
+        for task_mapping_id, task_assigned_products in assigned_products.items():
 
             total_quantity = sum(product.quantity for product in task_assigned_products)
 
@@ -323,7 +342,7 @@ class ProposalCreationData:
                 if product.local_cost is not None
             )
 
-            tasks_with_products[task.id] = {
+            tasks_with_products[task_mapping_id] = {
                 "total_quantity": total_quantity,
                 "total_price": total_price,
                 "total_local_cost": total_local_cost,
@@ -343,230 +362,144 @@ class ProposalCreationData:
         return total_data
 
 
-# NOTE: Add data form handle circular import error
+# NOTE: Task mapping tables live here (and are imported by `task_mapping.py`) to avoid a circular import
 class TaskMappingData:
 
     @staticmethod
-    def _get_total_tasks(document_number: str) -> int:
+    def _get_task_mapping_tables(document_number: str) -> dict:
         """
-        Returns the total number of tasks.
+        Get the task mapping tables of a document number from the estimate cache, see `_build_task_mapping_tables`.
 
         :param document_number: The document number to filter task mappings.
+        :return: A dictionary with the `total_tasks`, `task_mapping_list`, `task_mapping_labor_list`,
+            `grand_total` and `labor_task_total` context values.
         """
-        task_mapping_obj = TaskMapping.objects.filter(opportunity__document_number=document_number)
-        return len(task_mapping_obj)
+        return get_or_compute(
+            "task_mapping_tables", document_number, lambda: TaskMappingData._build_task_mapping_tables(document_number)
+        )
 
     @staticmethod
-    def _get_tasks(document_number: str) -> dict:
+    def _build_task_mapping_tables(document_number: str) -> dict:
         """
-        Retrieve tasks and their assigned products for a given document number.
+        Build the product table, labor table, totals and task count of the task mapping stage in a single pass.
+
+        The task mappings (with their rollups) and the assigned products of the opportunity are fetched once,
+        the products are grouped by task mapping in Python, so the number of queries doesn't grow with the
+        number of tasks.
 
         :param document_number: The document number to filter task mappings.
-        :return: A dictionary with task details, including total quantities, prices, and profit percentages.
+        :return: A dictionary with the `total_tasks`, `task_mapping_list`, `task_mapping_labor_list`,
+            `grand_total` and `labor_task_total` context values.
         """
         task_mappings = TaskMapping.objects.filter(opportunity__document_number=document_number)
-        filtered_task_mappings = task_mappings.exclude(task__description__icontains="labor")
-        task_mapping_ids = filtered_task_mappings.values_list("id", flat=True)
-
-        try:
-            assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids).order_by(
-                "sequence"
-            )
-
-        except Exception as e:
-            LOGGER.error(f"assigned_products Exception : {e}")
-            assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids)
+        TaskMappingRollup.ensure(task_mappings)
 
-        tasks_with_products = {}
+        task_mappings = list(task_mappings.select_related("task", "rollup", "opportunity"))
+        # The task blocks link to the opportunity, one instance is shared so it's pickled once in the cache
+        for task in task_mappings[1:]:
+            task.opportunity = task_mappings[0].opportunity
 
-        for task in filtered_task_mappings:
-            task_assigned_products = assigned_products.filter(task_mapping_id=task.id)
+        assigned_products = defaultdict(list)
+        for product in AssignedProduct.objects.filter(task_mapping__in=[task.id for task in task_mappings]).order_by(
+            "sequence"
+        ):
+            assigned_products[product.task_mapping_id].append(product)
 
-            total_quantity = sum(product.quantity for product in task_assigned_products)
-            total_price = sum(
-                (
-                    product.vendor_quoted_cost * product.quantity
-                    if product.vendor_quoted_cost
-                    else product.standard_cost * product.quantity
-                )
-                for product in task_assigned_products
-            )
-            total_unit_price = sum(
-                product.vendor_quoted_cost if product.vendor_quoted_cost else product.standard_cost
-                for product in task_assigned_products
-            )
-
-            total_percent = sum(product.gross_profit_percentage for product in task_assigned_products)
-
-            tasks_with_products[task.id] = {
-                "task": task,
-                "assigned_products": task_assigned_products,
-                "total_quantity": round(total_quantity, 2),
-                "total_price": round(total_price, 2),
-                "total_unit_price": round(total_unit_price, 2),
-                "total_percent": round(total_percent, 2),
-            }
-
-        return tasks_with_products
+        tables = {"task_mapping_list": {}, "task_mapping_labor_list": {}}
+        for task in task_mappings:
+            table = "task_mapping_labor_list" if is_labor_task(task) else "task_mapping_list"
+            tables[table][task.id] = TaskMappingData._get_task_info(task, assigned_products[task.id])
+
+        return {
+            "total_tasks": len(task_mappings),
+            "task_mapping_list": tables["task_mapping_list"],
+            "task_mapping_labor_list": tables["task_mapping_labor_list"],
+            **TaskMappingData._get_grand_totals(task_mappings),
+        }
 
     @staticmethod
-    def _get_task_total(document_number: str) -> dict:
+    def _get_task_info(task: TaskMapping, assigned_products: list) -> dict:
         """
-        Calculate total quantities and prices for tasks associated with a document number.
+        Build the row of one task of the task mapping tables from its rollup.
 
-        :param document_number: The document number to filter task mappings.
-        :return: A dictionary with grand total quantity and price.
+        :param task: Task mapping, with its `rollup`.
+        :param assigned_products: Assigned products of the task, ordered by sequence.
+        :return: The `t_info` context of the task.
         """
-        task_mappings = TaskMapping.objects.filter(opportunity__document_number=document_number)
-        filtered_task_mappings = task_mappings.exclude(task__description__icontains="labor")
-        task_mapping_ids = filtered_task_mappings.values_list("id", flat=True)
-
-        assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids)
-
-        tasks_with_products = {}
-
-        for task in filtered_task_mappings:
-            task_assigned_products = assigned_products.filter(task_mapping_id=task.id)
-
-            total_quantity = sum(product.quantity for product in task_assigned_products)
-            total_price = sum(
-                (
-                    (product.vendor_quoted_cost if product.vendor_quoted_cost is not None else product.standard_cost)
-                    * product.quantity
-                )
-                for product in task_assigned_products
-            )
-
-            tasks_with_products[task.id] = {
-                "total_quantity": total_quantity,
-                "total_price": total_price,
-            }
-
-        # Calculate grand total price and quantity
-        grand_total_price = sum(v["total_price"] for v in tasks_with_products.values())
-        grand_total_quantity = sum(v["total_quantity"] for v in tasks_with_products.values())
-
-        total_data = {
-            "grand_total_price": round(grand_total_price, 2),
-            "grand_total_quantity": round(grand_total_quantity, 2),
+        rollup = task.rollup
+        return {
+            "task": task,
+            "assigned_products": assigned_products,
+            "total_quantity": round(rollup.total_quantity, 2),
+            "total_price": round(rollup.total_price, 2),
+            "total_unit_price": round(rollup.total_unit_price, 2),
+            "total_percent": round(rollup.total_percent, 2),
         }
-        return total_data
 
     @staticmethod
-    def _get_labour_tasks(document_number: str) -> dict:
+    def _get_grand_totals(task_mappings: list) -> dict:
         """
-        Retrieve labor tasks and their assigned products for a given document number.
+        Sum the rollups of the product tasks and of the labor tasks.
 
-        :param document_number: The document number to filter task mappings.
-        :return: A dictionary containing labor task details, including total quantities, prices, and profit percentages.
+        :param task_mappings: Task mappings of the opportunity, with their `task` and `rollup`.
+        :return: A dictionary with the `grand_total` and `labor_task_total` context values.
         """
-        task_mappings = TaskMapping.objects.filter(opportunity__document_number=document_number)
-        filtered_task_mappings = task_mappings.filter(task__description__icontains="labor")
-        task_mapping_ids = filtered_task_mappings.values_list("id", flat=True)
-
-        try:
-            assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids).order_by(
-                "sequence"
-            )
-        except Exception as e:
-            LOGGER.error(f"error: {e}")
-            assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids)
-
-        tasks_with_products = {}
-
-        for task in filtered_task_mappings:
-            task_assigned_products = assigned_products.filter(task_mapping_id=task.id)
-
-            total_quantity = sum(product.quantity for product in task_assigned_products)
-            total_price = sum(
-                (
-                    product.vendor_quoted_cost * product.quantity
-                    if product.vendor_quoted_cost
-                    else product.standard_cost * product.quantity
-                )
-                for product in task_assigned_products
-            )
-            total_unit_price = sum(
-                product.vendor_quoted_cost if product.vendor_quoted_cost else product.standard_cost
-                for product in task_assigned_products
-            )
-
-            total_percent = sum(product.gross_profit_percentage for product in task_assigned_products)
-
-            tasks_with_products[task.id] = {
-                "task": task,
-                "assigned_products": task_assigned_products,
-                "total_quantity": round(total_quantity, 2),
-                "total_price": round(total_price, 2),
-                "total_unit_price": round(total_unit_price, 2),
-                "total_percent": round(total_percent, 2),
-            }
+        totals = {
+            "task_mapping_list": {"grand_total_price": 0.0, "grand_total_quantity": 0.0},
+            "task_mapping_labor_list": {"grand_total_price": 0.0, "grand_total_quantity": 0.0},
+        }
+        for task in task_mappings:
+            table = "task_mapping_labor_list" if is_labor_task(task) else "task_mapping_list"
+            totals[table]["grand_total_price"] += task.rollup.total_price
+            totals[table]["grand_total_quantity"] += task.rollup.total_quantity
 
-        return tasks_with_products
+        return {
+            "grand_total": {key: round(value, 2) for key, value in totals["task_mapping_list"].items()},
+            "labor_task_total": {key: round(value, 2) for key, value in totals["task_mapping_labor_list"].items()},
+        }
 
     @staticmethod
-    def _get_labor_task_total(document_number: str) -> dict:
-        """
-        Calculate total quantities and prices for labor tasks associated with a document number.
-
-        :param document_number: The document number to filter task mappings.
-        :return: A dictionary with grand total quantity and price for labor tasks.
+    def _get_task_blocks(task_mapping_ids: list) -> dict:
         """
-        task_mappings = TaskMapping.objects.filter(opportunity__document_number=document_number)
-        filtered_task_mappings = task_mappings.filter(task__description__icontains="labor")
-        task_mapping_ids = filtered_task_mappings.values_list("id", flat=True)
-
-        assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids)
-
-        tasks_with_products = {}
-
-        for task in filtered_task_mappings:
-            task_assigned_products = assigned_products.filter(task_mapping_id=task.id)
-
-            total_quantity = sum(product.quantity for product in task_assigned_products)
-            total_price = sum(
-                (
-                    product.vendor_quoted_cost * product.quantity
-                    if product.vendor_quoted_cost * product.quantity
-                    else product.standard_cost
-                )
-                for product in task_assigned_products
-            )
-
-            tasks_with_products[task.id] = {
-                "total_quantity": total_quantity,
-                "total_price": total_price,
-            }
+        Build the context of some tasks of the task mapping tables, for the AJAX responses that re-render only the
+        changed tasks instead of the whole table.
 
-        # Calculate grand total price correctly
-        grand_total_price = sum(v["total_price"] for v in tasks_with_products.values())
-        grand_total_quantity = sum(v["total_quantity"] for v in tasks_with_products.values())
+        NOTE: The rollups of all the tasks of the opportunity are read for the grand totals, the assigned products
+        are only fetched for the changed tasks.
 
-        total_data = {
-            "grand_total_price": round(grand_total_price, 2),
-            "grand_total_quantity": round(grand_total_quantity, 2),
+        :param task_mapping_ids: IDs of the changed task mappings, of the same opportunity.
+        :return: A dictionary with the `tasks` (`t_info` by task mapping id, in the order of `task_mapping_ids`),
+            `opportunity`, `total_tasks`, `grand_total` and `labor_task_total` context values.
+        """
+        task_mapping = TaskMapping.objects.select_related("opportunity").get(id=task_mapping_ids[0])
+        task_mappings = TaskMapping.objects.filter(opportunity=task_mapping.opportunity)
+        TaskMappingRollup.ensure(task_mappings)
+
+        task_mappings = {task.id: task for task in task_mappings.select_related("task", "rollup")}
+        assigned_products = defaultdict(list)
+        for product in AssignedProduct.objects.filter(task_mapping__in=task_mapping_ids).order_by("sequence"):
+            assigned_products[product.task_mapping_id].append(product)
+
+        tasks = {}
+        for task_mapping_id in task_mapping_ids:
+            task = task_mappings[task_mapping_id]
+            task.opportunity = task_mapping.opportunity
+            tasks[task.id] = TaskMappingData._get_task_info(task, assigned_products[task.id])
+
+        return {
+            "tasks": tasks,
+            "opportunity": task_mapping.opportunity,
+            "total_tasks": len(task_mappings),
+            **TaskMappingData._get_grand_totals(list(task_mappings.values())),
         }
-        return total_data
 
 
 class TaskMappingTable:
 
     @staticmethod
     def generate_table(opportunity):
-        total_tasks = TaskMappingData._get_total_tasks(opportunity.document_number)
-        task_mapping_list = TaskMappingData._get_tasks(opportunity.document_number)
-        task_mapping_labor_list = TaskMappingData._get_labour_tasks(opportunity.document_number)
-        grand_total = TaskMappingData._get_task_total(opportunity.document_number)
-        labor_task_total = TaskMappingData._get_labor_task_total(opportunity.document_number)
-
-        data = {
-            "total_tasks": total_tasks,
-            "task_mapping_list": task_mapping_list,
-            "task_mapping_labor_list": task_mapping_labor_list,
-            "grand_total": grand_total,
-            "labor_task_total": labor_task_total,
-            "opportunity": opportunity,
-        }
+        data = TaskMappingData._get_task_mapping_tables(opportunity.document_number)
+        data["opportunity"] = opportunity
         return data
 
 
@@ -8,6 +8,7 @@ from apps.mixin import ViewMixin
 from apps.proposal.customer.models import Customer
 from apps.proposal.labour_cost.models import LabourCost
 from apps.proposal.product.models import Product
+from apps.proposal.product.search import search_products
 from apps.proposal.task.models import Task
 from apps.proposal.vendor.models import Vendor
 
@@ -30,16 +31,7 @@ class ItemCodeSearchView(ViewMixin):
         search_terms = search_term.split()
         LOGGER.info(f"Search Terms: {search_terms}")
 
-        if search_terms:
-            queryset = Product.objects.all()
-
-            for term in search_terms:
-                queryset = queryset.filter(display_name__icontains=term)
-
-            queryset = queryset[:50]
-        else:
-            queryset = Product.objects.filter(display_name__isnull=False).exclude(display_name="")[:50]
-
+        queryset = search_products(search_term, "display_name")
         results = [{"id": product.id, "text": product.display_name} for product in queryset]
         results.insert(0, {"id": "Clear", "text": "--------------"})
         return JsonResponse({"results": results})
@@ -92,16 +84,7 @@ class ItemDescriptionSearchView(ViewMixin):
         search_terms = search_term.split()
         LOGGER.info(f"Search Terms: {search_terms}")
 
-        if search_terms:
-            queryset = Product.objects.all()
-
-            for term in search_terms:
-                queryset = queryset.filter(name__icontains=term)
-
-            queryset = queryset[:50]
-        else:
-            queryset = Product.objects.filter(name__isnull=False).exclude(name="")[:50]
-
+        queryset = search_products(search_term, "name")
         results = [{"id": product.id, "text": product.name} for product in queryset]
         results.insert(0, {"id": "Clear", "text": "--------------"})  # Add the "Clear" option at the top of the list
         return JsonResponse({"results": results})
@@ -9,7 +9,6 @@ from apps.constants import ERROR_RESPONSE, LOGGER
 from apps.mixin import CustomDataTableMixin, CustomViewMixin, ViewMixin
 from apps.proposal.opportunity.tasks import generate_task_mapping_table
 from apps.proposal.opportunity.views.generate_estimate import GenerateEstimate
-from apps.proposal.opportunity.views.task_mapping import TaskMappingData
 from apps.proposal.task.models import Task
 
 from ..models import Opportunity, SelectTaskCode, TaskMapping
@@ -6,17 +6,79 @@ from django.contrib import messages
 from django.db.models import QuerySet
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404, render
+from django.template.loader import render_to_string
 
 from apps.constants import ERROR_RESPONSE, LOGGER
 from apps.mixin import TemplateViewMixin, ViewMixin
 from apps.proposal.labour_cost.models import LabourCost
-from apps.proposal.opportunity.views.proposal_creation import ProposalCreationData
-from apps.proposal.product.models import Product
+from apps.proposal.opportunity.views.proposal_creation import TaskMappingData
+from apps.proposal.product.models import Product, display_name_key
 from apps.proposal.task.models import Task
 from apps.proposal.vendor.models import Vendor
 
+from ..assignment import assign_products
+from ..bulk_edit import bulk_edit_assigned_products, parse_rows
+from ..estimate import is_labor_task
 from ..models import AssignedProduct, Opportunity, PreliminaryMaterialList, TaskMapping
 
+# Templates of the task fragments, by kind of fragment and labor task flag, see `render_task_fragments`
+TASK_FRAGMENT_TEMPLATES = {
+    ("rows", False): "proposal/opportunity/stage/task_mapping/task_products.html",
+    ("rows", True): "proposal/opportunity/stage/task_mapping/labor_task_products.html",
+    ("block", False): "proposal/opportunity/stage/task_mapping/task_block.html",
+    ("block", True): "proposal/opportunity/stage/task_mapping/labor_task_block.html",
+}
+
+
+def render_task_fragments(request, task_mapping_ids: list, fragment: str = "rows") -> dict:
+    """
+    Render the changed tasks of the task mapping tables, the task mapping page patches them in place (see
+    `patchTaskFragments` in tasks.html) instead of replacing the whole table.
+
+    :param request: The HTTP request object.
+    :param task_mapping_ids: IDs of the changed task mappings, of the same opportunity.
+    :param fragment: "rows" to render the assigned products of existing tasks, "block" to render new tasks with
+        their header row.
+    :return: Dictionary with the `fragment`, the `tasks` (`task_id`, `labor`, `html` and `totals` of each task)
+        and the `grand_total` and `labor_task_total` of the opportunity.
+    """
+    data = TaskMappingData._get_task_blocks(task_mapping_ids)
+
+    tasks = []
+    for t_id, t_info in data["tasks"].items():
+        labor = is_labor_task(t_info["task"])
+        context = {"t_id": t_id, "t_info": t_info, "opportunity": data["opportunity"]}
+        tasks.append(
+            {
+                "task_id": t_id,
+                "labor": labor,
+                "html": render_to_string(TASK_FRAGMENT_TEMPLATES[fragment, labor], context, request=request),
+                "totals": {
+                    key: t_info[key] for key in ("total_quantity", "total_price", "total_unit_price", "total_percent")
+                },
+            }
+        )
+
+    return {
+        "fragment": fragment,
+        "tasks": tasks,
+        "grand_total": data["grand_total"],
+        "labor_task_total": data["labor_task_total"],
+    }
+
+
+class TaskFragmentView(ViewMixin):
+    """
+    View returning the assigned products and totals of one task, to refresh it after an edit.
+    """
+
+    def get(self, request, *args, **kwargs) -> JsonResponse:
+        """
+        :return: JsonResponse with the fragment of the task, see `render_task_fragments`.
+        """
+        task_mapping = get_object_or_404(TaskMapping, id=self.kwargs["task_id"])
+        return JsonResponse(render_task_fragments(request, [task_mapping.id]))
+
 
 class AssignProdLabor(TemplateViewMixin):
     """
@@ -33,75 +95,48 @@ class AssignProdLabor(TemplateViewMixin):
         :param document_number: Document number associated with the opportunity to filter products.
         :return: QuerySet of available products that are not assigned to the task mapping.
         """
-        all_products = PreliminaryMaterialList.objects.filter(opportunity__document_number=document_number)
-
-        assigned_item_codes = AssignedProduct.objects.filter(task_mapping__id=task_mapping_id).values_list(
-            "item_code", flat=True
-        )
+        assigned_item_codes = AssignedProduct.objects.filter(
+            task_mapping__id=task_mapping_id, item_code__isnull=False
+        ).values("item_code")
 
-        assigned_product_ids = list(map(str, assigned_item_codes)) if assigned_item_codes else []
-
-        available_products = all_products.exclude(item_number__in=assigned_product_ids)
+        available_products = PreliminaryMaterialList.objects.filter(
+            opportunity__document_number=document_number
+        ).exclude(item_number__in=assigned_item_codes)
 
         return available_products
 
     def post(self, request, *args, **kwargs) -> JsonResponse:
+        """
+        Assign the selected preliminary materials to the task, see `assign_products`.
 
+        :return: JsonResponse with the fragment of the task, see `render_task_fragments`.
+        """
         data = json.loads(request.POST.get("items", "[]"))
-        document_number = self.kwargs["document_number"]
         task_id = self.kwargs.get("task_id")
 
         try:
-            task_mapping_obj = TaskMapping.objects.get(id=task_id)
+            task_mapping_obj = TaskMapping.objects.select_related("task").get(id=task_id)
         except TaskMapping.DoesNotExist:
             LOGGER.error("Task Mapping does not exist")
             return JsonResponse(ERROR_RESPONSE, status=404)
 
-        created_products = []
-        errors = []
-
-        for item in data:
-            internal_id = item.get("internal_id")
-            try:
-                prod_obj = PreliminaryMaterialList.objects.get(
-                    opportunity__document_number=document_number, item_number=internal_id
-                )
-                prod = Product.objects.filter(display_name=prod_obj.item_number).first()
-
-                assigned_product = AssignedProduct(
-                    task_mapping=task_mapping_obj,
-                    quantity=prod_obj.combined_quantities_from_both_import,
-                    item_code=prod_obj.item_number,
-                    description=prod_obj.description,
-                    standard_cost= prod.std_cost if prod else 0,
-                    is_assign=True,
-                )
-                assigned_product.save()
-                created_products.append(assigned_product.id)
-
-            except PreliminaryMaterialList.DoesNotExist:
-                errors.append({"internal_id": internal_id, "error": "Product not found"})
-            except Exception as e:
-                LOGGER.error(f"{str(e)}")
-                errors.append({"internal_id": internal_id, "error": ERROR_RESPONSE["message"]})
+        try:
+            result = assign_products(task_mapping_obj, [item.get("internal_id") for item in data])
+        except Exception as e:
+            LOGGER.error(f"{str(e)}")
+            return JsonResponse(ERROR_RESPONSE, status=500)
 
-        if errors:
-            return JsonResponse({"status": "error", "errors": errors}, status=404)
+        if result["errors"]:
+            return JsonResponse({"status": "error", "errors": result["errors"]}, status=404)
 
         task_name = task_mapping_obj.code or task_mapping_obj.task.name
-        # messages.success(self.request, f'Product assigned for "{task_name}" successfully!')
-        opportunity = get_object_or_404(Opportunity, document_number=document_number)
-        data = TaskMappingTable.generate_table(opportunity)
-
-        # Render the updated HTML for the task mapping table
-        html = render(request, "proposal/opportunity/stage/task_mapping/tasks.html", data)
 
         return JsonResponse(
             {
                 "status": "success",
                 "message": f'Product assigned for "{task_name}" successfully!',
-                "created_products": created_products,
-                "html": html.content.decode("utf-8"),
+                "created_products": result["created"],
+                **render_task_fragments(request, [task_mapping_obj.id]),
             }
         )
 
@@ -110,13 +145,18 @@ class AssignProdLabor(TemplateViewMixin):
         document_number = self.kwargs["document_number"]
         task_mapping_id = self.kwargs["task_id"]
         
-        products = self._get_products_data(task_mapping_id, document_number)
+        products = list(self._get_products_data(task_mapping_id, document_number))
+
+        # Split the materials that match a product with one query, keeping the standard cost of the valid ones
+        catalog = Product.get_by_display_name(product.item_number for product in products)
 
         valid_products = []
         non_valid_products = []
 
         for product in products:
-            if Product.objects.filter(display_name=product.item_number).exists():
+            catalog_product = catalog.get(display_name_key(product.item_number))
+            product.std_cost = catalog_product.std_cost if catalog_product else None
+            if catalog_product:
                 valid_products.append(product)
             else:
                 non_valid_products.append(product)
@@ -190,26 +230,24 @@ class UpdateAssignProdView(ViewMixin):
         :return: Response data indicating success or failure.
         """
         try:
-            rows = {}
-
-            for key, value in data.items():
-                if key.startswith("rows["):
-                    row_index = key.split("[")[1].split("]")[0]
-                    field_name = key.split("[")[2].split("]")[0]
-
-                    if row_index not in rows:
-                        rows[row_index] = {}
-                    rows[row_index][field_name] = value[0].strip()
-
-            for index, row in rows.items():
-                assigned_prod_obj = AssignedProduct.objects.get(id=row.get("assign_prod_id"))
-                for field, value in row.items():
-                    if field in ["quantity", "vendor_quoted_cost", "standard_cost"]:
-                        setattr(assigned_prod_obj, field, value)
-                        assigned_prod_obj.save()
+            result = bulk_edit_assigned_products(
+                parse_rows(data), ("quantity", "standard_cost", "vendor_quoted_cost"), id_field="assign_prod_id"
+            )
+            if result["errors"]:
+                error = result["errors"][0]
+                return {
+                    "status": "error",
+                    "message": f"{error['field'].replace('_', ' ').capitalize()}: {error['error']}",
+                    "errors": result["errors"],
+                }
 
             messages.success(self.request, "Updated Successfully")
-            return {"status": "success", "type": "bulk_update", "message": "Product updated successfully"}
+            return {
+                "status": "success",
+                "type": "bulk_update",
+                "message": "Product updated successfully",
+                "totals": result["totals"],
+            }
 
         except Exception as e:
             LOGGER.error(f"[UpdateAssignProdView][bulk_update] {e}")
@@ -238,7 +276,8 @@ class UpdateAssignProdView(ViewMixin):
 
             # response["html"] = html.content.decode('utf-8')
 
-            return JsonResponse(response)
+            # The rejected bulk updates are reported to the error handler of the edit forms
+            return JsonResponse(response, status=400 if response.get("errors") else 200)
 
         except json.JSONDecodeError:
             LOGGER.error("Invalid JSON")
@@ -278,7 +317,8 @@ class AddProdRowView(ViewMixin):
                 task_data["task_id"] = task_id
                 result[task_id].append(task_data)
 
-        overall_data_saved = False
+        # IDs of the tasks with saved rows, only these tasks are re-rendered
+        saved_task_ids = []
 
         for task_id, products in result.items():
             try:
@@ -292,13 +332,15 @@ class AddProdRowView(ViewMixin):
                         response = self._save_product(task_mapping, product)
                         if response:
                             return response  # Return warning if any required field is missing
-                        overall_data_saved = True
+                        if task_mapping.id not in saved_task_ids:
+                            saved_task_ids.append(task_mapping.id)
 
                     elif product.get("task_name"):
                         response = self._save_labor(task_mapping, product)
                         if response:
                             return response  # Return warning if any required field is missing
-                        overall_data_saved = True
+                        if task_mapping.id not in saved_task_ids:
+                            saved_task_ids.append(task_mapping.id)
 
             except TaskMapping.DoesNotExist:
                 return {
@@ -307,14 +349,12 @@ class AddProdRowView(ViewMixin):
                     "code": 404,
                 }
 
-        if overall_data_saved:
+        if saved_task_ids:
             try:
-                data = TaskMappingTable.generate_table(task_mapping.opportunity)
-                html = render(self.request, "proposal/opportunity/stage/task_mapping/task_table.html", data)
                 return {
                     "status": "success",
                     "message": "Task added successfully",
-                    "html": html.content.decode("utf-8"),
+                    **render_task_fragments(self.request, saved_task_ids),
                 }
             except Exception as e:
                 return {
@@ -656,7 +696,8 @@ class AddTaskView(ViewMixin):
         :param request: The HTTP request object containing form data.
         :param args: Additional positional arguments.
         :param kwargs: Additional keyword arguments.
-        :return: JSON response indicating success or error status.
+        :return: JSON response indicating success or error status, with the fragments of the new tasks (see
+            `render_task_fragments`).
         """
         tasks = request.POST.getlist("task")
         description = request.POST.get("description")
@@ -668,6 +709,7 @@ class AddTaskView(ViewMixin):
         opportunity = get_object_or_404(Opportunity, document_number=document_number)
 
         available_tasks = TaskMapping.objects.filter(opportunity=opportunity)
+        created_task_ids = []
         for task_name in tasks:
             task_instance = get_object_or_404(Task, name=task_name)
             if description:
@@ -691,19 +733,15 @@ class AddTaskView(ViewMixin):
                     }
                 )
 
-            TaskMapping.objects.create(**task_mapping_data)
-
-        data = TaskMappingTable.generate_table(opportunity)
-
-        # Render the updated HTML for the task mapping table
-        html = render(request, "proposal/opportunity/stage/task_mapping/task_table.html", data)
+            created_task_ids.append(TaskMapping.objects.create(**task_mapping_data).id)
 
+        # Render the new tasks only, the page inserts them in the task mapping table
         # messages.success(request, "Tasks added successfully!")
         return JsonResponse(
             {
                 "status": "Created",
                 "message": "Task added successfully",
-                "html": html.content.decode("utf-8"),
+                **render_task_fragments(request, created_task_ids, fragment="block"),
             },
             status=201,
         )
@@ -719,273 +757,27 @@ class AddTaskView(ViewMixin):
         return render(self.request, self.template_name, context, **response_kwargs)
 
 
-class TaskMappingData:
-
-    @staticmethod
-    def _get_total_tasks(document_number: str) -> int:
-        """
-        Returns the total number of tasks.
-
-        :param document_number: The document number to filter task mappings.
-        """
-        task_mapping_obj = TaskMapping.objects.filter(opportunity__document_number=document_number)
-        return len(task_mapping_obj)
-
-    @staticmethod
-    def _get_tasks(document_number: str) -> dict:
-        """
-        Retrieve tasks and their assigned products for a given document number.
-
-        :param document_number: The document number to filter task mappings.
-        :return: A dictionary with task details, including total quantities, prices, and profit percentages.
-        """
-        task_mappings = TaskMapping.objects.filter(opportunity__document_number=document_number)
-        filtered_task_mappings = task_mappings.exclude(task__description__icontains="labor")
-        task_mapping_ids = filtered_task_mappings.values_list("id", flat=True)
-
-        try:
-            assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids).order_by(
-                "sequence"
-            )
-
-        except Exception as e:
-            LOGGER.error(f"assigned_products Exception : {e}")
-            assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids)
-
-        tasks_with_products = {}
-
-        for task in filtered_task_mappings:
-            task_assigned_products = assigned_products.filter(task_mapping_id=task.id)
-
-            total_quantity = sum(product.quantity for product in task_assigned_products)
-            total_price = sum(
-                (
-                    product.vendor_quoted_cost * product.quantity
-                    if product.vendor_quoted_cost
-                    else product.standard_cost * product.quantity
-                )
-                for product in task_assigned_products
-            )
-            total_unit_price = sum(
-                product.vendor_quoted_cost if product.vendor_quoted_cost else product.standard_cost
-                for product in task_assigned_products
-            )
-
-            total_percent = sum(product.gross_profit_percentage for product in task_assigned_products)
-
-            tasks_with_products[task.id] = {
-                "task": task,
-                "assigned_products": task_assigned_products,
-                "total_quantity": round(total_quantity, 2),
-                "total_price": round(total_price, 2),
-                "total_unit_price": round(total_unit_price, 2),
-                "total_percent": round(total_percent, 2),
-            }
-
-        return tasks_with_products
-
-    @staticmethod
-    def _get_task_total(document_number: str) -> dict:
-        """
-        Calculate total quantities and prices for tasks associated with a document number.
-
-        :param document_number: The document number to filter task mappings.
-        :return: A dictionary with grand total quantity and price.
-        """
-        task_mappings = TaskMapping.objects.filter(opportunity__document_number=document_number)
-        filtered_task_mappings = task_mappings.exclude(task__description__icontains="labor")
-        task_mapping_ids = filtered_task_mappings.values_list("id", flat=True)
-
-        assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids)
-
-        tasks_with_products = {}
-
-        for task in filtered_task_mappings:
-            task_assigned_products = assigned_products.filter(task_mapping_id=task.id)
-
-            total_quantity = sum(product.quantity for product in task_assigned_products)
-            total_price = sum(
-                (
-                    (
-                        product.vendor_quoted_cost if product.vendor_quoted_cost is not None and product.vendor_quoted_cost != 0
-                        else (product.standard_cost if product.standard_cost is not None else 0)
-                    )
-                    * product.quantity
-                )
-                for product in task_assigned_products
-            )
-
-            tasks_with_products[task.id] = {
-                "total_quantity": total_quantity,
-                "total_price": total_price,
-            }
-
-        # Calculate grand total price and quantity
-        grand_total_price = sum(v["total_price"] for v in tasks_with_products.values())
-        grand_total_quantity = sum(v["total_quantity"] for v in tasks_with_products.values())
-
-        total_data = {
-            "grand_total_price": round(grand_total_price, 2),
-            "grand_total_quantity": round(grand_total_quantity, 2),
-        }
-        return total_data
-
-    @staticmethod
-    def _get_labour_tasks(document_number: str) -> dict:
-        """
-        Retrieve labor tasks and their assigned products for a given document number.
-
-        :param document_number: The document number to filter task mappings.
-        :return: A dictionary containing labor task details, including total quantities, prices, and profit percentages.
-        """
-        task_mappings = TaskMapping.objects.filter(opportunity__document_number=document_number)
-        filtered_task_mappings = task_mappings.filter(task__description__icontains="labor")
-        task_mapping_ids = filtered_task_mappings.values_list("id", flat=True)
-
-        try:
-            assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids).order_by(
-                "sequence"
-            )
-        except Exception as e:
-            LOGGER.error(f"error: {e}")
-            assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids)
-
-        tasks_with_products = {}
-
-        for task in filtered_task_mappings:
-            task_assigned_products = assigned_products.filter(task_mapping_id=task.id)
-
-            total_quantity = sum(product.quantity for product in task_assigned_products)
-            total_price = sum(
-                (
-                    product.vendor_quoted_cost * product.quantity
-                    if product.vendor_quoted_cost
-                    else product.standard_cost * product.quantity
-                )
-                for product in task_assigned_products
-            )
-            total_unit_price = sum(
-                product.vendor_quoted_cost if product.vendor_quoted_cost else product.standard_cost
-                for product in task_assigned_products
-            )
-
-            total_percent = sum(product.gross_profit_percentage for product in task_assigned_products)
-
-            tasks_with_products[task.id] = {
-                "task": task,
-                "assigned_products": task_assigned_products,
-                "total_quantity": round(total_quantity, 2),
-                "total_price": round(total_price, 2),
-                "total_unit_price": round(total_unit_price, 2),
-                "total_percent": round(total_percent, 2),
-            }
-
-        return tasks_with_products
-
-    @staticmethod
-    def _get_labor_task_total(document_number: str) -> dict:
-        """
-        Calculate total quantities and prices for labor tasks associated with a document number.
-
-        :param document_number: The document number to filter task mappings.
-        :return: A dictionary with grand total quantity and price for labor tasks.
-        """
-        task_mappings = TaskMapping.objects.filter(opportunity__document_number=document_number)
-        filtered_task_mappings = task_mappings.filter(task__description__icontains="labor")
-        task_mapping_ids = filtered_task_mappings.values_list("id", flat=True)
-
-        assigned_products = AssignedProduct.objects.filter(task_mapping_id__in=task_mapping_ids)
-
-        tasks_with_products = {}
-
-        for task in filtered_task_mappings:
-            task_assigned_products = assigned_products.filter(task_mapping_id=task.id)
-
-            total_quantity = sum(product.quantity for product in task_assigned_products)
-            total_price = sum(
-                (
-                    (
-                        product.vendor_quoted_cost if product.vendor_quoted_cost is not None and product.vendor_quoted_cost != 0
-                        else (product.standard_cost if product.standard_cost is not None else 0)
-                    )
-                    * product.quantity
-                )
-                for product in task_assigned_products
-            )
-
-            tasks_with_products[task.id] = {
-                "total_quantity": total_quantity,
-                "total_price": total_price,
-            }
-
-        # Calculate grand total price correctly
-        grand_total_price = sum(v["total_price"] for v in tasks_with_products.values())
-        grand_total_quantity = sum(v["total_quantity"] for v in tasks_with_products.values())
-
-        total_data = {
-            "grand_total_price": round(grand_total_price, 2),
-            "grand_total_quantity": round(grand_total_quantity, 2),
-        }
-        return total_data
-
-
 class UpdateSequenceView(ViewMixin):
     """Update sequence of rows."""
 
-    def __update_sequence(self, body: bytes) -> None:
+    def __update_sequence(self, body: bytes) -> dict:
         """
         Updates the sequence field for each row in the provided data.
         :prams:body (bytes): The JSON-encoded request body containing sequence data.
+        :return: Result of the bulk edition, see `bulk_edit_assigned_products`.
         """
         data = json.loads(body)
-        sequence_data = data.get("sequence", [])
-
-        for item in sequence_data:
-            row_id = item.get("id")
-            new_sequence = item.get("sequence")
-
-            if row_id:
-                AssignedProduct.objects.filter(id=row_id).update(sequence=new_sequence)
+        return bulk_edit_assigned_products(data.get("sequence", []), ("sequence",))
 
     def post(self, request, *args, **kwargs):
         """POST request to update sequence"""
         try:
-            self.__update_sequence(request.body)
+            result = self.__update_sequence(request.body)
+            if result["errors"]:
+                return JsonResponse(
+                    {"status": "error", "message": "Invalid sequence", "errors": result["errors"]}, status=400
+                )
             return JsonResponse({"status": "success", "message": "Sequence updated successfully"})
 
         except Exception:
             return JsonResponse({"status": "error", "message": ERROR_RESPONSE}, status=400)
-
-
-class TaskMappingTable:
-
-    @staticmethod
-    def generate_table(opportunity):
-        total_tasks = TaskMappingData._get_total_tasks(opportunity.document_number)
-        task_mapping_list = TaskMappingData._get_tasks(opportunity.document_number)
-        task_mapping_labor_list = TaskMappingData._get_labour_tasks(opportunity.document_number)
-        grand_total = TaskMappingData._get_task_total(opportunity.document_number)
-        labor_task_total = TaskMappingData._get_labor_task_total(opportunity.document_number)
-
-        data = {
-            "total_tasks": total_tasks,
-            "task_mapping_list": task_mapping_list,
-            "task_mapping_labor_list": task_mapping_labor_list,
-            "grand_total": grand_total,
-            "labor_task_total": labor_task_total,
-            "opportunity": opportunity,
-        }
-        return data
-
-
-class ProposalTable:
-
-    @staticmethod
-    def generate_table(opportunity):
-        """Generate proposal table"""
-        grouped_proposals = ProposalCreationData._get_proposal_creation(opportunity.document_number)
-        proposal_total = ProposalCreationData._get_proposal_totals(opportunity.document_number)
-
-        data = {"grouped_proposals": grouped_proposals, "proposal_total": proposal_total, "opportunity": opportunity}
-
-        return data
\ No newline at end of file
@@ -1,16 +1,26 @@
+import codecs
 import csv
 import math
 import re
-from collections import defaultdict
-from io import StringIO
-from typing import Optional
+from collections import Counter, defaultdict
+from functools import lru_cache
+from itertools import islice
+from typing import Callable, Iterable, Iterator, Optional
 
+import numpy as np
 import pandas as pd
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from celery.result import AsyncResult
+from django.core import signing
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
 from django.http import JsonResponse
+from django.urls import reverse
+from kombu.exceptions import OperationalError
 
-from apps.constants import LOGGER
+from apps.constants import BULK_CREATE_BATCH_SIZE, ERROR_RESPONSE, LOGGER
 from apps.mixin import ViewMixin
+from apps.proposal.product.formula import FormulaError, compile_formula
 from apps.proposal.product.models import AdditionalMaterials, Product
 
 from ..models import (
@@ -19,191 +29,345 @@ from ..models import (
     Opportunity,
     PreliminaryMaterialList,
 )
+from ..tasks import process_cad_file as process_cad_file_task
+
+# Salt and lifetime (in seconds) of the signed job tokens of the status URL, see `UploadCADFileStatus`
+CAD_FILE_JOB_SALT = "opportunity.upload-cad-file"
+CAD_FILE_JOB_MAX_AGE = 24 * 60 * 60
+
+# Joints per pint of glue by pipe size, the rows of the mains & manifold table (see `calculate_mains_manifold`)
+JOINTS_PER_PINT = {
+    24: 0.0625,
+    21: 0.125,
+    20: 0.125,
+    18.7: 0.25,
+    15: 0.375,
+    12: 0.5,
+    10: 1,
+    8: 2,
+    6: 5,
+    5: 10,
+    4: 15,
+    3: 20,
+    2.5: 25,
+    2: 30,
+}
+
+# Columns of the material list DataFrame counted by `calculate_mains_manifold`
+MAINS_MANIFOLD_COLUMNS = ("form1", "form4", "CROSS", "Tee's", "RED BUSH & COUPS")
+# `form4` fittings followed by a pipe size, e.g. "ELB 2" (the lookahead finds overlapping fittings like "MA" in "FMA")
+MAINS_MANIFOLD_FITTINGS = ("CRO", "TEE", "ELB", "COU", "RED", "FLA", "CAP", "FA", "MA")
+FITTING_PATTERN = re.compile(f"(?=({'|'.join(MAINS_MANIFOLD_FITTINGS)}) )", flags=re.IGNORECASE)
+PIPE_PATTERN = re.compile("PIPE", flags=re.IGNORECASE)
+PIPE_END_PATTERN = re.compile(" SW| BE", flags=re.IGNORECASE)
 
 
 class UploadCADFile(ViewMixin):
     """View for handling the upload of CAD files and processing material lists."""
 
-    def generate_material_list(self, uploaded_file: InMemoryUploadedFile, document_number: str) -> dict:
+    @staticmethod
+    def read_lines(uploaded_file: File) -> Iterator[str]:
         """
-        Generates material list from an uploaded file.
+        Read the lines of an uploaded file one chunk at a time.
 
-        :param uploaded_file: Uploaded file object (InMemoryUploadedFile).
-        :param document_number: Document number for the associated opportunity.
-        :return: Dictionary containing the material list data.
+        NOTE: Each line is decoded as UTF-8, falling back to Latin-1 for lines exported with a Windows code
+        page, so only one chunk and the current line are held in memory.
+
+        :param uploaded_file: Uploaded CAD file.
+        :return: Iterator over the decoded lines, line endings included.
         """
-        material_list_obj = MaterialList.objects.filter(opportunity__document_number=document_number)
+        remainder = b""
+        for index, chunk in enumerate(uploaded_file.chunks()):
+            if index == 0 and chunk.startswith(codecs.BOM_UTF8):
+                chunk = chunk[len(codecs.BOM_UTF8) :]
 
-        if len(material_list_obj) != 0:
-            MaterialList.objects.filter(opportunity__document_number=document_number).delete()
-            GlueAndAdditionalMaterial.objects.filter(opportunity__document_number=document_number).delete()
-            PreliminaryMaterialList.objects.filter(opportunity__document_number=document_number).delete()
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+            for line in lines:
+                yield UploadCADFile._decode(line + b"\n")
 
-        data = {"Quantity": [], "Description": [], "Item Number": []}
+        if remainder:
+            yield UploadCADFile._decode(remainder)
 
-        # Get the opportunity instance to save the material list data
+    @staticmethod
+    def _decode(line: bytes) -> str:
         try:
-            opportunity = Opportunity.objects.get(document_number=document_number)
-        except Opportunity.DoesNotExist:
-            LOGGER.error(f"Opportunity with document number {document_number} not found.")
-            return data
+            return line.decode("utf-8")
+        except UnicodeDecodeError:
+            return line.decode("latin-1")
 
-        # Read the file content
-        file_content = uploaded_file.read().decode("utf-8")
-        file_like_object = StringIO(file_content)
+    def read_cad_file(self, uploaded_file: File) -> Iterator[tuple]:
+        """
+        Parse the `quantity,description,item number` rows of a CAD file (.tmp or .txt export).
 
-        reader = csv.reader(file_like_object)
-        for row in reader:
+        :param uploaded_file: Uploaded CAD file.
+        :return: Iterator over `(quantity, description, item_number)` tuples, rows without 3 columns are skipped.
+        """
+        for row in csv.reader(self.read_lines(uploaded_file)):
             if len(row) != 3:
                 continue
 
             quantity, description, item_number = row
-                        
+
             try:
                 quantity = float(quantity)
             except ValueError:
-                quantity = 0 
+                quantity = 0.0
 
-            # Append the values to the corresponding lists in the dictionary
-            data["Quantity"].append(float(quantity))
-            data["Description"].append(description)
-            data["Item Number"].append(item_number)
+            yield quantity, description, item_number
 
-            # Save data into the database
-            MaterialList.objects.create(
-                opportunity=opportunity, quantity=float(quantity), description=description, item_number=item_number
-            )
-        return data
+    def generate_material_list(self, uploaded_file: File) -> dict:
+        """
+        Generates material list from an uploaded file, with one row per item number.
 
-    def apply_transformations(self, row: pd.Series) -> pd.Series:
-        """Helper function to generate rows with calculations for Material List."""
-        description = row["Description"]
+        NOTE: The lines are aggregated while the file is streamed, so memory grows with the number of distinct
+        items rather than the number of lines. An item keeps the description of its first line and the total of
+        its quantities. "Line Quantities" counts its lines by quantity, for the per-line formulas of the
+        Glue & Additional Material List, and "Last Quantities" maps each (stripped) item number to the quantity
+        of its last line, for the Preliminary Material List. The saved Material List keeps one row per line,
+        see `save_material_lists`.
 
-        # Formula for form1
-        form1 = description.replace('"', "")
+        :param uploaded_file: Uploaded CAD file.
+        :return: Dictionary containing the material list data.
+        """
+        items = {}
+        last_quantities = {}
+
+        for quantity, description, item_number in self.read_cad_file(uploaded_file):
+            item = items.get(item_number)
+            if item is None:
+                item = items[item_number] = {"Quantity": 0.0, "Description": description, "Lines": Counter()}
+            item["Quantity"] += quantity
+            item["Lines"][quantity] += 1
+            last_quantities[item_number.strip()] = quantity
+
+        return {
+            "Quantity": [item["Quantity"] for item in items.values()],
+            "Description": [item["Description"] for item in items.values()],
+            "Item Number": list(items),
+            "Line Quantities": [item["Lines"] for item in items.values()],
+            "Last Quantities": last_quantities,
+        }
+
+    def apply_transformations(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Generate the ['form1', 'form2', 'form3', 'form4'] columns of the Material List.
+
+        NOTE: form2 and form3 are the 2 and 5 characters before the first quote, sliced like the previous per-row
+        `description[quote_index - 5 : quote_index]`: a negative start counts from the end, so only a description
+        shorter than 5 characters has characters before a quote in its first 5 (e.g. 'ab"c' gives "b").
+
+        :param df: Material list DataFrame with a "Description" column.
+        :return: DataFrame with the four form columns, aligned with `df`.
+        """
+        description = df["Description"].astype(str)
+        head = description.str[:3]
+
+        # Text before the first quote, NaN without a quote
+        before_quote = description.str.extract(r'^([^"]*)"', flags=re.DOTALL, expand=False)
+        has_quote = before_quote.notna()
+        quote_index = before_quote.str.len()
 
         # Formula for form2
-        if '"' in description:
-            quote_index = description.find('"')
-            form2 = description[:3] + description[quote_index - 2 : quote_index]
-        else:
-            form2 = description[:3]  # fallback if no quote found
+        form2 = head.copy()
+        form2[has_quote] = head + before_quote.str[-2:].where(quote_index >= 2, "")
 
         # Formula for form3
-        if '"' in description:
-            quote_index = description.find('"')
-            form3 = description[quote_index - 5 : quote_index].replace("  ", " ")
-        else:
-            form3 = description  # fallback if no quote found
+        form3 = description.copy()
+        form3[has_quote] = before_quote.str[-5:].where(quote_index >= 5, "")
+        wrapped = has_quote & (quote_index < 5) & (description.str.len() < 5)
+        form3[wrapped] = [
+            value[max(len(value) + index - 5, 0) : index]
+            for value, index in zip(description[wrapped], quote_index[wrapped].astype(int))
+        ]
+        form3[has_quote] = form3[has_quote].str.replace("  ", " ", regex=False)
+
+        # Formula for form4: up to 10 characters after the first space of form3
+        after_space = form3.str.extract(r"^[^ ]* (.{0,10})", flags=re.DOTALL, expand=False)
+        form4 = (head + " " + after_space.str.strip()).where(after_space.notna(), head)
 
-        # Formula for form4
-        if " " in form3:
-            space_index = form3.find(" ")
-            form4 = description[:3] + " " + form3[space_index + 1 : space_index + 11].strip()
-        else:
-            form4 = description[:3]  # fallback if no space found in form3
+        return pd.DataFrame(
+            {"form1": description.str.replace('"', "", regex=False), "form2": form2, "form3": form3, "form4": form4},
+            index=df.index,
+            dtype=object,
+        )
 
-        return pd.Series([form1, form2, form3, form4], index=["form1", "form2", "form3", "form4"])
+    def calculate_additional_columns(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Generate the ["Tee's", 'RED BUSH & COUPS', 'CROSS', 'Hose'] columns of the Material List.
 
-    def calculate_additional_columns(self, row: pd.Series) -> pd.Series:
-        """Helper function to generate rows with calculations for Material List."""
+        :param df: Material list DataFrame with the "Description", "form1" and "form3" columns.
+        :return: DataFrame with the four columns, aligned with `df`.
+        """
+        description = df["Description"].astype(str)
+        form1 = df["form1"]
+        form3 = df["form3"]
 
-        description = row["Description"]
-        form1 = row["form1"]
-        form3 = row["form3"]
+        # Up to 4 characters after the first "X " (description.find("X ") + 2)
+        after_x = description.str.extract(r"X (.{0,4})", flags=re.DOTALL, expand=False).str.strip()
+        form1_after_x = form1.str.extract(r"X (.{0,4})", flags=re.DOTALL, expand=False).str.strip()
+        # Up to 3 characters after the first space of form3
+        form3_after_space = form3.str.extract(r"^[^ ]* (.{0,3})", flags=re.DOTALL, expand=False).str.strip()
+        last_x_part = description.str.rsplit("X ", n=1).str[-1]
 
         # Extract 'Tee's'
-        if "TEE" in description:
-            if "X " in description:
-                start_index = description.find("X ") + 2
-                tee_value = description[start_index : start_index + 4].strip()
-            else:
-                tee_value = description.split(" ")[-1].strip()
-        else:
-            tee_value = "ERR"
+        tee_value = pd.Series("ERR", index=df.index, dtype=object)
+        is_tee = description.str.contains("TEE", regex=False)
+        tee_value[is_tee] = after_x.where(after_x.notna(), description.str.rsplit(" ", n=1).str[-1].str.strip())[is_tee]
 
         # Extract 'RED BUSH & COUPS'
-        if "RED BUSH" in description:
-            red_bush_value = description.split("X ")[-1].split("SPXS")[0].strip()
-        elif "RED COUP" in description:
-            red_bush_value = description.split("X ")[-1].strip()
-        else:
-            red_bush_value = "IFERR"
+        red_bush_value = pd.Series("IFERR", index=df.index, dtype=object)
+        is_red_coup = description.str.contains("RED COUP", regex=False)
+        is_red_bush = description.str.contains("RED BUSH", regex=False)
+        red_bush_value[is_red_coup] = last_x_part.str.strip()[is_red_coup]
+        red_bush_value[is_red_bush] = last_x_part.str.split("SPXS", n=1).str[0].str.strip()[is_red_bush]
 
         # Extract 'CROSS'
-        if "CROSS" in form1:
-            if "X " in form1:
-                start_index = form1.find("X ") + 2
-                cross_value = form1[start_index : start_index + 4].strip()
-            else:
-                if " " in form3:
-                    space_index = form3.find(" ")
-                    cross_value = form3[space_index + 1 : space_index + 4].strip()
-                else:
-                    cross_value = "ERR"
-        else:
-            cross_value = "ERR"
+        cross_value = pd.Series("ERR", index=df.index, dtype=object)
+        is_cross = form1.str.contains("CROSS", regex=False)
+        cross_value[is_cross] = form1_after_x.where(form1_after_x.notna(), form3_after_space).fillna("ERR")[is_cross]
 
         # Extract 'Hose'
-        hose_value = description[:14].strip()
+        hose_value = description.str[:14].str.strip()
 
-        return pd.Series(
-            [tee_value, red_bush_value, cross_value, hose_value], index=["Tee's", "RED BUSH & COUPS", "CROSS", "Hose"]
+        return pd.DataFrame(
+            {"Tee's": tee_value, "RED BUSH & COUPS": red_bush_value, "CROSS": cross_value, "Hose": hose_value},
+            index=df.index,
         )
 
-    def calculate_mains_manifold(self, df: pd.DataFrame, pipe_size: float, joints_per_pint: float) -> dict:
-        """Helper function to generate rows with calculations for Glue & Additional Material List."""
+    def calculate_mains_manifold(self, df: pd.DataFrame, joints_per_pint_values: dict) -> list:
+        """
+        Helper function to generate rows with calculations for Glue & Additional Material List.
 
-        # Filters based on pipe size and type
-        solvent_weld_pipe = df[
-            df["form1"].str.contains(f"PIPE.*{pipe_size} SW", case=False, na=False)
-            | df["form1"].str.contains(f"PIPE.*{pipe_size} BE", case=False, na=False)
-        ]
+        Each distinct value of the matched columns is scanned once for the fittings it mentions (see
+        `fitting_sizes`), then the quantities are summed per fitting and pipe size with one groupby.
+
+        :param df: Material list DataFrame with the form and fitting columns.
+        :param joints_per_pint_values: Dictionary of `{pipe_size: joints_per_pint}`, in output order, e.g.
+            `JOINTS_PER_PINT`.
+        :return: A list with the mains & manifold row of each pipe size.
+        """
+        fitting_sizes = self.fitting_sizes(joints_per_pint_values)
 
-        # Cross joints calculation using the formula provided
-        cross_joints_from_form4 = df[df["form4"].str.contains(f"CRO {pipe_size}", case=False, na=False)][
-            "Quantity"
-        ].sum()
-        cross_joints_from_cross = df[df["CROSS"].str.contains(f"{pipe_size}", case=False, na=False)]["Quantity"].sum()
-        cross_joints_sum = (cross_joints_from_form4 + cross_joints_from_cross) * 2
-
-        # Tee joints calculation
-        tee_joints_formula = (
-            df[df["form4"].str.contains(f"TEE {pipe_size}", case=False, na=False)]["Quantity"].sum() * 2
-        ) + df[df["Tee's"].str.contains(f"{pipe_size}", case=False, na=False)]["Quantity"].sum()
-
-        # Elbow, Coupler, RB, RC Joints calculation
-        elbow_coupler_rb_rc_joints = (
-            df[df["form4"].str.contains(f"ELB {pipe_size}", case=False, na=False)]["Quantity"].sum() * 2
-            + df[df["form4"].str.contains(f"COU {pipe_size}", case=False, na=False)]["Quantity"].sum() * 2
-            + df[df["form4"].str.contains(f"RED {pipe_size}", case=False, na=False)]["Quantity"].sum()
-            + df[df["form4"].str.contains(f"FLA {pipe_size}", case=False, na=False)]["Quantity"].sum()
-            + df[df["form4"].str.contains(f"CAP {pipe_size}", case=False, na=False)]["Quantity"].sum()
-            + df[df["form4"].str.contains(f"FA {pipe_size}", case=False, na=False)]["Quantity"].sum()
-            + df[df["form4"].str.contains(f"MA {pipe_size}", case=False, na=False)]["Quantity"].sum()
-            + df[df["RED BUSH & COUPS"].str.contains(f"{pipe_size}", case=False, na=False)]["Quantity"].sum()
+        records = []
+        for column in MAINS_MANIFOLD_COLUMNS:
+            for value, quantity in df.groupby(column, sort=False)["Quantity"].sum().items():
+                records.extend((fitting, size, quantity) for fitting, size in fitting_sizes(column, value))
+
+        joints = (
+            pd.DataFrame(records, columns=["fitting", "size", "quantity"])
+            .groupby(["fitting", "size"])["quantity"]
+            .sum()
         )
 
-        # Sum quantities
-        solvent_weld_pipe_sum = solvent_weld_pipe["Quantity"].sum()
-        cross_joints_sum = cross_joints_sum
-        tee_joints_sum = tee_joints_formula
-        elbow_coupler_rb_rc_joints_sum = elbow_coupler_rb_rc_joints
-        total_joints = (solvent_weld_pipe_sum / 20) + cross_joints_sum + tee_joints_sum + elbow_coupler_rb_rc_joints_sum
-        pints = total_joints / joints_per_pint
-        thrust_block_conc_bags = 0
+        results = []
+
+        for pipe_size, joints_per_pint in joints_per_pint_values.items():
 
-        return {
-            "Pipe Size": pipe_size,
-            "Solvent Weld Pipe": solvent_weld_pipe_sum,
-            "Cross Joints": cross_joints_sum,
-            "Tee Joints": tee_joints_sum,
-            "Elbow, Coupler, RB, RC Joints": elbow_coupler_rb_rc_joints_sum,
-            "TOTAL JOINTS": total_joints,
-            "JOINTS PER PINT": joints_per_pint,
-            "PINTS": round(pints, 1),
-            "Thrust Block # Conc. Bags": thrust_block_conc_bags,
-        }
+            def quantity(fitting: str) -> float:
+                return float(joints.get((fitting, pipe_size), 0))
+
+            # Filters based on pipe size and type
+            solvent_weld_pipe_sum = quantity("PIPE")
+
+            # Cross joints calculation using the formula provided
+            cross_joints_sum = (quantity("CRO") + quantity("CROSS")) * 2
+
+            # Tee joints calculation
+            tee_joints_sum = quantity("TEE") * 2 + quantity("Tee's")
+
+            # Elbow, Coupler, RB, RC Joints calculation
+            elbow_coupler_rb_rc_joints_sum = (
+                quantity("ELB") * 2
+                + quantity("COU") * 2
+                + quantity("RED")
+                + quantity("FLA")
+                + quantity("CAP")
+                + quantity("FA")
+                + quantity("MA")
+                + quantity("RED BUSH & COUPS")
+            )
+
+            total_joints = (
+                (solvent_weld_pipe_sum / 20) + cross_joints_sum + tee_joints_sum + elbow_coupler_rb_rc_joints_sum
+            )
+            pints = total_joints / joints_per_pint
+            thrust_block_conc_bags = 0
+
+            results.append(
+                {
+                    "Pipe Size": pipe_size,
+                    "Solvent Weld Pipe": solvent_weld_pipe_sum,
+                    "Cross Joints": cross_joints_sum,
+                    "Tee Joints": tee_joints_sum,
+                    "Elbow, Coupler, RB, RC Joints": elbow_coupler_rb_rc_joints_sum,
+                    "TOTAL JOINTS": total_joints,
+                    "JOINTS PER PINT": joints_per_pint,
+                    # Rounded like the numpy sums were (3.15 pints is 3.2)
+                    "PINTS": float(np.round(pints, 1)),
+                    "Thrust Block # Conc. Bags": thrust_block_conc_bags,
+                }
+            )
+
+        return results
+
+    @staticmethod
+    def fitting_sizes(pipe_sizes: Iterable) -> Callable[[str, str], set]:
+        """
+        Build the extractor of the `(fitting, pipe size)` pairs mentioned by a value of a mains & manifold column.
+
+        The fittings are "PIPE" for the solvent weld pipes of `form1` ("PIPE ... 2 SW" or "... 2 BE"), the
+        `form4` keywords of `MAINS_MANIFOLD_FITTINGS` followed by a space and the size (e.g. "ELB 2"), and the
+        column name for the sizes anywhere in the "CROSS", "Tee's" and "RED BUSH & COUPS" columns.
+
+        NOTE: Like the sheet formulas (`str.contains` with the pipe size as a case-insensitive pattern), a size
+        matches any text starting with it (e.g. "2" matches "24") and its "." matches any character but a new line.
+
+        :param pipe_sizes: Pipe sizes, e.g. the keys of `JOINTS_PER_PINT`.
+        :return: A function of a column name and a value, returning a set of `(fitting, pipe_size)`.
+        """
+        size_patterns = {size: re.compile(f"{size}", flags=re.IGNORECASE) for size in pipe_sizes}
+        longest = max((len(f"{size}") for size in size_patterns), default=0)
+
+        @lru_cache(maxsize=None)
+        def sizes_at(text: str) -> tuple:
+            """Sizes matching the start of `text`."""
+            return tuple(size for size, pattern in size_patterns.items() if pattern.match(text))
+
+        @lru_cache(maxsize=None)
+        def sizes_before(text: str) -> tuple:
+            """Sizes matching the end of `text` (every size pattern matches a fixed number of characters)."""
+            return tuple(
+                size
+                for size, pattern in size_patterns.items()
+                if len(text) >= len(f"{size}") and pattern.fullmatch(text[len(text) - len(f"{size}") :])
+            )
+
+        def pipe_sizes_of(value: str) -> set:
+            # "PIPE.*<size> SW" can't span lines, the size is in a line after "PIPE"
+            sizes = set()
+            for line in value.split("\n"):
+                pipe = PIPE_PATTERN.search(line)
+                if pipe:
+                    rest = line[pipe.end() :]
+                    for end in PIPE_END_PATTERN.finditer(rest):
+                        sizes.update(sizes_before(rest[max(end.start() - longest, 0) : end.start()]))
+            return {("PIPE", size) for size in sizes}
+
+        def extract(column: str, value: str) -> set:
+            if not isinstance(value, str):
+                return set()
+            if column == "form1":
+                return pipe_sizes_of(value)
+            if column == "form4":
+                return {
+                    (fitting.group(1).upper(), size)
+                    for fitting in FITTING_PATTERN.finditer(value)
+                    for size in sizes_at(value[fitting.end(1) + 1 : fitting.end(1) + 1 + longest])
+                }
+            return {(column, size) for index in range(len(value)) for size in sizes_at(value[index : index + longest])}
+
+        return extract
 
     def calculate_flex_riser_quantities(self, df: pd.DataFrame, values: list) -> pd.DataFrame:
         """Helper function to generate rows with calculations for Glue & Additional Material List."""
@@ -301,87 +465,101 @@ class UploadCADFile(ViewMixin):
         """
         return sum(args)
 
-    def __evaluate_formula(self, qty: str, amf: str, formula: str) -> Optional[float]:
+    def get_additional_material_catalog(self, item_numbers: list) -> tuple:
         """
-        Evaluate the given formula string after substituting 'qty' and 'amf'.
+        Load the additional materials and the formulas of their products with two queries.
+
+        :param item_numbers: Item numbers of the material list.
+        :return: A tuple of `({item_number: AdditionalMaterials}, {material_id: AdditionalMaterials},
+            {material_id: formula})`. Item numbers shared by several additional materials map to None.
         """
-        product_code_match = re.search(r"ProductCode\s*=\s*\[([0-9, ]+)\]", formula)
-        product_code = []
-        if product_code_match:
-            product_code = list(map(int, product_code_match.group(1).split(",")))
+        materials_by_item_number = {}
+        materials_by_id = {}
+        for material in AdditionalMaterials.objects.all():
+            materials_by_id[material.material_id] = material
+            if material.product_item_number in materials_by_item_number:
+                materials_by_item_number[material.product_item_number] = None  # Ambiguous item number
+            else:
+                materials_by_item_number[material.product_item_number] = material
 
-        cumulative_values = {}
+        material_ids = {
+            materials_by_item_number[item].material_id
+            for item in set(item_numbers)
+            if materials_by_item_number.get(item) is not None
+        }
+        formulas = dict(Product.objects.filter(internal_id__in=material_ids).values_list("internal_id", "formula"))
+
+        return materials_by_item_number, materials_by_id, formulas
 
-        for i in product_code:
+    def calculate_additional_quantities(self, quantities_by_formula: dict, materials_by_id: dict) -> dict:
+        """
+        Evaluate each formula once over all the line quantities that use it.
+
+        :param quantities_by_formula: Dictionary of `{formula: Counter({quantity: number of lines})}`.
+        :param materials_by_id: Dictionary of `{material_id: AdditionalMaterials}`.
+        :return: A dictionary of `{material_id: total quantity}`.
+        """
+        result: dict = {}
+        missing_material_ids = set()
+
+        for formula, quantities in quantities_by_formula.items():
             try:
-                _amf = AdditionalMaterials.objects.get(material_id=i)
-                formula_with_values = formula.replace("$qty", str(qty)).replace(
-                    "$amf", str(_amf.additional_material_factor)
-                )
-                formula_content = re.sub(r"ProductCode\s*=\s*\[.*?\],?\s*", "", formula_with_values).strip()
-                calculated_value = eval(formula_content)
-                cumulative_values[i] = cumulative_values.get(i, 0) + calculated_value
-            except AdditionalMaterials.DoesNotExist:
-                print(f"Material ID {i} not found in AdditionalMaterials.")
-            except Exception as e:
-                print(f"Error evaluating formula for Product Code {i}: {e}")
-        # final_value = sum(cumulative_values.values())
-        return cumulative_values
-
-    def get_final_unit(self, qty: str, item_number: str) -> Optional[float]:
-        """Get final unit based on a single formula."""
-        try:
-            _amf = AdditionalMaterials.objects.get(product_item_number=item_number)
-            _formula = Product.objects.get(internal_id=_amf.material_id)
-            return self.__evaluate_formula(qty, _amf.additional_material_factor, _formula.formula)
-        except AdditionalMaterials.DoesNotExist:
-            pass
-            # LOGGER.error(f"AdditionalMaterials Not Exist")
-
-    def generate_glue_and_additional_material_list(self, material_list: dict, document_number: str) -> dict:
+                compiled = compile_formula(formula)
+            except FormulaError as e:
+                LOGGER.error(f"Error compiling formula {formula!r}: {e}")
+                continue
+
+            for code in compiled.product_codes:
+                if code not in materials_by_id:
+                    missing_material_ids.add(code)
+                    continue
+                try:
+                    value = compiled.evaluate(
+                        list(quantities), materials_by_id[code].additional_material_factor, list(quantities.values())
+                    )
+                except Exception as e:
+                    LOGGER.error(f"Error evaluating formula for Product Code {code}: {e}")
+                    continue
+                if value is not None:
+                    result[code] = result.get(code, 0) + value
+
+        if missing_material_ids:
+            LOGGER.error(f"Material IDs not found in AdditionalMaterials: {sorted(missing_material_ids)}")
+
+        return result
+
+    def generate_glue_and_additional_material_list(self, material_list: dict) -> dict:
         glue_and_additional_data = {"Quantity": [], "Description": [], "Item": []}
 
-        glue_list: list = []
-        for qty, item in zip(material_list.get("Quantity", []), material_list.get("Item Number", [])):
-            try:
-                glue_qty = self.get_final_unit(qty, item)
-                if glue_qty:
-                    glue_list.append(glue_qty)
-            except Exception as e:
-                print(f"Error processing item {item}: {e}")
+        item_numbers = material_list.get("Item Number", [])
+        materials_by_item_number, materials_by_id, formulas = self.get_additional_material_catalog(item_numbers)
 
-        result: dict = {}
-        for d in glue_list:
-            for key, value in d.items():
-                # Add value to the key directly, initialize if key doesn't exist
-                result[key] = result.get(key, 0) + value
+        # Group the line quantities by formula, so every formula is evaluated once for all of its lines
+        quantities_by_formula = defaultdict(Counter)
+        unmatched_items = defaultdict(set)
 
-        print(f"result {type(result)}: {result}")
+        for lines, item in zip(material_list.get("Line Quantities", []), item_numbers):
+            if item not in materials_by_item_number:
+                continue  # Not an additional material item
 
-        for key, value in result.items():
-            try:
-                material = AdditionalMaterials.objects.get(material_id=key)
-                glue_and_additional_data["Quantity"].append(value)
-                glue_and_additional_data["Description"].append(material.material_name)
-                glue_and_additional_data["Item"].append(material.product_item_number)
-            except AdditionalMaterials.DoesNotExist:
-                LOGGER.error(f"Additional material not found")
-            except Exception as e:
-                LOGGER.error(f"Error processing item {key}: {e}")
+            material = materials_by_item_number[item]
+            if material is None:
+                unmatched_items["multiple additional materials"].add(item)
+            elif material.material_id not in formulas:
+                unmatched_items["product not found"].add(item)
+            elif formulas[material.material_id]:
+                quantities_by_formula[formulas[material.material_id]].update(lines)
 
-        try:
-            opportunity = Opportunity.objects.get(document_number=document_number)
-            for i in range(len(glue_and_additional_data["Item"])):
-                GlueAndAdditionalMaterial.objects.create(
-                    opportunity=opportunity,
-                    quantity=glue_and_additional_data["Quantity"][i],
-                    description=glue_and_additional_data["Description"][i],
-                    item_number=glue_and_additional_data["Item"][i],
-                )
-        except Opportunity.DoesNotExist:
-            print(f"Opportunity with document number {document_number} not found.")
-        except Exception as e:
-            print(f"Error saving glue and additional material data: {e}")
+        for reason, items in unmatched_items.items():
+            LOGGER.error(f"Glue & additional material items skipped ({reason}): {sorted(items)}")
+
+        result = self.calculate_additional_quantities(quantities_by_formula, materials_by_id)
+
+        for key, value in result.items():
+            material = materials_by_id[key]
+            glue_and_additional_data["Quantity"].append(value)
+            glue_and_additional_data["Description"].append(material.material_name)
+            glue_and_additional_data["Item"].append(material.product_item_number)
 
         return glue_and_additional_data
 
@@ -398,31 +576,20 @@ class UploadCADFile(ViewMixin):
                 merged_data[item_number]["Item Number"] = item_number
                 merged_data[item_number]["Quantity"] = [quantity]
 
-    def generate_preliminary_material_list(
-        self, material_list: dict, glue_and_additional_data: dict, document_number: str
-    ) -> dict:
+    def generate_preliminary_material_list(self, material_list: dict, glue_and_additional_data: dict) -> dict:
         """
-        Generate and save preliminary material list into the database.
+        Generate preliminary material list.
 
         :param material_list : Material List data.
         :param glue_and_additional_data : Glue & Additional Material List data.
-        :param document_number: Document number for the associated opportunity.
+        :return: Dictionary containing the preliminary material list data.
         """
-        # Get the opportunity instance to save the Glue and Additional material list data
-        try:
-            opportunity = Opportunity.objects.get(document_number=document_number)
-        except Opportunity.DoesNotExist:
-            LOGGER.error(f"Opportunity with document number {document_number} not found.")
-            return glue_and_additional_data
-
         # Initialize data structures
         irricad_data = material_list
         glue_data = glue_and_additional_data
 
-        # Create dictionaries for mapping item numbers to quantities
-        irricad_quantities = {
-            item.strip(): quantity for item, quantity in zip(irricad_data["Item Number"], irricad_data["Quantity"])
-        }
+        # Create dictionaries for mapping item numbers to quantities (the quantity of the last line of an item)
+        irricad_quantities = irricad_data["Last Quantities"]
         glue_quantities = {item: quantity for item, quantity in zip(glue_data["Item"], glue_data["Quantity"])}
 
         # Combine quantities for the same item_number
@@ -452,9 +619,7 @@ class UploadCADFile(ViewMixin):
             description_dict[item] = description
 
         # Add descriptions from irricad_data if not already present
-        for item, description in zip(
-            irricad_data["Item Number"], irricad_data["Description"] * len(irricad_data["Item Number"])
-        ):
+        for item, description in zip(irricad_data["Item Number"], irricad_data["Description"]):
             if item not in description_dict:
                 description_dict[item] = description
 
@@ -475,23 +640,181 @@ class UploadCADFile(ViewMixin):
             final_data["Glue & Additional Mat'l Quantities"].append(values["Glue & Additional Mat'l Quantities"])
             final_data["Combined Quantities from both Imports"].append(values["Combined Quantities from both Imports"])
 
-        # Save each unique combination to the database
-        for item_number, values in combined_quantities.items():
-            PreliminaryMaterialList.objects.create(
-                opportunity=opportunity,
-                irricad_imported_quantities=values["Irricad Imported Quantities"],
-                glue_and_additional_mat_quantities=values["Glue & Additional Mat'l Quantities"],
-                combined_quantities_from_both_import=values["Combined Quantities from both Imports"],
-                description=description_dict.get(item_number, "Description not available"),
-                item_number=item_number,
-                # Add any additional fields if necessary
-            )
-
         return final_data
 
+    @staticmethod
+    def bulk_create_in_batches(model, objects: Iterable) -> None:
+        """
+        Insert model instances from an iterable, building at most `BULK_CREATE_BATCH_SIZE` of them at a time.
+
+        :param model: Model class to insert.
+        :param objects: Iterable (e.g. a generator) of unsaved model instances.
+        """
+        objects = iter(objects)
+        while batch := list(islice(objects, BULK_CREATE_BATCH_SIZE)):
+            model.objects.bulk_create(batch)
+
+    @transaction.atomic
+    def save_material_lists(
+        self, opportunity: Opportunity, cad_lines: Iterable, glue_and_additional_data: dict, preliminary_data: dict
+    ) -> None:
+        """
+        Replace the Material List, Glue & Additional Material List and Preliminary Material List of an opportunity.
+
+        NOTE: Runs in a single transaction, so a failed upload keeps the previous lists. The Material List has one
+        row per line of the CAD file, written in batches as the lines are read.
+
+        :param opportunity: Opportunity to save the lists for.
+        :param cad_lines: Iterable of the `(quantity, description, item_number)` lines of the CAD file, e.g.
+            `read_cad_file`.
+        :param glue_and_additional_data: Glue & Additional Material List data.
+        :param preliminary_data: Preliminary Material List data.
+        """
+        MaterialList.objects.filter(opportunity=opportunity).delete()
+        GlueAndAdditionalMaterial.objects.filter(opportunity=opportunity).delete()
+        PreliminaryMaterialList.objects.filter(opportunity=opportunity).delete()
+
+        self.bulk_create_in_batches(
+            MaterialList,
+            (
+                MaterialList(
+                    opportunity=opportunity, quantity=quantity, description=description, item_number=item_number
+                )
+                for quantity, description, item_number in cad_lines
+            ),
+        )
+
+        self.bulk_create_in_batches(
+            GlueAndAdditionalMaterial,
+            (
+                GlueAndAdditionalMaterial(
+                    opportunity=opportunity, quantity=quantity, description=description, item_number=item_number
+                )
+                for quantity, description, item_number in zip(
+                    glue_and_additional_data["Quantity"],
+                    glue_and_additional_data["Description"],
+                    glue_and_additional_data["Item"],
+                )
+            ),
+        )
+
+        self.bulk_create_in_batches(
+            PreliminaryMaterialList,
+            (
+                PreliminaryMaterialList(
+                    opportunity=opportunity,
+                    irricad_imported_quantities=irricad_quantity,
+                    glue_and_additional_mat_quantities=glue_quantity,
+                    combined_quantities_from_both_import=combined_quantity,
+                    description=description,
+                    item_number=item_number,
+                )
+                for irricad_quantity, glue_quantity, combined_quantity, description, item_number in zip(
+                    preliminary_data["Irricad Imported Quantities"],
+                    preliminary_data["Glue & Additional Mat'l Quantities"],
+                    preliminary_data["Combined Quantities from both Imports"],
+                    preliminary_data["Description"],
+                    preliminary_data["Item Number"],
+                )
+            ),
+        )
+
+    def process_cad_file(
+        self, uploaded_file: File, document_number: str, on_progress: Optional[Callable[[str, int], None]] = None
+    ) -> dict:
+        """
+        Replace the Material List, Glue & Additional Material List and Preliminary Material List of an
+        opportunity with the ones generated from a CAD file.
+
+        NOTE: The lists are calculated first and then saved in a single transaction (see `save_material_lists`),
+        so a failed upload keeps the previous lists.
+
+        :param uploaded_file: Uploaded CAD file.
+        :param document_number: Document number for the associated opportunity.
+        :param on_progress: Optional callback called with the current step and progress percentage.
+        :return: A dictionary with the `mains_manifold` glue rows and the `flex_risers` rows of the CAD file.
+        """
+        report_progress = on_progress or (lambda step, progress: None)
+
+        try:
+            opportunity = Opportunity.objects.get(document_number=document_number)
+        except Opportunity.DoesNotExist:
+            LOGGER.error(f"Opportunity with document number {document_number} not found.")
+            raise
+
+        # Generate Material List
+        report_progress("Reading CAD file", 10)
+        material_list = self.generate_material_list(uploaded_file)
+        material_list_df = pd.DataFrame(
+            {column: material_list[column] for column in ("Quantity", "Description", "Item Number")}
+        )
+
+        # Helper function to calculate ['form1', 'form2', 'form3', 'form4'] for material list
+        material_list_df[["form1", "form2", "form3", "form4"]] = self.apply_transformations(material_list_df)
+
+        # Helper function to calculate ['Tee\'s', 'RED BUSH & COUPS', 'CROSS', 'Hose'] for material list
+        material_list_df[["Tee's", "RED BUSH & COUPS", "CROSS", "Hose"]] = self.calculate_additional_columns(
+            material_list_df
+        )
+
+        # Calculate the glue (mains & manifold) and Flex Riser Quantities
+        mains_manifold = self.calculate_mains_manifold(material_list_df, JOINTS_PER_PINT)
+        flex_risers = self.calculate_flex_riser_quantities(material_list_df, ["1/2", "3/4", "1"])
+
+        # Generate Glue & Additional Material List
+        # NOTE: Converted Macro code into python ("Run Miscellaneous Material")
+        # _glue_and_additional_data_df
+        report_progress("Generating Glue & Additional Material List", 40)
+        glue_and_additional_data = self.generate_glue_and_additional_material_list(material_list)
+        # glue_and_additional_data_df = pd.DataFrame(glue_and_additional_data)
+
+        # Generate Preliminary Material List
+        # NOTE: Converted Macro code into python ("Import Material from Previous Tabs", "FINALIZE MATERIAL")
+        report_progress("Generating Preliminary Material List", 70)
+
+        # --[Import Material from Previous Tabs]
+        # Dictionary to store merged data
+        merged_data = defaultdict(lambda: {"Quantity": [], "Description": None, "Item Number": None})
+
+        # Add both datasets to merged_data
+        self.add_to_merged_data(material_list, "Item Number", merged_data)
+        self.add_to_merged_data(glue_and_additional_data, "Item", merged_data)
+
+        # Convert quantities to comma-separated strings and finalize the merged data
+        final_merged_data = {
+            "Quantity": [],
+            "Item Number": [],
+            "Description": [],
+        }
+
+        for item_number, values in merged_data.items():
+            final_merged_data["Item Number"].append(values["Item Number"])
+            final_merged_data["Description"].append(values["Description"])
+            final_merged_data["Quantity"].append(",".join(map(str, values["Quantity"])))
+
+        # import_from_previous_data = pd.DataFrame(final_merged_data)
+        # import_from_previous_data_df = import_from_previous_data.sort_values(by='Item Number').reset_index(drop=True)
+
+        # --[FINALIZE MATERIAL]
+        # Generate preliminary material list data
+        # preliminary_material_list_df = pd.DataFrame(preliminary_material_list)
+        preliminary_material_list = self.generate_preliminary_material_list(material_list, glue_and_additional_data)
+
+        report_progress("Saving material lists", 90)
+        # The CAD file is read again, so its lines are saved without being held in memory
+        self.save_material_lists(
+            opportunity, self.read_cad_file(uploaded_file), glue_and_additional_data, preliminary_material_list
+        )
+
+        return {"mains_manifold": mains_manifold, "flex_risers": flex_risers.to_dict("records")}
+
     def post(self, request, *args, **kwargs) -> JsonResponse:
         """
         Handel POST request for uploaded CAD File.
+
+        NOTE: The file is processed by the `process_cad_file` Celery task. The response contains the job id and
+        the URL to poll for its status, which carries the job id signed with the id of the user (see
+        `UploadCADFileStatus`).
         """
         if "file" not in request.FILES:
             return JsonResponse({"error": "No file uploaded"}, status=400)
@@ -499,98 +822,65 @@ class UploadCADFile(ViewMixin):
         uploaded_file = request.FILES["file"]
         document_number = request.POST.get("document_number")
 
-        if uploaded_file.name.lower().endswith((".tmp", ".txt")):
-            # Generate and save Material List
-            material_list = self.generate_material_list(uploaded_file, document_number)
-            material_list_df = pd.DataFrame(material_list)
+        if not uploaded_file.name.lower().endswith((".tmp", ".txt")):
+            return JsonResponse({"error": "Invalid file format. Only .tmp files are supported."}, status=400)
 
-            # Helper function to calculate ['form1', 'form2', 'form3', 'form4'] for material list
-            material_list_df[["form1", "form2", "form3", "form4"]] = material_list_df.apply(
-                self.apply_transformations, axis=1
-            )
+        try:
+            file_name = default_storage.save(f"cad_files/{document_number}/{uploaded_file.name}", uploaded_file)
+        except Exception as e:
+            LOGGER.error(f"[UploadCADFile][save] {e}")
+            return JsonResponse({"error": ERROR_RESPONSE["message"]}, status=500)
 
-            # Helper function to calculate ['Tee\'s', 'RED BUSH & COUPS', 'CROSS', 'Hose'] for material list
-            material_list_df[["Tee's", "RED BUSH & COUPS", "CROSS", "Hose"]] = material_list_df.apply(
-                self.calculate_additional_columns, axis=1
-            )
+        try:
+            job = process_cad_file_task.delay(file_name, document_number)
+        except OperationalError as e:
+            # Broker is not available, process the file in this request
+            LOGGER.warning(f"[UploadCADFile] Celery broker unavailable, processing {file_name} synchronously: {e}")
+            job = process_cad_file_task.apply(args=(file_name, document_number))
+
+        if job.ready():
+            if job.failed():
+                return JsonResponse({"error": ERROR_RESPONSE["message"]}, status=500)
+            return JsonResponse(job.result, status=200)
+
+        token = signing.dumps({"job_id": job.id, "user_id": request.user.pk}, salt=CAD_FILE_JOB_SALT)
+        return JsonResponse(
+            {
+                "job_id": job.id,
+                "status_url": reverse("proposal_app:opportunity:upload-cad-file-status", args=[token]),
+                "message": "CAD file uploaded, generating material lists",
+            },
+            status=202,
+        )
 
-            # Define pipe sizes and joints per pint
-            pipe_sizes = [24, 21, 20, 18.7, 15, 12, 10, 8, 6, 5, 4, 3, 2.5, 2]
-            joints_per_pint_values = {
-                24: 0.0625,
-                21: 0.125,
-                20: 0.125,
-                18.7: 0.25,
-                15: 0.375,
-                12: 0.5,
-                10: 1,
-                8: 2,
-                6: 5,
-                5: 10,
-                4: 15,
-                3: 20,
-                2.5: 25,
-                2: 30,
-            }
-
-            # Calculate values for each pipe size
-            mains_manifold_results = []
-            for pipe_size in pipe_sizes:
-                joints_per_pint = joints_per_pint_values.get(pipe_size, "")
-                mains_manifold_data = self.calculate_mains_manifold(material_list_df, pipe_size, joints_per_pint)
-                mains_manifold_results.append(mains_manifold_data)
-
-            # Create a DataFrame for mains and manifold pipes
-            # mains_manifold_df = pd.DataFrame(mains_manifold_results)
-
-            # Calculate Flex Riser Quantities
-            values = ["1/2", "3/4", "1"]
-            # flex_riser_df = self.calculate_flex_riser_quantities(material_list_df, values)
-            self.calculate_flex_riser_quantities(material_list_df, values)
-
-            # Generate and save Glue & Additional Material List
-            # NOTE: Converted Macro code into python ("Run Miscellaneous Material")
-            # _glue_and_additional_data_df
-            glue_and_additional_data = self.generate_glue_and_additional_material_list(material_list, document_number)
-            # glue_and_additional_data_df = pd.DataFrame(glue_and_additional_data)
-
-            # Generate and save Preliminary Material List
-            # NOTE: Converted Macro code into python ("Import Material from Previous Tabs", "FINALIZE MATERIAL")
-
-            # --[Import Material from Previous Tabs]
-            # Dictionary to store merged data
-            merged_data = defaultdict(lambda: {"Quantity": [], "Description": None, "Item Number": None})
-
-            # Add both datasets to merged_data
-            self.add_to_merged_data(material_list, "Item Number", merged_data)
-            self.add_to_merged_data(glue_and_additional_data, "Item", merged_data)
-
-            # Convert quantities to comma-separated strings and finalize the merged data
-            final_merged_data = {
-                "Quantity": [],
-                "Item Number": [],
-                "Description": [],
-            }
-
-            for item_number, values in merged_data.items():
-                final_merged_data["Item Number"].append(values["Item Number"])
-                final_merged_data["Description"].append(values["Description"])
-                final_merged_data["Quantity"].append(",".join(map(str, values["Quantity"])))
-
-            # import_from_previous_data = pd.DataFrame(final_merged_data)
-            # import_from_previous_data_df = import_from_previous_data.sort_values(by='Item Number').reset_index(drop=True)
-
-            # --[FINALIZE MATERIAL]
-            # Generate and save preliminary material list data
-            # preliminary_material_list = self.generate_preliminary_material_list(material_list, glue_and_additional_data, document_number)
-            # preliminary_material_list_df = pd.DataFrame(preliminary_material_list)
-            self.generate_preliminary_material_list(material_list, glue_and_additional_data, document_number)
-
-            return JsonResponse(
-                {
-                    "message": "Generated Material list, Glue & Additional Material List and Preliminary Material List successfully"
-                },
-                status=200,
-            )
 
-        return JsonResponse({"error": "Invalid file format. Only .tmp files are supported."}, status=400)
+class UploadCADFileStatus(ViewMixin):
+    """View to poll the status of a CAD file processing job."""
+
+    def get(self, request, token: str, *args, **kwargs) -> JsonResponse:
+        """
+        Return the state of the job, with the current step and progress while it runs.
+
+        NOTE: The token is the job id signed with the id of the user who uploaded the file (see
+        `UploadCADFile.post`), so users can only poll their own jobs and not any task by its id.
+        """
+        try:
+            job_token = signing.loads(token, salt=CAD_FILE_JOB_SALT, max_age=CAD_FILE_JOB_MAX_AGE)
+        except signing.BadSignature:
+            job_token = {}
+
+        if job_token.get("user_id") != request.user.pk:
+            return JsonResponse({"error": "Job not found"}, status=404)
+
+        job_id = job_token["job_id"]
+        job = AsyncResult(job_id)
+        response = {"job_id": job_id, "state": job.state}
+
+        if job.state == "PROGRESS":
+            response.update(job.info or {})
+        elif job.successful():
+            response.update(job.result)
+        elif job.failed():
+            response["error"] = ERROR_RESPONSE["message"]
+
+        return JsonResponse(response, status=200)
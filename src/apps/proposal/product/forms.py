@@ -24,6 +24,9 @@ class ImportProductForm(forms.Form):
     ]
 
     csv_file = forms.FileField(widget=forms.FileInput(attrs={"accept": ", ".join(VALID_EXTENSIONS)}))
+    detect_changes = forms.BooleanField(
+        required=False, help_text="List the added, changed and removed products after the import."
+    )
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -31,8 +34,7 @@ class ImportProductForm(forms.Form):
             f"{', '.join(self.VALID_EXTENSIONS)} files must contain the following columns in the same sequence: "
             f"{', '.join(self.REQUIRED_COLUMNS)}."
         )
-        for visible in self.visible_fields():
-            visible.field.widget.attrs.update({"class": "custom-file-input", "id": "inputGroupFile01"})
+        self.fields["csv_file"].widget.attrs.update({"class": "custom-file-input", "id": "inputGroupFile01"})
 
     def clean_csv_file(self):
         """Validates the uploaded file format."""
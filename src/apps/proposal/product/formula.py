@@ -0,0 +1,306 @@
+"""
+Safe evaluation of the `Product.formula` strings used by the Glue & Additional Material List.
+
+A formula looks like ``ProductCode=[101, 102], $qty * $amf / 100``. The product codes are the
+`AdditionalMaterials.material_id` values the result is added to. The expression can use `$qty` (quantity of
+the CAD line) and `$amf` (additional material factor of the product code).
+
+Formulas are parsed once into a whitelisted AST, compiled and cached by formula text. Evaluation takes a NumPy
+array of quantities, so a formula runs once for every line that uses it instead of once per line.
+"""
+
+import ast
+import re
+from functools import lru_cache, reduce
+from types import SimpleNamespace
+from typing import Optional
+
+import numpy as np
+from django.core.exceptions import ValidationError
+
+PRODUCT_CODE_PATTERN = re.compile(r"ProductCode\s*=\s*\[([0-9, ]+)\]")
+PRODUCT_CODE_PREFIX_PATTERN = re.compile(r"ProductCode\s*=\s*\[.*?\],?\s*")
+
+ALLOWED_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Call,
+    ast.Attribute,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.Pow,
+    ast.UAdd,
+    ast.USub,
+)
+VARIABLES = ("qty", "amf")
+MAX_CONSTANT_EXPONENT = 100
+
+# Largest absolute value of a power of constants, folded as floats so a tower like `(99**99)**99` is rejected
+MAX_CONSTANT_POWER = 1e300
+
+# Largest number of decimals of `round`
+MAX_ROUND_DIGITS = 10
+
+# Functions available to formulas, as NumPy functions so they work on arrays of quantities
+FUNCTIONS = {
+    "abs": np.abs,
+    "min": lambda *args: reduce(np.minimum, args),
+    "max": lambda *args: reduce(np.maximum, args),
+    "round": np.round,
+    "math": SimpleNamespace(ceil=np.ceil, floor=np.floor),
+}
+
+# Functions of the `math` namespace
+MATH_FUNCTIONS = ("ceil", "floor")
+
+# Number of arguments of the functions, (minimum, maximum) with None for no maximum
+FUNCTION_ARITY = {
+    "abs": (1, 1),
+    "min": (2, None),
+    "max": (2, None),
+    "round": (1, 2),
+    "ceil": (1, 1),
+    "floor": (1, 1),
+}
+
+_BINARY_OPERATORS = {
+    ast.Add: lambda left, right: left + right,
+    ast.Sub: lambda left, right: left - right,
+    ast.Mult: lambda left, right: left * right,
+    ast.Div: lambda left, right: left / right,
+    ast.FloorDiv: lambda left, right: left // right,
+    ast.Mod: lambda left, right: left % right,
+    ast.Pow: lambda left, right: left**right,
+}
+
+
+class FormulaError(ValueError):
+    """Raised when a formula can't be parsed or uses something other than arithmetic on `$qty`/`$amf`."""
+
+
+class CompiledFormula:
+    """A parsed `Product.formula`, see `compile_formula`."""
+
+    def __init__(self, formula: str, product_codes: tuple, expression: str):
+        self.formula = formula
+        self.product_codes = product_codes
+        self.expression = expression
+        tree = self._parse(expression)
+        self.code = compile(tree, "<formula>", "eval")
+        self.is_integral = self._is_integral(tree.body)
+
+    @staticmethod
+    def _parse(expression: str) -> ast.Expression:
+        """Parse the expression and reject anything outside the whitelist."""
+        try:
+            tree = ast.parse(expression.replace("$qty", "qty").replace("$amf", "amf"), mode="eval")
+        except SyntaxError as e:
+            raise FormulaError(f"Invalid formula expression {expression!r}: {e}") from e
+
+        # Names allowed as the function of a call, `math` only as the namespace of `math.ceil`/`math.floor`
+        called = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Call):
+                called.add(id(node.func))
+                if isinstance(node.func, ast.Attribute):
+                    called.add(id(node.func.value))
+
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise FormulaError(f"{type(node).__name__} is not allowed in formula {expression!r}")
+            if isinstance(node, ast.Constant) and (
+                not isinstance(node.value, (int, float)) or isinstance(node.value, bool)
+            ):
+                raise FormulaError(f"Only numbers are allowed in formula {expression!r}")
+            if isinstance(node, ast.Name) and node.id not in VARIABLES:
+                if node.id not in FUNCTIONS or id(node) not in called:
+                    raise FormulaError(f"Unknown name {node.id!r} in formula {expression!r}")
+            if isinstance(node, ast.Attribute) and not (
+                isinstance(node.value, ast.Name)
+                and node.value.id == "math"
+                and node.attr in MATH_FUNCTIONS
+                and id(node) in called
+            ):
+                raise FormulaError(f"Unknown function in formula {expression!r}")
+            if isinstance(node, ast.Call):
+                CompiledFormula._check_call(node, expression)
+            if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+                CompiledFormula._check_power(node, expression)
+
+        return tree
+
+    @staticmethod
+    def _check_call(node: ast.Call, expression: str) -> None:
+        """Reject calls with keywords, an unknown function or a wrong number of arguments."""
+        if node.keywords or not isinstance(node.func, (ast.Name, ast.Attribute)):
+            raise FormulaError(f"Invalid function call in formula {expression!r}")
+
+        name = node.func.id if isinstance(node.func, ast.Name) else node.func.attr
+        if name not in FUNCTION_ARITY:
+            raise FormulaError(f"Invalid function call in formula {expression!r}")
+
+        minimum, maximum = FUNCTION_ARITY[name]
+        if len(node.args) < minimum or (maximum is not None and len(node.args) > maximum):
+            raise FormulaError(f"Wrong number of arguments to {name}() in formula {expression!r}")
+
+        if name == "round" and len(node.args) == 2:
+            digits = CompiledFormula._constant_value(node.args[1])
+            if not isinstance(digits, int) or abs(digits) > MAX_ROUND_DIGITS:
+                raise FormulaError(
+                    f"The decimals of round() must be an integer up to {MAX_ROUND_DIGITS} in formula {expression!r}"
+                )
+
+    @staticmethod
+    def _check_power(node: ast.BinOp, expression: str) -> None:
+        """
+        Reject the powers that could hang the worker with Python integer arithmetic, e.g. `9**9**9`.
+
+        Exponents must be small constants or depend on `$qty`/`$amf` (NumPy floats, which overflow to `inf`
+        instead of growing). A power of constants is folded as floats and must stay below `MAX_CONSTANT_POWER`.
+        """
+        exponent = CompiledFormula._constant_value(node.right)
+        if exponent is None:
+            if not any(isinstance(child, ast.Name) and child.id in VARIABLES for child in ast.walk(node.right)):
+                raise FormulaError(f"Exponent too large in formula {expression!r}")
+        elif abs(exponent) > MAX_CONSTANT_EXPONENT:
+            raise FormulaError(f"Exponent too large in formula {expression!r}")
+
+        base = CompiledFormula._constant_value(node.left)
+        if base is not None and exponent is not None:
+            try:
+                value = abs(float(base)) ** float(exponent)
+            except (OverflowError, ZeroDivisionError):
+                value = float("inf")
+            if value > MAX_CONSTANT_POWER:
+                raise FormulaError(f"Exponent too large in formula {expression!r}")
+
+    @staticmethod
+    def _constant_value(node: ast.AST):
+        """
+        Fold an expression of constants, with floats for the powers so the folding itself can't hang.
+
+        :return: The value, None if the expression depends on `$qty`/`$amf`, calls a function or can't be
+            computed (e.g. a division by zero).
+        """
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.UnaryOp):
+            operand = CompiledFormula._constant_value(node.operand)
+            if operand is None:
+                return None
+            return -operand if isinstance(node.op, ast.USub) else operand
+        if isinstance(node, ast.BinOp):
+            left = CompiledFormula._constant_value(node.left)
+            right = CompiledFormula._constant_value(node.right)
+            if left is None or right is None:
+                return None
+            if isinstance(node.op, ast.Pow):
+                left, right = float(left), float(right)
+            try:
+                return _BINARY_OPERATORS[type(node.op)](left, right)
+            except (ArithmeticError, ValueError, TypeError):
+                return None
+        return None
+
+    @staticmethod
+    def _is_integral(node: ast.AST) -> bool:
+        """
+        Return True when the expression always yields an `int` in Python, e.g. `math.ceil($qty / 20)`.
+
+        NOTE: `min`/`max` over mixed int and float arguments are treated as float.
+        """
+        if isinstance(node, ast.Constant):
+            return isinstance(node.value, int)
+        if isinstance(node, ast.UnaryOp):
+            return CompiledFormula._is_integral(node.operand)
+        if isinstance(node, ast.BinOp):
+            if isinstance(node.op, ast.Div):
+                return False
+            if isinstance(node.op, ast.Pow):
+                return (
+                    CompiledFormula._is_integral(node.left)
+                    and isinstance(node.right, ast.Constant)
+                    and isinstance(node.right.value, int)
+                    and node.right.value >= 0
+                )
+            return CompiledFormula._is_integral(node.left) and CompiledFormula._is_integral(node.right)
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Attribute):  # math.ceil / math.floor
+                return True
+            if node.func.id == "round":
+                return len(node.args) == 1 or CompiledFormula._is_integral(node.args[0])
+            return all(CompiledFormula._is_integral(arg) for arg in node.args)
+        return False
+
+    def evaluate(self, quantities: np.ndarray, amf: float, counts: Optional[np.ndarray] = None) -> Optional[float]:
+        """
+        Evaluate the formula for every quantity and sum the results.
+
+        Lines whose result isn't a finite number (e.g. a division by a zero quantity) are skipped.
+
+        :param quantities: Array of line quantities.
+        :param amf: Additional material factor of the product code.
+        :param counts: Optional array of the number of lines of each quantity, every quantity is one line by default.
+        :return: The sum of the line results, or None if no line could be evaluated. Like Python evaluation,
+            the sum is an `int` when the formula produces integers (e.g. `math.ceil`).
+        """
+        quantities = np.asarray(quantities, dtype=float)
+        if amf is None or quantities.size == 0:
+            return None
+
+        with np.errstate(all="ignore"):
+            values = eval(self.code, {"__builtins__": {}}, {**FUNCTIONS, "qty": quantities, "amf": float(amf)})
+            values = np.broadcast_to(np.asarray(values, dtype=float), quantities.shape)
+        valid = np.isfinite(values)
+        if not valid.any():
+            return None
+
+        if counts is not None:
+            values = values * np.asarray(counts, dtype=float)
+        total = float(values[valid].sum())
+        return int(round(total)) if self.is_integral else total
+
+    def __repr__(self):
+        return f"<CompiledFormula {self.formula!r}>"
+
+
+@lru_cache(maxsize=1024)
+def compile_formula(formula: str) -> CompiledFormula:
+    """
+    Parse and compile a `Product.formula`, cached by formula text.
+
+    :param formula: Formula text, e.g. ``ProductCode=[101], $qty * $amf``.
+    :return: The compiled formula.
+    :raises FormulaError: If the formula is invalid or not a plain arithmetic expression.
+    """
+    product_code_match = PRODUCT_CODE_PATTERN.search(formula)
+    product_codes = ()
+    if product_code_match:
+        product_codes = tuple(int(code) for code in product_code_match.group(1).split(",") if code.strip())
+
+    expression = PRODUCT_CODE_PREFIX_PATTERN.sub("", formula).strip()
+    return CompiledFormula(formula, product_codes, expression)
+
+
+def validate_formula(formula: str) -> None:
+    """
+    Validator of `Product.formula`, so an invalid formula is rejected when the product is saved or imported
+    instead of when a CAD file is processed.
+
+    :param formula: Formula text, empty for products without formula.
+    :raises ValidationError: If the formula is invalid, see `compile_formula`.
+    """
+    if not formula:
+        return
+    try:
+        compile_formula(str(formula))
+    except FormulaError as e:
+        raise ValidationError(str(e), code="invalid_formula") from e
@@ -0,0 +1,52 @@
+import os
+
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.constants import PRODUCT_IMPORT_CHUNK_SIZE
+from apps.proposal.product.tasks import import_product_from_file
+from apps.upsert import format_upsert_result
+
+
+class Command(BaseCommand):
+    help = "Import a NetSuite item export, split into chunks of rows imported by several processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="Path of the .csv, .xlsx or .xls file")
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=PRODUCT_IMPORT_CHUNK_SIZE,
+            help=f"Rows per chunk (default: {PRODUCT_IMPORT_CHUNK_SIZE})",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Number of worker processes (default: number of CPUs)",
+        )
+        parser.add_argument(
+            "--detect-changes",
+            action="store_true",
+            help="Report the Internal IDs of the added, changed and removed products",
+        )
+
+    def handle(self, *args, **options):
+        if not os.path.isfile(options["file"]):
+            raise CommandError(f"File not found: {options['file']}")
+
+        with open(options["file"], "rb") as f:
+            result = import_product_from_file(
+                File(f, name=os.path.basename(options["file"])),
+                detect_changes=options["detect_changes"],
+                chunk_size=options["chunk_size"],
+                max_workers=options["workers"],
+            )
+
+        if result.get("error"):
+            raise CommandError(result["error"])
+
+        for row, column, reason in result["errors"]:
+            self.stdout.write(self.style.WARNING(f"Row {row} ({column}): {reason}"))
+
+        self.stdout.write(self.style.SUCCESS(f"Products imported: {format_upsert_result(result)}"))
@@ -0,0 +1,54 @@
+# Generated by Django 4.2 on 2026-10-17 01:42
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+
+def fill_display_name_key(apps, schema_editor):
+    """
+    Fill the lookup key of the existing products, see `apps.proposal.product.models.display_name_key`.
+
+    The import hash is cleared so the next import compares the products field by field instead of reporting
+    them all as changed.
+    """
+    Product = apps.get_model('product', 'Product')
+    products = []
+    for product in Product.objects.only('id', 'display_name').iterator(chunk_size=2000):
+        product.display_name_key = " ".join(str(product.display_name or "").split()).upper() or None
+        product.import_hash = None
+        products.append(product)
+    Product.objects.bulk_update(products, ['display_name_key', 'import_hash'], batch_size=1000)
+
+
+def create_trigram_index(apps, schema_editor):
+    """Trigram index for the `display_name__icontains` searches, PostgreSQL only (pg_trgm)."""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS product_display_name_trgm_idx '
+        'ON product_product USING gin (UPPER(display_name::text) gin_trgm_ops)'
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS product_display_name_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0002_product_import_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='display_name_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.RunPython(fill_display_name_key, migrations.RunPython.noop),
+        TrigramExtension(),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2 on 2026-10-17 18:05
+
+from django.db import migrations
+
+
+def create_search_indexes(apps, schema_editor):
+    """
+    Indexes of the product search, PostgreSQL only, see `apps.proposal.product.search`.
+
+    The full text index expression must match `SEARCH_VECTOR_SQL`. The `display_name` trigram index is created by
+    migration 0003.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS product_search_vector_idx ON product_product USING gin (('
+        "setweight(to_tsvector('simple'::regconfig, COALESCE(display_name, '')), 'A') || "
+        "setweight(to_tsvector('simple'::regconfig, COALESCE(name, '')), 'B') || "
+        "setweight(to_tsvector('simple'::regconfig, description), 'C')"
+        '))'
+    )
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS product_name_trgm_idx '
+        'ON product_product USING gin (UPPER(name::text) gin_trgm_ops)'
+    )
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS product_search_vector_idx')
+    schema_editor.execute('DROP INDEX IF EXISTS product_name_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0003_product_display_name_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2 on 2026-10-17 02:18
+
+import apps.proposal.product.formula
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0004_product_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='product',
+            name='formula',
+            field=models.CharField(blank=True, max_length=255, null=True, validators=[apps.proposal.product.formula.validate_formula]),
+        ),
+    ]
@@ -1,10 +1,27 @@
+from typing import Iterable, Optional
+
 from django.db import models
 
-from laurel.models import BaseModel
+from laurel.models import BaseModel, ImportedModel
+
+from .formula import validate_formula
+
+
+def display_name_key(value) -> Optional[str]:
+    """
+    Normalize a product display name or item code for lookups: upper case, without surrounding or repeated
+    whitespace, e.g. " pvc  elbow " -> "PVC ELBOW".
+
+    :param value: Display name of a product, or item number of a material list / item code of an assigned product.
+    :return: The lookup key, or None if the value is empty.
+    """
+    if value is None:
+        return None
+    return " ".join(str(value).split()).upper() or None
 
 
 # Create your models here.
-class Product(BaseModel):
+class Product(ImportedModel):
     internal_id = models.IntegerField(unique=True)
     family = models.CharField(max_length=255)
     parent = models.CharField(max_length=255)
@@ -15,9 +32,30 @@ class Product(BaseModel):
     type = models.CharField(max_length=255, blank=True, null=True)
     name = models.CharField(max_length=255, blank=True, null=True)
     display_name = models.CharField(max_length=255, blank=True, null=True)
+    display_name_key = models.CharField(max_length=255, blank=True, null=True, db_index=True, editable=False)
     tax_schedule = models.CharField(max_length=255, blank=True, null=True)
     preferred_vendor = models.CharField(max_length=255)
-    formula = models.CharField(max_length=255, null=True, blank=True)
+    formula = models.CharField(max_length=255, null=True, blank=True, validators=[validate_formula])
+
+    def save(self, *args, **kwargs):
+        self.display_name_key = display_name_key(self.display_name)
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def get_by_display_name(cls, item_codes: Iterable) -> dict:
+        """
+        Find the products of several item codes with one query on the indexed `display_name_key`.
+
+        NOTE: When several products share a display name, the first one created is returned.
+
+        :param item_codes: Item numbers of a material list or item codes of assigned products.
+        :return: Dictionary mapping the lookup keys (see `display_name_key`) to the products.
+        """
+        keys = {display_name_key(code) for code in item_codes} - {None}
+        products = {}
+        for product in cls.objects.filter(display_name_key__in=keys).order_by("id"):
+            products.setdefault(product.display_name_key, product)
+        return products
 
     def __str__(self) -> str:
         return f"{self.internal_id} - {self.description}"
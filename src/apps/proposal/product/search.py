@@ -0,0 +1,85 @@
+"""
+Search of the catalog products for the item code and item description pickers.
+
+On PostgreSQL a product matches when every term is the prefix of a word of its `display_name`, `name` or
+`description` (full text search on the GIN indexed `SEARCH_VECTOR_SQL`), or when the search is close to a word of
+the field shown by the picker (`pg_trgm` word similarity, GIN trigram indexes). The matches are ranked by
+relevance. The other databases (SQLite for the local settings and the tests) match every term with `icontains` on
+the field shown by the picker, in creation order.
+"""
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField, TrigramWordSimilarity
+from django.db import connection
+from django.db.models import F, Q, QuerySet
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Upper
+
+from .models import Product
+
+# Maximum number of products returned to a picker
+SEARCH_LIMIT = 50
+
+# Weighted search document of a product, must match the `product_search_vector_idx` index (migration 0004)
+SEARCH_VECTOR_SQL = (
+    "setweight(to_tsvector('simple'::regconfig, COALESCE(display_name, '')), 'A') || "
+    "setweight(to_tsvector('simple'::regconfig, COALESCE(name, '')), 'B') || "
+    "setweight(to_tsvector('simple'::regconfig, description), 'C')"
+)
+
+# `SearchRank` weights of the D, C (description), B (name) and A (display name) words, by picker field
+RANK_WEIGHTS = {
+    "display_name": [0.1, 0.2, 0.4, 1.0],
+    "name": [0.1, 0.2, 1.0, 0.4],
+}
+
+
+def prefix_query(terms: list) -> str:
+    """
+    Build a raw `tsquery` matching the documents with a word starting with every term.
+
+    :param terms: Search terms, e.g. `["pvc", "o'ring"]`.
+    :return: The query, e.g. `'pvc':* & 'o''ring':*`.
+    """
+    quoted_terms = (term.replace("\\", "\\\\").replace("'", "''") for term in terms)
+    return " & ".join(f"'{term}':*" for term in quoted_terms)
+
+
+def search_products(search_term: str, field: str, limit: int = SEARCH_LIMIT) -> QuerySet:
+    """
+    Search the catalog products for a picker.
+
+    NOTE: Without search terms, the first products (in creation order) with a value for the picker field are
+    returned.
+
+    :param search_term: Text typed in the picker, split into terms on whitespace.
+    :param field: Field shown by the picker, `display_name` (item code) or `name` (item description).
+    :param limit: Maximum number of products.
+    :return: The matching products, the most relevant first.
+    """
+    terms = search_term.split()
+    if not terms:
+        return Product.objects.filter(**{f"{field}__isnull": False}).exclude(**{field: ""}).order_by("id")[:limit]
+
+    if connection.vendor != "postgresql":
+        queryset = Product.objects.all()
+        for term in terms:
+            queryset = queryset.filter(**{f"{field}__icontains": term})
+        return queryset.order_by("id")[:limit]
+
+    query = SearchQuery(prefix_query(terms), config="simple", search_type="raw")
+    search = " ".join(terms).upper()
+    return (
+        Product.objects.filter(**{f"{field}__isnull": False})
+        .exclude(**{field: ""})
+        .annotate(
+            # The picker field is compared in upper case to use the `UPPER(<field>)` trigram indexes
+            search_field=Upper(field),
+            search_vector=RawSQL(SEARCH_VECTOR_SQL, [], output_field=SearchVectorField()),
+        )
+        .filter(Q(search_vector=query) | Q(search_field__trigram_word_similar=search))
+        .annotate(
+            rank=SearchRank(F("search_vector"), query, weights=RANK_WEIGHTS[field]),
+            similarity=TrigramWordSimilarity(search, "search_field"),
+        )
+        .order_by("-rank", "-similarity", "id")[:limit]
+    )
@@ -1,129 +1,380 @@
-import os
+import json
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import get_context
+from typing import Optional
 
-import pandas as pd
+from celery import shared_task
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.db import DatabaseError, connection, connections, transaction
 
 from apps.constants import LOGGER
-from apps.proposal.product.models import AdditionalMaterials, Product
+from apps.proposal.product.formula import validate_formula
+from apps.proposal.product.models import AdditionalMaterials, Product, display_name_key
+from apps.spreadsheet import ChunkReader, SpreadsheetError, SpreadsheetReader, write_chunks
+from apps.upsert import RowError, bulk_upsert, removed_keys
 
+# Product fields set by the import, `internal_id` identifies the product
+PRODUCT_IMPORT_FIELDS = [
+    "family",
+    "parent",
+    "description",
+    "primary_units_type",
+    "primary_stock_unit",
+    "std_cost",
+    "preferred_vendor",
+    "type",
+    "name",
+    "display_name",
+    "display_name_key",
+    "tax_schedule",
+    "formula",
+]
 
-def import_product_from_file(file: InMemoryUploadedFile) -> dict:
+# File columns of the product fields, used in the import errors
+PRODUCT_IMPORT_COLUMNS = {
+    "internal_id": "Internal ID",
+    "family": "Family",
+    "parent": "Parent",
+    "description": "Description",
+    "primary_units_type": "Primary Units Type",
+    "primary_stock_unit": "Primary Stock Unit",
+    "std_cost": "Std Cost",
+    "preferred_vendor": "Preferred Vendor",
+    "type": "Type",
+    "name": "Name",
+    "display_name": "Display Name",
+    "tax_schedule": "Tax Schedule",
+    "formula": "Formula",
+}
+
+# Additional material fields set by the import, `material_id` identifies the material
+ADDITIONAL_MATERIAL_IMPORT_FIELDS = [
+    "material_name",
+    "material_type",
+    "product_item_number",
+    "material_factor",
+    "additional_material_factor",
+]
+
+# File columns of the additional material fields, used in the import errors
+ADDITIONAL_MATERIAL_IMPORT_COLUMNS = {
+    "material_id": "Material ID",
+    "material_name": "Material Name",
+    "material_type": "Material Type",
+    "product_item_number": "Product Item Number",
+    "material_factor": "Material Factor",
+    "additional_material_factor": "Additional Material Factor",
+}
+
+
+def open_product_file(file: File) -> SpreadsheetReader:
     """
-    Imports product data from an uploaded Excel or CSV file.
+    Open an uploaded product file and check its columns.
 
-    :prams file (File): The uploaded file containing product data.
-    :return: A context dictionary with messages about created/updated products
-            or errors if the columns do not match or records are skipped.
+    :param file: The uploaded file containing product data.
+    :return: The reader of the file.
+    :raises SpreadsheetError: If the file can't be read, is empty, has several sheets or misses a required column.
     """
     # Define required columns (minimum needed)
     required_columns = {"Internal ID", "Name", "Description"}
 
-    # Define optional columns with defaults
-    optional_columns = {
-        "Family": "",
-        "Parent": "",
-        "Primary Units Type": "EA",
-        "Primary Stock Unit": "EA",
-        "Std Cost": 0,
-        "Standard Cost": 0,  # Alternative name for NetSuite exports
-        "Preferred Vendor": "",
-        "Formula": "",
-        "Type": "",
-        "Display Name": "",
-        "Tax Schedule": "",
-    }
-
     # Check for empty file
     if file.size == 0:
-        return {"error": "You are trying to upload an empty file."}
+        raise SpreadsheetError("You are trying to upload an empty file.")
 
-    # Determine file type and load data
-    try:
-        file_extension = os.path.splitext(file.name)[1]
-        if file_extension == ".csv":
-            df = pd.read_csv(file)
-        elif file_extension in {".xlsx", ".xls"}:
-            excel_file = pd.ExcelFile(file)
-            if len(excel_file.sheet_names) > 1:
-                return {"error": "The file with multiple sheets won't be processed"}
-            df = pd.read_excel(excel_file, sheet_name=0)
-        else:
-            return {"error": "Unsupported file format."}
-    except (ImportError, pd.errors.EmptyDataError) as e:
-        return {"error": f"Failed to process the file: {str(e)}."}
+    # Open the file, the rows are read while they are imported
+    reader = SpreadsheetReader(file)
+
+    if reader.sheet_count > 1:
+        raise SpreadsheetError("The file with multiple sheets won't be processed")
 
-    # Check if DataFrame is empty
-    if df.empty:
-        return {"error": "The file is empty."}
+    # Check if the file is empty
+    if reader.empty:
+        raise SpreadsheetError("The file is empty.")
 
     # Check if required columns exist
-    missing_required = required_columns - set(df.columns)
+    missing_required = required_columns - set(reader.columns)
     if missing_required:
-        return {"error": f"Missing required columns: {', '.join(missing_required)}. File has: {', '.join(df.columns)}"}
-
-    df = df.fillna("")
-    records = df.to_dict(orient="records")
-    context = {"messages": []}
-    skipped_records = []
-
-    # Validate 'Internal ID' and process records
-    for record in records:
-        internal_id = record.get("Internal ID")
-        if not isinstance(internal_id, (int, str)):
-            skipped_records.append(record)
-            context["messages"].append(f"Invalid 'Internal ID' in record: {record}. Must be an integer.")
-            continue
-
-        try:
-            internal_id = int(internal_id)
-        except ValueError:
-            skipped_records.append(record)
-            context["messages"].append(f"Invalid 'Internal ID' in record: {record}. Must be an integer.")
-            continue
-
-        # Prepare data for updating or creating the product
-        # Support both "Std Cost" and "Standard Cost" column names
-        std_cost = record.get("Std Cost") or record.get("Standard Cost") or 0
-
-        product_data = {
-            "family": record.get("Family", ""),
-            "parent": record.get("Parent", ""),
-            "description": record.get("Description", ""),
-            "primary_units_type": record.get("Primary Units Type", "EA"),
-            "primary_stock_unit": record.get("Primary Stock Unit", "EA"),
-            "std_cost": std_cost if std_cost else 0,
-            "preferred_vendor": record.get("Preferred Vendor", ""),
-            "type": record.get("Type", ""),
-            "name": record.get("Name", ""),
-            "display_name": record.get("Display Name", record.get("Name", "")),  # Use Name if Display Name missing
-            "tax_schedule": record.get("Tax Schedule", ""),
-            "formula": record.get("Formula", ""),
-        }
-
-        try:
-            product, created = Product.objects.update_or_create(
-                internal_id=internal_id,
-                defaults=product_data,
-            )
-            action = "Created" if created else "Updated"
-            context["messages"].append(f"{action} product with Internal ID: {internal_id}")
-        except Exception as e:
-            skipped_records.append(record)
-            context["messages"].append(f"Error processing record: {record}. Error: {str(e)}")
-
-    if skipped_records:
-        LOGGER.info(f"Skipped Records: {skipped_records}")
+        raise SpreadsheetError(
+            f"Missing required columns: {', '.join(missing_required)}. File has: {', '.join(reader.columns)}"
+        )
+
+    return reader
+
+
+def product_values(record: dict) -> Optional[dict]:
+    """
+    Return the product data of a record, or None if its 'Internal ID' isn't an integer.
+    """
+    internal_id = record.get("Internal ID")
+    if not isinstance(internal_id, (int, str)):
+        return None
+
+    try:
+        internal_id = int(internal_id)
+    except ValueError:
+        return None
+
+    # Support both "Std Cost" and "Standard Cost" column names
+    std_cost = record.get("Std Cost") or record.get("Standard Cost") or 0
+
+    display_name = record.get("Display Name", record.get("Name", ""))  # Use Name if Display Name missing
+
+    return {
+        "internal_id": internal_id,
+        "family": record.get("Family", ""),
+        "parent": record.get("Parent", ""),
+        "description": record.get("Description", ""),
+        "primary_units_type": record.get("Primary Units Type", "EA"),
+        "primary_stock_unit": record.get("Primary Stock Unit", "EA"),
+        "std_cost": std_cost if std_cost else 0,
+        "preferred_vendor": record.get("Preferred Vendor", ""),
+        "type": record.get("Type", ""),
+        "name": record.get("Name", ""),
+        "display_name": display_name,
+        "display_name_key": display_name_key(display_name),
+        "tax_schedule": record.get("Tax Schedule", ""),
+        "formula": record.get("Formula", ""),
+    }
+
+
+def product_key(record: dict) -> Optional[int]:
+    """
+    Return the 'Internal ID' of a valid product record, or None if the import would skip the record.
+
+    NOTE: Used to find the duplicated Internal IDs of a file, an invalid row doesn't replace the previous row
+    of its Internal ID.
+    """
+    values = product_values(record)
+    if values is None:
+        return None
+
+    try:
+        for name, value in values.items():
+            Product._meta.get_field(name).to_python(value)
+        validate_formula(values["formula"])
+    except ValidationError:
+        return None
+
+    return values["internal_id"]
+
+
+def upsert_products(reader: SpreadsheetReader, duplicates: dict = None) -> dict:
+    """
+    Validate the records of a reader and insert or update the products.
+
+    :param reader: Reader of a product file (or of one of its chunks, see `ChunkReader`).
+    :param duplicates: Optional Internal IDs found on several rows of the file, mapped to the row of their last
+        occurrence. The other rows of these Internal IDs are skipped, so the last row wins even when the chunks
+        of the file are imported in parallel.
+    :return: The `bulk_upsert` result, the rows with an invalid 'Internal ID' are included in the errors, which
+        are sorted by row.
+    """
+    errors = []
+
+    def products():
+        """Validate 'Internal ID' and yield the product data of each record."""
+        for record in reader:
+            values = product_values(record)
+            if values is None:
+                errors.append(RowError(reader.row_number, "Internal ID", "Must be an integer."))
+                continue
+
+            try:
+                validate_formula(values["formula"])
+            except ValidationError as e:
+                errors.append(RowError(reader.row_number, "Formula", "; ".join(e.messages)))
+                continue
+
+            # Skip the valid rows replaced by a later row, the invalid ones are still reported
+            last_row = duplicates.get(values["internal_id"], reader.row_number) if duplicates else reader.row_number
+            if last_row != reader.row_number and product_key(record) is not None:
+                continue
+
+            yield values
+
+    result = bulk_upsert(
+        Product,
+        products(),
+        "internal_id",
+        PRODUCT_IMPORT_FIELDS,
+        hash_field="import_hash",
+        row_number=lambda: reader.row_number,
+        columns=PRODUCT_IMPORT_COLUMNS,
+    )
+    result["errors"] = sorted(errors + result["errors"], key=lambda error: (error.row is None, error.row or 0))
+    return result
+
+
+def product_import_context(result: dict, removed: list = None) -> dict:
+    """
+    Build the report of a product import from the `bulk_upsert` result (or the merged chunk reports).
+
+    :param result: Counts, added/changed Internal IDs and errors of the import.
+    :param removed: Internal IDs of the products that are not in the file, when the changes are detected.
+    :return: The context returned by `import_product_from_file`.
+    """
+    context = {
+        "created": result["created"],
+        "updated": result["updated"],
+        "unchanged": result["unchanged"],
+        "errors": result["errors"],
+    }
+    if removed is not None:
+        context["changes"] = {"added": result["added"], "changed": result["changed"], "removed": removed}
+
+    if context["errors"]:
+        LOGGER.info(f"Skipped {len(context['errors']):,} product rows")
 
     return context
 
 
+def import_product_from_file(
+    file: InMemoryUploadedFile, detect_changes: bool = False, chunk_size: int = None, max_workers: int = None
+) -> dict:
+    """
+    Imports product data from an uploaded Excel or CSV file.
+
+    With `chunk_size`, the file is split into chunks of rows imported by `max_workers` processes, see
+    `import_product_chunks`.
+
+    :prams file (File): The uploaded file containing product data.
+    :param detect_changes: Also return the Internal IDs of the added, changed and removed rows in 'changes'.
+    :param chunk_size: Optional number of rows per chunk.
+    :param max_workers: Number of processes importing the chunks, they are imported one by one by default.
+    :return: A context dictionary with the created/updated/unchanged product counts and the skipped rows in
+            'errors' (see `RowError`), or an error if the columns do not match.
+    """
+    try:
+        reader = open_product_file(file)
+    except SpreadsheetError as e:
+        return {"error": str(e)}
+
+    if chunk_size:
+        return import_product_chunks(reader, chunk_size, detect_changes, max_workers)
+
+    result = upsert_products(reader)
+    removed = removed_keys(Product, "internal_id", result["keys"]) if detect_changes else None
+    return product_import_context(result, removed)
+
+
+def split_product_file(reader: SpreadsheetReader, chunk_size: int) -> dict:
+    """
+    Split a product file into chunks of `chunk_size` rows, see `write_chunks`.
+    """
+    return write_chunks(reader, chunk_size, f"imports/product/chunks/{uuid.uuid4().hex}", key=product_key)
+
+
+def import_product_chunk(path: str, duplicates: list) -> dict:
+    """
+    Import one chunk of a product file (see `split_product_file`) in a transaction.
+
+    NOTE: The report of the chunk is saved next to it once committed. A retried chunk returns the saved report
+    instead of importing the rows again, so the merged report is the same whether chunks are retried or not.
+
+    :param path: Path of the chunk in the default storage.
+    :param duplicates: `[internal_id, row]` pairs of the Internal IDs found on several rows of the file.
+    :return: JSON serializable report with the counts, the added/changed Internal IDs and the errors as
+        `[row, column, reason]` lists.
+    """
+    report_path = f"{path}.report.json"
+    if default_storage.exists(report_path):
+        with default_storage.open(report_path, "rb") as report_file:
+            return json.load(report_file)
+
+    with default_storage.open(path, "rb") as chunk_file, transaction.atomic():
+        result = upsert_products(ChunkReader(chunk_file), dict(duplicates))
+
+    report = {key: result[key] for key in ("created", "updated", "unchanged", "added", "changed")}
+    report["errors"] = [list(error) for error in result["errors"]]
+    default_storage.save(report_path, ContentFile(json.dumps(report).encode()))
+    return report
+
+
+def merge_product_reports(reports: list) -> dict:
+    """
+    Merge the chunk reports, in file order, into one result (see `product_import_context`).
+    """
+    result = {"created": 0, "updated": 0, "unchanged": 0, "added": [], "changed": [], "errors": []}
+    for report in reports:
+        for key in ("created", "updated", "unchanged"):
+            result[key] += report[key]
+        result["added"].extend(report["added"])
+        result["changed"].extend(report["changed"])
+        result["errors"].extend(RowError(*error) for error in report["errors"])
+
+    return result
+
+
+def delete_product_chunks(paths: list) -> None:
+    """Delete the chunk files of a product file and their reports."""
+    for path in paths:
+        default_storage.delete(path)
+        default_storage.delete(f"{path}.report.json")
+
+
+def import_product_chunks(
+    reader: SpreadsheetReader, chunk_size: int, detect_changes: bool = False, max_workers: int = None
+) -> dict:
+    """
+    Import a product file split into chunks of rows, each chunk is validated and upserted by a worker process.
+
+    The result doesn't depend on the number of workers: the reports are merged in file order and the last row
+    of an Internal ID wins, like in a single process import.
+
+    NOTE: The workers are forked, so they inherit the Django setup and open their own database connection.
+    SQLite allows a single writer, the chunks are then imported one by one.
+
+    :param reader: Reader of the product file, see `open_product_file`.
+    :param chunk_size: Number of rows per chunk.
+    :param detect_changes: Also return the Internal IDs of the added, changed and removed rows in 'changes'.
+    :param max_workers: Number of worker processes, the chunks are imported one by one by default.
+    :return: The context of `import_product_from_file`.
+    """
+    chunks = split_product_file(reader, chunk_size)
+    duplicates = list(chunks["duplicates"].items())
+    removed = removed_keys(Product, "internal_id", chunks["keys"]) if detect_changes else None
+
+    try:
+        if max_workers and max_workers > 1 and len(chunks["paths"]) > 1 and connection.vendor != "sqlite":
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context("fork")) as executor:
+                reports = list(executor.map(import_product_chunk, chunks["paths"], repeat(duplicates)))
+        else:
+            reports = [import_product_chunk(path, duplicates) for path in chunks["paths"]]
+    finally:
+        delete_product_chunks(chunks["paths"])
+
+    return product_import_context(merge_product_reports(reports), removed)
+
+
+@shared_task(bind=True, max_retries=3)
+def import_product_chunk_task(self, path: str, duplicates: list) -> dict:
+    """
+    Celery task importing one chunk of a product file, see `import_product_chunk`.
+
+    NOTE: The chunk is retried on database errors (e.g. a lock timeout), its rows are rolled back on failure.
+    """
+    try:
+        return import_product_chunk(path, duplicates)
+    except DatabaseError as e:
+        LOGGER.warning(f"[import_product_chunk_task] {path}: {e}")
+        raise self.retry(exc=e, countdown=5)
+
+
 def import_additional_material_from_file(file: InMemoryUploadedFile) -> dict:
     """
     Imports additional material data from an uploaded Excel or CSV file.
 
     :prams file (File): The uploaded file containing product data.
-    :return: A context dictionary with messages about created/updated products
-            or errors if the columns do not match or records are skipped.
+    :return: A context dictionary with the created/updated/unchanged material counts and the skipped rows in
+            'errors' (see `RowError`), or an error if the columns do not match.
     """
     # Define the expected columns
     expected_columns = {
@@ -139,59 +390,51 @@ def import_additional_material_from_file(file: InMemoryUploadedFile) -> dict:
     if file.size == 0:
         return {"error": "You are trying to upload an empty file."}
 
-    # Determine file type and load data
+    # Open the file, the rows are read while they are imported
     try:
-        file_extension = os.path.splitext(file.name)[1]
-        if file_extension == ".csv":
-            df = pd.read_csv(file)
-        elif file_extension in {".xlsx", ".xls"}:
-            excel_file = pd.ExcelFile(file)
-            if len(excel_file.sheet_names) > 1:
-                return {"error": "The file with multiple sheets won't be processed"}
-            df = pd.read_excel(excel_file, sheet_name=0)
-        else:
-            return {"error": "Unsupported file format."}
-    except (ImportError, pd.errors.EmptyDataError) as e:
-        return {"error": f"Failed to process the file: {str(e)}."}
+        reader = SpreadsheetReader(file)
+    except SpreadsheetError as e:
+        return {"error": str(e)}
+
+    if reader.sheet_count > 1:
+        return {"error": "The file with multiple sheets won't be processed"}
 
-    # Check if DataFrame is empty or columns don't match
-    if df.empty or set(df.columns) != expected_columns:
+    # Check if the file is empty or columns don't match
+    if reader.empty or set(reader.columns) != expected_columns:
         return {"error": "The columns do not match or the file is empty."}
 
-    df = df.fillna("")
-    records = df.to_dict(orient="records")
-    context = {"messages": []}
-    skipped_material = []
-
-    # Validate 'Internal ID' and process records
-    for record in records:
-        material_id = record["Material ID"]
-
-        # Prepare data for updating or creating the product
-        material_data = {
-            "material_name": record["Material Name"],
-            "material_type": record["Material Type"],
-            "product_item_number": record["Product Item Number"],
-            "material_factor": record["Material Factor"],
-            "additional_material_factor": record["Additional Material Factor"],
-        }
-
-        try:
-            if material_id:
-                print("-=-=-====-==---")
-                material, created = AdditionalMaterials.objects.update_or_create(
-                    material_id=material_id,
-                    defaults=material_data,
-                )
-                print("-=-=-====-==--- 2")
-                action = "Created" if created else "Updated"
-                context["messages"].append(f"{action} Material with Internal ID: {material_id}")
-        except Exception as e:
-            print("-=-=-=-=-=-=-=-=")
-            skipped_material.append(record)
-            context["messages"].append(f"Error processing record: {record}. Error: {str(e)}")
-
-    if skipped_material:
-        LOGGER.info(f"Skipped Records: {skipped_material}")
+    context = {"errors": []}
+
+    def materials():
+        for record in reader:
+            material_id = record["Material ID"]
+            if not material_id:
+                context["errors"].append(RowError(reader.row_number, "Material ID", "Missing value."))
+                continue
+
+            yield {
+                "material_id": material_id,
+                "material_name": record["Material Name"],
+                "material_type": record["Material Type"],
+                "product_item_number": record["Product Item Number"],
+                "material_factor": record["Material Factor"] if record["Material Factor"] != "" else None,
+                "additional_material_factor": (
+                    record["Additional Material Factor"] if record["Additional Material Factor"] != "" else None
+                ),
+            }
+
+    result = bulk_upsert(
+        AdditionalMaterials,
+        materials(),
+        "material_id",
+        ADDITIONAL_MATERIAL_IMPORT_FIELDS,
+        row_number=lambda: reader.row_number,
+        columns=ADDITIONAL_MATERIAL_IMPORT_COLUMNS,
+    )
+    context.update(created=result["created"], updated=result["updated"], unchanged=result["unchanged"])
+    context["errors"].extend(result["errors"])
+
+    if context["errors"]:
+        LOGGER.info(f"Skipped {len(context['errors']):,} additional material rows")
 
     return context
@@ -1 +1,319 @@
-# Create your tests here.
+import tempfile
+from decimal import Decimal
+from io import BytesIO
+from unittest import mock, skipIf, skipUnless
+
+import openpyxl
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, connection
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from apps.proposal.product.formula import FormulaError, compile_formula, validate_formula
+from apps.proposal.product.models import Product
+from apps.proposal.product.search import search_products
+from apps.proposal.product import tasks
+from apps.proposal.product.tasks import (
+    delete_product_chunks,
+    import_product_chunk,
+    import_product_chunk_task,
+    import_product_from_file,
+    open_product_file,
+    split_product_file,
+)
+from apps.spreadsheet import SpreadsheetReader
+
+
+def create_product(internal_id: int, **fields) -> Product:
+    """Create a product with the required fields filled."""
+    defaults = {
+        "family": "Family",
+        "parent": "Parent",
+        "description": "",
+        "primary_units_type": "Each",
+        "primary_stock_unit": "Each",
+        "std_cost": "1.00",
+        "preferred_vendor": "Vendor",
+    }
+    defaults.update(fields)
+    return Product.objects.create(internal_id=internal_id, **defaults)
+
+
+def explain(queryset: QuerySet) -> str:
+    """
+    EXPLAIN plan of a queryset, PostgreSQL only.
+
+    NOTE: Sequential scans are disabled for the rest of the test transaction, so the plan uses an index whenever
+    one matches the query, however few rows the test tables have.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SET LOCAL enable_seqscan = off")
+    return queryset.explain()
+
+
+class FormulaTests(SimpleTestCase):
+    """Sandbox of the product formulas, see `apps.proposal.product.formula`."""
+
+    def test_evaluate(self):
+        self.assertEqual(compile_formula("ProductCode=[101, 102], $qty * $amf / 100").product_codes, (101, 102))
+        self.assertAlmostEqual(compile_formula("ProductCode=[101], $qty * $amf / 100").evaluate([10, 20], 2), 0.6)
+        self.assertEqual(compile_formula("math.ceil($qty / 20)").evaluate([1, 21], 1), 3)
+        self.assertEqual(compile_formula("math.ceil($qty / 20)").evaluate([1, 21], 1, [2, 3]), 8)
+        self.assertEqual(compile_formula("max($qty, 1) ** 2").evaluate([0.5, 2], 1), 5.0)
+        self.assertEqual(compile_formula("round($qty, 2)").evaluate([1.234], 1), 1.23)
+
+    def test_reject_unsafe_powers(self):
+        for expression in (
+            "9**9**9",
+            "(((99**99)**99)**99)**99",
+            "(99**99 * 99**99) ** 99",
+            "2 ** abs(1000)",
+            "$qty ** (10 * 11)",
+        ):
+            with self.subTest(expression=expression), self.assertRaises(FormulaError):
+                compile_formula(expression)
+
+    def test_reject_attributes_and_names(self):
+        for expression in ("math.__class__", "math.__init__()", "math", "abs + 1", "math.sqrt($qty)", "__import__"):
+            with self.subTest(expression=expression), self.assertRaises(FormulaError):
+                compile_formula(expression)
+
+    def test_reject_wrong_arity(self):
+        for expression in ("min()", "max($qty)", "abs($qty, 2)", "math.ceil()", "round($qty, 1, 2)"):
+            with self.subTest(expression=expression), self.assertRaises(FormulaError):
+                compile_formula(expression)
+
+    def test_reject_round_decimals(self):
+        for expression in ("round($qty, 10**100)", "round($qty, 1.5)", "round($qty, $amf)"):
+            with self.subTest(expression=expression), self.assertRaises(FormulaError):
+                compile_formula(expression)
+
+    def test_validate_formula(self):
+        validate_formula(None)
+        validate_formula("")
+        validate_formula("ProductCode=[101], $qty * $amf")
+        with self.assertRaises(ValidationError):
+            validate_formula("ProductCode=[101], min()")
+
+
+@skipUnless(connection.vendor == "postgresql", "PostgreSQL indexes")
+class ProductIndexTests(TestCase):
+    """Indexes of the catalog lookups (migration 0003), see `Product.get_by_display_name`."""
+
+    def setUp(self):
+        create_product(1, display_name="PVC ELBOW 2", name="Elbow")
+        create_product(2, display_name="PVC TEE 2", name="Tee")
+
+    def test_display_name_key(self):
+        plan = explain(Product.objects.filter(display_name_key__in=["PVC ELBOW 2", "PVC TEE 2"]))
+        self.assertRegex(plan, r"(using|on) product_product_display_name_key_\w+")
+
+    def test_display_name_trigram(self):
+        plan = explain(Product.objects.filter(display_name__icontains="elbow"))
+        self.assertIn("product_display_name_trgm_idx", plan)
+
+
+class SearchProductsTests(TestCase):
+    """Search of the product pickers, see `apps.proposal.product.search`."""
+
+    def setUp(self):
+        self.elbow = create_product(1, display_name="PVC ELBOW 2", name="Elbow 2in", description="PVC elbow fitting")
+        self.pipe = create_product(2, display_name="PIPE 2", name="PVC pipe", description="PVC pipe for an elbow")
+        self.tee = create_product(3, display_name="PVC TEE 2", name="Tee 2in", description="PVC tee fitting")
+        create_product(4, display_name="", name="")
+
+    def search(self, search_term: str, field: str = "display_name", **kwargs) -> list:
+        return list(search_products(search_term, field, **kwargs))
+
+    def test_without_terms(self):
+        self.assertEqual(self.search(" "), [self.elbow, self.pipe, self.tee])
+        self.assertEqual(self.search("", "name", limit=2), [self.elbow, self.pipe])
+
+    @skipIf(connection.vendor == "postgresql", "icontains fallback of the other databases")
+    def test_icontains(self):
+        self.assertEqual(self.search("pvc 2"), [self.elbow, self.tee])
+        self.assertEqual(self.search("ELB pvc"), [self.elbow])
+        self.assertEqual(self.search("pvc", "name"), [self.pipe])
+        self.assertEqual(self.search("2", limit=1), [self.elbow])
+        self.assertEqual(self.search("elbows"), [])
+
+    @skipUnless(connection.vendor == "postgresql", "PostgreSQL search")
+    def test_rank(self):
+        # Matches of the picker field first, then of the other fields
+        self.assertEqual(self.search("pvc elb"), [self.elbow, self.pipe])
+        self.assertEqual(self.search("pvc", "name"), [self.pipe, self.elbow, self.tee])
+        self.assertEqual(self.search("pvc", limit=2), [self.elbow, self.tee])
+
+    @skipUnless(connection.vendor == "postgresql", "PostgreSQL search")
+    def test_trigram(self):
+        # Not a prefix of any word, close to "ELBOW"
+        self.assertEqual(self.search("elbows"), [self.elbow])
+
+    @skipUnless(connection.vendor == "postgresql", "PostgreSQL search")
+    def test_indexes(self):
+        plan = explain(search_products("pvc elb", "display_name"))
+        self.assertIn("product_search_vector_idx", plan)
+        self.assertIn("product_display_name_trgm_idx", plan)
+
+        plan = explain(search_products("pvc elb", "name"))
+        self.assertIn("product_search_vector_idx", plan)
+        self.assertIn("product_name_trgm_idx", plan)
+
+
+# Columns of the product files of the import tests
+PRODUCT_COLUMNS = ["Internal ID", "Name", "Description", "Display Name", "Std Cost", "Formula"]
+
+
+def product_csv(*rows, name: str = "products.csv") -> SimpleUploadedFile:
+    """Build a product CSV file from rows of `PRODUCT_COLUMNS` values."""
+    lines = [",".join(PRODUCT_COLUMNS)] + [",".join(str(value) for value in row) for row in rows]
+    return SimpleUploadedFile(name, "\n".join(lines).encode())
+
+
+def product_xlsx(*rows, name: str = "products.xlsx") -> SimpleUploadedFile:
+    """Build a product workbook from rows of `PRODUCT_COLUMNS` values, the numbers stored as numbers."""
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(PRODUCT_COLUMNS)
+    for row in rows:
+        sheet.append(row)
+    content = BytesIO()
+    workbook.save(content)
+    return SimpleUploadedFile(name, content.getvalue())
+
+
+class ProductImportTests(TestCase):
+    """Import of a product file, see `apps.proposal.product.tasks.import_product_from_file`."""
+
+    ROWS = [
+        (1, "Elbow", "PVC elbow", "PVC ELBOW 2", "1.50", ""),
+        (2, "Pipe", "PVC pipe", "PIPE 2", "3.00", "math.ceil($qty/20)"),
+        (3, "Tee", "PVC tee", "PVC TEE 2", "2.25", ""),
+    ]
+
+    def test_reimport_counts(self):
+        result = import_product_from_file(product_csv(*self.ROWS))
+        self.assertEqual((result["created"], result["updated"], result["unchanged"]), (3, 0, 0))
+        updated_at = dict(Product.objects.values_list("internal_id", "updated_at"))
+
+        # The same file again: every row has the hash of its stored values, nothing is written
+        with CaptureQueriesContext(connection) as context:
+            result = import_product_from_file(product_csv(*self.ROWS), detect_changes=True)
+        self.assertEqual((result["created"], result["updated"], result["unchanged"]), (0, 0, 3))
+        self.assertEqual(result["changes"], {"added": [], "changed": [], "removed": []})
+        self.assertFalse([query for query in context.captured_queries if query["sql"].startswith(("INSERT", "UPDATE"))])
+        self.assertEqual(dict(Product.objects.values_list("internal_id", "updated_at")), updated_at)
+
+        # One row changed, one added and one removed
+        rows = [
+            self.ROWS[0],
+            (2, "Pipe", "PVC pipe", "PIPE 2", "3.50", "math.ceil($qty/20)"),
+            (4, "Cap", "", "CAP", 1, ""),
+        ]
+        result = import_product_from_file(product_csv(*rows), detect_changes=True)
+        self.assertEqual((result["created"], result["updated"], result["unchanged"]), (1, 1, 1))
+        self.assertEqual(result["changes"], {"added": [4], "changed": [2], "removed": [3]})
+        self.assertEqual(Product.objects.get(internal_id=2).std_cost, Decimal("3.50"))
+
+    def test_reimport_edited_product(self):
+        import_product_from_file(product_csv(*self.ROWS))
+        product = Product.objects.get(internal_id=1)
+        product.name = "Edited"
+        product.save()
+        self.assertIsNone(Product.objects.get(internal_id=1).import_hash)
+
+        # The edited row is compared field by field and written back, the others are skipped by their hash
+        result = import_product_from_file(product_csv(*self.ROWS))
+        self.assertEqual((result["created"], result["updated"], result["unchanged"]), (0, 1, 2))
+        self.assertEqual(Product.objects.get(internal_id=1).name, "Elbow")
+        self.assertIsNotNone(Product.objects.get(internal_id=1).import_hash)
+
+    def test_csv_and_xlsx(self):
+        # Numbers typed in the workbook, a blank row and an invalid Internal ID
+        rows = [
+            *self.ROWS[:2],
+            ("", "", "", "", "", ""),
+            ("X", "Bad", "", "", "", ""),
+            (3, "Tee", "PVC tee", "", 2.25, ""),
+        ]
+        xlsx_rows = [[float(value) if value == "3.00" else value for value in row] for row in rows]
+        fields = ("internal_id", "name", "description", "display_name", "display_name_key", "std_cost", "formula")
+
+        def read(file) -> list:
+            reader = SpreadsheetReader(file)
+            return [reader.columns] + [(reader.row_number, str(record["Internal ID"])) for record in reader]
+
+        self.assertEqual(read(product_csv(*rows)), read(product_xlsx(*xlsx_rows)))
+
+        def import_file(file) -> tuple:
+            Product.objects.all().delete()
+            result = import_product_from_file(file)
+            errors = [(error.row, error.column) for error in result["errors"]]
+            return result["created"], errors, list(Product.objects.order_by("internal_id").values(*fields))
+
+        imported = import_file(product_csv(*rows))
+        self.assertEqual(imported, import_file(product_xlsx(*xlsx_rows)))
+        self.assertEqual(imported[:2], (3, [(5, "Internal ID")]))
+
+
+class ProductChunkImportTests(TestCase):
+    """Import of a product file split into chunks, see `apps.proposal.product.tasks.import_product_chunks`."""
+
+    ROWS = [(internal_id, f"Product {internal_id}", "PVC", "", "1.00", "") for internal_id in range(1, 6)]
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        storage = override_settings(
+            DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage", MEDIA_ROOT=media_root.name
+        )
+        storage.enable()
+        self.addCleanup(storage.disable)
+
+    def split(self) -> dict:
+        chunks = split_product_file(open_product_file(product_csv(*self.ROWS)), 2)
+        self.addCleanup(delete_product_chunks, chunks["paths"])
+        return chunks
+
+    def test_chunks_and_single_import(self):
+        result = import_product_from_file(product_csv(*self.ROWS), detect_changes=True, chunk_size=2)
+        products = list(Product.objects.order_by("internal_id").values("internal_id", "name", "std_cost"))
+        Product.objects.all().delete()
+
+        self.assertEqual(result, import_product_from_file(product_csv(*self.ROWS), detect_changes=True))
+        self.assertEqual(
+            list(Product.objects.order_by("internal_id").values("internal_id", "name", "std_cost")), products
+        )
+
+    def test_chunk_imported_once(self):
+        path = self.split()["paths"][0]
+        report = import_product_chunk(path, [])
+        self.assertEqual((report["created"], report["added"]), (2, [1, 2]))
+
+        # A retried chunk returns its saved report without writing
+        Product.objects.filter(internal_id=1).update(name="Renamed")
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(import_product_chunk(path, []), report)
+        self.assertFalse(context.captured_queries)
+        self.assertEqual(Product.objects.get(internal_id=1).name, "Renamed")
+
+    def test_task_retry(self):
+        path = self.split()["paths"][1]
+        upsert = tasks.upsert_products
+        calls = []
+
+        def upsert_products(reader, duplicates=None):
+            # The first attempt fails, like on a lock timeout
+            calls.append(path)
+            if len(calls) == 1:
+                raise DatabaseError("lock timeout")
+            return upsert(reader, duplicates)
+
+        with mock.patch.object(tasks, "upsert_products", side_effect=upsert_products):
+            report = import_product_chunk_task.apply(args=[path, []]).get()
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual((report["created"], report["updated"], report["added"]), (2, 0, [3, 4]))
+        self.assertEqual(list(Product.objects.order_by("internal_id").values_list("internal_id", flat=True)), [3, 4])
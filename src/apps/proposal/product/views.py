@@ -1,11 +1,12 @@
-from django.contrib import messages
 from django.db.models import Q
 from django.http import JsonResponse
 from django.urls import reverse
 
 from apps.mixin import CustomDataTableMixin, FormViewMixin, ProposalViewMixin
-from apps.proposal.product import forms, tasks
+from apps.proposal.models import ImportJob
+from apps.proposal.product import forms
 from apps.proposal.product.models import AdditionalMaterials, Product
+from apps.proposal.tasks import start_import_job
 
 
 # Create your views here.
@@ -88,25 +89,26 @@ class ProductImportView(FormViewMixin):
     form_class = forms.ImportProductForm
 
     def form_valid(self, form):
-        """Handle valid form submission and import products."""
+        """
+        Handle valid form submission and queue the product import.
+
+        NOTE: The response contains the job id and the URL to poll for its status, see `ImportJobStatusView`.
+        """
         csv_file = form.cleaned_data["csv_file"]
-        response = tasks.import_product_from_file(csv_file)
+        job = start_import_job(
+            ImportJob.PRODUCT, csv_file, self.request.user, detect_changes=form.cleaned_data["detect_changes"]
+        )
 
-        if "error" in response:
-            form.add_error("csv_file", response["error"])
+        if job.status == ImportJob.FAILED:
+            form.add_error("csv_file", job.error)
             return self.render_to_response(self.get_context_data(form=form), status=201)
 
-        # Count successful imports
-        messages_list = response.get("messages", [])
-        import_count = len([m for m in messages_list if "Created" in m or "Updated" in m])
-
         return JsonResponse(
             {
+                **job.as_dict(),
                 "redirect": reverse("proposal_app:product:product-list"),
-                "message": f"✓ {import_count:,} products imported successfully! Search for a product to test it.",
                 "status": "success",
-                "code": 200,
-                "import_count": import_count,
+                "code": 202,
             }
         )
 
@@ -168,19 +170,19 @@ class AdditionalMaterialImportView(FormViewMixin):
     form_class = forms.ImportMaterialForm
 
     def form_valid(self, form):
-        """Handle valid form submission and import additional material."""
+        """Handle valid form submission and queue the additional material import."""
         csv_file = form.cleaned_data["csv_file"]
-        response = tasks.import_additional_material_from_file(csv_file)
+        job = start_import_job(ImportJob.ADDITIONAL_MATERIAL, csv_file, self.request.user)
 
-        if "error" in response:
-            form.add_error("csv_file", response["error"])
+        if job.status == ImportJob.FAILED:
+            form.add_error("csv_file", job.error)
             return self.render_to_response(self.get_context_data(form=form), status=201)
 
-        messages.success(self.request, "Additional Material imported successfully!")
         return JsonResponse(
             {
+                **job.as_dict(),
                 "status": "success",
-                "code": 200,
+                "code": 202,
             }
         )
 
@@ -3,9 +3,10 @@ from django.http import JsonResponse
 from django.urls import reverse
 
 from apps.mixin import CustomDataTableMixin, FormViewMixin, ProposalViewMixin
+from apps.proposal.models import ImportJob
 from apps.proposal.task.forms import ImportTaskForm
 from apps.proposal.task.models import Task
-from apps.proposal.task.tasks import import_task_from_file
+from apps.proposal.tasks import start_import_job
 
 
 class TaskListView(ProposalViewMixin):
@@ -66,23 +67,21 @@ class TaskImportView(FormViewMixin):
 
     def form_valid(self, form):
         """
-        Process valid form submission and import tasks.
+        Process valid form submission and queue the task import.
         """
         csv_file = form.cleaned_data["csv_file"]
-        # To check file size
-        # file_size = csv_file.size
 
-        response = import_task_from_file(csv_file)
-        if response.get("error"):
-            form.add_error("csv_file", response["error"])
+        job = start_import_job(ImportJob.TASK, csv_file, self.request.user)
+        if job.status == ImportJob.FAILED:
+            form.add_error("csv_file", job.error)
             return self.render_to_response(self.get_context_data(form=form), status=201)
 
         return JsonResponse(
             {
+                **job.as_dict(),
                 "redirect": reverse("proposal_app:task:task-list"),
-                "message": "Task imported successfully!",
                 "status": "success",
-                "code": 200,
+                "code": 202,
             }
         )
 
@@ -0,0 +1,194 @@
+from typing import Optional
+
+from celery import chord, shared_task
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from kombu.exceptions import OperationalError
+
+from apps.constants import BULK_CREATE_BATCH_SIZE, ERROR_RESPONSE, LOGGER, PRODUCT_IMPORT_CHUNK_SIZE
+from apps.proposal.product.models import Product
+from apps.proposal.product.tasks import (
+    delete_product_chunks,
+    import_product_chunk,
+    import_product_chunk_task,
+    merge_product_reports,
+    open_product_file,
+    product_import_context,
+    split_product_file,
+)
+from apps.spreadsheet import SpreadsheetError
+from apps.upsert import removed_keys
+
+from .models import ImportJob, ImportJobError
+
+# Import function of each kind of job, called with the uploaded file and the job options
+IMPORTERS = {
+    ImportJob.PRODUCT: "apps.proposal.product.tasks.import_product_from_file",
+    ImportJob.ADDITIONAL_MATERIAL: "apps.proposal.product.tasks.import_additional_material_from_file",
+    ImportJob.CUSTOMER: "apps.proposal.customer.tasks.import_customer_from_xlsx",
+    ImportJob.VENDOR: "apps.proposal.vendor.tasks.import_vendor_from_file",
+    ImportJob.TASK: "apps.proposal.task.tasks.import_task_from_file",
+    ImportJob.LABOUR_COST: "apps.proposal.labour_cost.tasks.import_labour_cost_from_xlsx",
+}
+
+
+def start_import_job(kind: str, file: File, user=None, **options) -> ImportJob:
+    """
+    Save an uploaded file and queue its import.
+
+    NOTE: If the Celery broker is not available, the file is imported in the current request and the returned
+    job is already finished.
+
+    :param kind: Kind of import, one of `ImportJob.KIND_CHOICES`.
+    :param file: Uploaded file.
+    :param user: User who uploaded the file, if authenticated.
+    :param options: Keyword arguments of the import function, e.g. `detect_changes`.
+    :return: The import job.
+    """
+    file_path = default_storage.save(f"imports/{kind}/{file.name}", file)
+    job = ImportJob.objects.create(
+        kind=kind,
+        file_name=file.name,
+        file_path=file_path,
+        options=options,
+        created_by=user if user and user.is_authenticated else None,
+    )
+
+    try:
+        run_import_job.delay(job.id)
+    except OperationalError as e:
+        LOGGER.warning(f"[start_import_job] Celery broker unavailable, importing {file_path} synchronously: {e}")
+        run_import_job.apply(args=(job.id,))
+
+    job.refresh_from_db()
+    return job
+
+
+@shared_task(bind=True)
+def run_import_job(self, job_id: int) -> dict:
+    """
+    Import the file of an import job and record the counts, timing and invalid rows.
+
+    NOTE: The importers read the file lazily and write it in batches of `BULK_CREATE_BATCH_SIZE` rows (see
+    `apps.upsert.bulk_upsert`). Product files larger than `PRODUCT_IMPORT_CHUNK_SIZE` rows are split into chunks
+    imported in parallel by a Celery chord, the job is then finished by `finish_product_import_job`.
+
+    :param job_id: Id of the `ImportJob`.
+    :return: The status of the job, see `ImportJob.as_dict`.
+    """
+    job = ImportJob.objects.get(pk=job_id)
+    job.status = ImportJob.RUNNING
+    job.started_at = timezone.now()
+    job.save(update_fields=["status", "started_at", "updated_at"])
+
+    try:
+        with default_storage.open(job.file_path, "rb") as file:
+            if job.kind == ImportJob.PRODUCT and not self.request.is_eager:
+                result = start_product_import_chunks(job, file)
+            else:
+                result = import_string(IMPORTERS[job.kind])(file, **job.options)
+    except Exception as e:
+        LOGGER.error(f"[run_import_job] {job.kind} job {job.id}: {e}")
+        result = {"error": ERROR_RESPONSE["message"]}
+    finally:
+        default_storage.delete(job.file_path)
+
+    if result is None:
+        # The chunks are being imported
+        return job.as_dict()
+
+    return finish_import_job(job, result)
+
+
+def finish_import_job(job: ImportJob, result: dict) -> dict:
+    """
+    Record the result of an import function on its job.
+
+    :param job: The running job.
+    :param result: Context returned by the import function, with the counts and 'errors' or an 'error'.
+    :return: The status of the job, see `ImportJob.as_dict`.
+    """
+    if result.get("error"):
+        job.status = ImportJob.FAILED
+        job.error = result["error"]
+    else:
+        errors = result.get("errors", [])
+        ImportJobError.objects.bulk_create(
+            (ImportJobError(job=job, row=row, column=column, reason=reason) for row, column, reason in errors),
+            batch_size=BULK_CREATE_BATCH_SIZE,
+        )
+        job.status = ImportJob.SUCCESS
+        job.created_count = result["created"]
+        job.updated_count = result["updated"]
+        job.unchanged_count = result["unchanged"]
+        job.error_count = len(errors)
+        job.changes = result.get("changes")
+
+    job.finished_at = timezone.now()
+    job.save()
+    LOGGER.info(f"[run_import_job] {job.kind} job {job.id}: {job.get_message()} in {job.duration:.1f}s")
+
+    return job.as_dict()
+
+
+def start_product_import_chunks(job: ImportJob, file: File) -> Optional[dict]:
+    """
+    Split the product file of a job into chunks and queue a chord importing them.
+
+    NOTE: The removed products are found before the chunks are imported, the import never deletes products and
+    only adds the Internal IDs of the file.
+
+    :param job: The running product import job.
+    :param file: The uploaded product file.
+    :return: None once the chord is queued, or the result of the import when the file fits in one chunk or
+        can't be read.
+    """
+    try:
+        reader = open_product_file(file)
+    except SpreadsheetError as e:
+        return {"error": str(e)}
+
+    chunks = split_product_file(reader, PRODUCT_IMPORT_CHUNK_SIZE)
+    duplicates = list(chunks["duplicates"].items())
+    removed = removed_keys(Product, "internal_id", chunks["keys"]) if job.options.get("detect_changes") else None
+
+    if len(chunks["paths"]) == 1:
+        try:
+            report = import_product_chunk(chunks["paths"][0], duplicates)
+        finally:
+            delete_product_chunks(chunks["paths"])
+        return product_import_context(merge_product_reports([report]), removed)
+
+    callback = finish_product_import_job.s(job.id, chunks["paths"], removed).on_error(
+        fail_import_job.si(job.id, chunks["paths"])
+    )
+    chord(import_product_chunk_task.s(path, duplicates) for path in chunks["paths"])(callback)
+    LOGGER.info(f"[run_import_job] product job {job.id}: importing {len(chunks['paths'])} chunks")
+    return None
+
+
+@shared_task
+def finish_product_import_job(reports: list, job_id: int, paths: list, removed: list = None) -> dict:
+    """
+    Chord callback merging the chunk reports of a product import job, see `start_product_import_chunks`.
+
+    :param reports: Reports of the chunks, in file order.
+    :param job_id: Id of the `ImportJob`.
+    :param paths: Paths of the chunk files.
+    :param removed: Internal IDs of the products that are not in the file, when the changes are detected.
+    :return: The status of the job, see `ImportJob.as_dict`.
+    """
+    delete_product_chunks(paths)
+    job = ImportJob.objects.get(pk=job_id)
+    return finish_import_job(job, product_import_context(merge_product_reports(reports), removed))
+
+
+@shared_task
+def fail_import_job(job_id: int, paths: list) -> None:
+    """Error callback of the chord of a product import job, a chunk failed after its retries."""
+    delete_product_chunks(paths)
+    job = ImportJob.objects.get(pk=job_id)
+    LOGGER.error(f"[run_import_job] product job {job.id}: a chunk failed")
+    finish_import_job(job, {"error": ERROR_RESPONSE["message"]})
@@ -0,0 +1,140 @@
+import csv
+import tempfile
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from kombu.exceptions import OperationalError
+
+from apps.proposal import tasks
+from apps.proposal.models import ImportJob
+from apps.proposal.opportunity.tests import override_celery
+from apps.proposal.product import tasks as product_tasks
+from apps.proposal.product.models import Product
+from apps.proposal.tasks import start_import_job
+from apps.proposal.vendor.models import Vendor
+
+
+class ImportJobTests(TestCase):
+    """Catalog imports processed by the `run_import_job` task, see `start_import_job`."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(email="estimator@example.com")
+        self.client.force_login(self.user)
+
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        storage = override_settings(
+            DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage", MEDIA_ROOT=media_root.name
+        )
+        storage.enable()
+        self.addCleanup(storage.disable)
+        self.addCleanup(override_celery(CELERY_TASK_ALWAYS_EAGER=True, CELERY_BROKER_URL="memory://"))
+
+    def import_vendors(self, content: bytes) -> ImportJob:
+        return start_import_job(
+            ImportJob.VENDOR, SimpleUploadedFile("vendors.csv", content), self.user, detect_changes=True
+        )
+
+    def assertFileDeleted(self, job: ImportJob):
+        """Assert the uploaded file of the job was deleted once imported."""
+        self.assertFalse(default_storage.exists(job.file_path))
+
+    def test_lifecycle(self):
+        job = self.import_vendors(b"Internal ID,Name\n1,Acme\n2,Globex\n")
+
+        self.assertEqual(job.status, ImportJob.SUCCESS)
+        self.assertEqual((job.created_count, job.updated_count, job.unchanged_count), (2, 0, 0))
+        self.assertEqual(job.created_by, self.user)
+        self.assertLessEqual(job.started_at, job.finished_at)
+        self.assertEqual(job.changes, {"added": [1, 2], "changed": [], "removed": []})
+        self.assertEqual(sorted(Vendor.objects.values_list("name", flat=True)), ["Acme", "Globex"])
+        self.assertFileDeleted(job)
+
+        job = self.import_vendors(b"Internal ID,Name\n1,Acme Inc\n2,Globex\n")
+        self.assertEqual((job.created_count, job.updated_count, job.unchanged_count), (0, 1, 1))
+
+        response = self.client.get(reverse("proposal_app:import-job-status", args=[job.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["state"], ImportJob.SUCCESS)
+        self.assertIn("0 created, 1 updated, 1 unchanged", response.json()["message"])
+
+    def test_without_broker(self):
+        with mock.patch.object(tasks.run_import_job, "delay", side_effect=OperationalError("Connection refused")):
+            job = self.import_vendors(b"Internal ID,Name\n1,Acme\n")
+
+        self.assertEqual(job.status, ImportJob.SUCCESS)
+        self.assertEqual(job.created_count, 1)
+        self.assertFileDeleted(job)
+
+    def test_product_chunk_retry(self):
+        upsert = product_tasks.upsert_products
+        calls = []
+
+        def upsert_products(reader, duplicates=None):
+            # The second chunk fails once, like on a lock timeout, and is retried by the chord
+            calls.append(reader)
+            if len(calls) == 2:
+                raise DatabaseError("lock timeout")
+            return upsert(reader, duplicates)
+
+        rows = "".join(f"{internal_id},Product {internal_id},PVC\n" for internal_id in range(1, 6))
+        file = SimpleUploadedFile("products.csv", f"Internal ID,Name,Description\n{rows}".encode())
+        job = ImportJob.objects.create(
+            kind=ImportJob.PRODUCT,
+            status=ImportJob.RUNNING,
+            file_name=file.name,
+            file_path="imports/products.csv",
+            created_by=self.user,
+            started_at=timezone.now(),
+        )
+        # The eager Celery app runs the chord of the chunks, and the callback, in the test
+        with mock.patch.object(tasks, "PRODUCT_IMPORT_CHUNK_SIZE", 2), mock.patch.object(
+            product_tasks, "upsert_products", side_effect=upsert_products
+        ):
+            self.assertIsNone(tasks.start_product_import_chunks(job, file))
+        job.refresh_from_db()
+
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(job.status, ImportJob.SUCCESS)
+        self.assertEqual((job.created_count, job.updated_count, job.error_count), (5, 0, 0))
+        self.assertEqual(
+            list(Product.objects.order_by("internal_id").values_list("internal_id", flat=True)), [1, 2, 3, 4, 5]
+        )
+        self.assertFalse(default_storage.listdir("imports/product/chunks")[1])
+
+    def test_failed(self):
+        job = self.import_vendors(b"Code,Name\n1,Acme\n")
+
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertEqual(job.error, "The columns do not match the required format.")
+        self.assertEqual(job.as_dict()["message"], job.error)
+        self.assertFalse(Vendor.objects.exists())
+        self.assertFileDeleted(job)
+
+    def test_error_report(self):
+        job = self.import_vendors(b"Internal ID,Name\n1,Acme\n,Missing\nabc,Invalid\n")
+
+        self.assertEqual(job.status, ImportJob.SUCCESS)
+        self.assertEqual((job.created_count, job.error_count), (1, 2))
+
+        response = self.client.get(reverse("proposal_app:import-job-download", args=[job.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        rows = list(csv.reader(b"".join(response.streaming_content).decode().splitlines()))
+        self.assertIn(["Errors", "2"], rows)
+        self.assertEqual(rows[rows.index(["Row", "Column", "Reason"]) + 1], ["3", "Internal ID", "Missing value."])
+        self.assertEqual(rows[-1][:2], ["4", "Internal ID"])
+
+    def test_other_user(self):
+        job = self.import_vendors(b"Internal ID,Name\n1,Acme\n")
+        self.client.force_login(get_user_model().objects.create(email="other@example.com"))
+
+        for url_name in ("proposal_app:import-job-status", "proposal_app:import-job-download"):
+            with self.subTest(url_name=url_name):
+                self.assertEqual(self.client.get(reverse(url_name, args=[job.id])).status_code, 404)
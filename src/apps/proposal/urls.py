@@ -4,6 +4,8 @@ Proposal App Configuration
 
 from django.urls import include, path
 
+from . import views
+
 urlpatterns = [
     path("", include(("apps.proposal.task.urls", "task"), namespace="task")),
     path("", include(("apps.proposal.product.urls", "product"), namespace="product")),
@@ -11,4 +13,6 @@ urlpatterns = [
     path("", include(("apps.proposal.customer.urls", "customer"), namespace="customer")),
     path("", include(("apps.proposal.labour_cost.urls", "labour_cost"), namespace="labour_cost")),
     path("", include(("apps.proposal.opportunity.urls", "opportunity"), namespace="opportunity")),
+    path("import-jobs/<int:pk>", views.ImportJobStatusView.as_view(), name="import-job-status"),
+    path("import-jobs/<int:pk>/download", views.ImportJobDownloadView.as_view(), name="import-job-download"),
 ]
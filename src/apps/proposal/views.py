@@ -0,0 +1,55 @@
+import csv
+
+from django.http import JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+
+from apps.mixin import ViewMixin
+
+from .models import ImportJob
+
+
+class Echo:
+    """File-like object returning what is written, used to stream a CSV file."""
+
+    def write(self, value):
+        return value
+
+
+class ImportJobStatusView(ViewMixin):
+    """View to poll the status of an import job, only the user who started the job can see it."""
+
+    def get(self, request, pk: int, *args, **kwargs) -> JsonResponse:
+        """Return the state of the job, with its counts and message once finished."""
+        job = get_object_or_404(ImportJob, pk=pk, created_by=request.user)
+        return JsonResponse(job.as_dict(), status=200)
+
+
+class ImportJobDownloadView(ViewMixin):
+    """View to download the report of an import job as a CSV file, only for the user who started the job."""
+
+    def get(self, request, pk: int, *args, **kwargs) -> StreamingHttpResponse:
+        """
+        Stream the summary of the job followed by its invalid rows (row number, column and reason).
+        """
+        job = get_object_or_404(ImportJob, pk=pk, created_by=request.user)
+        writer = csv.writer(Echo())
+
+        def rows():
+            yield writer.writerow(["Import", job.get_kind_display()])
+            yield writer.writerow(["File", job.file_name])
+            yield writer.writerow(["Status", job.get_status_display()])
+            yield writer.writerow(["Created", job.created_count])
+            yield writer.writerow(["Updated", job.updated_count])
+            yield writer.writerow(["Unchanged", job.unchanged_count])
+            yield writer.writerow(["Errors", job.error_count])
+            yield writer.writerow(["Duration (s)", job.duration if job.duration is not None else ""])
+            if job.error:
+                yield writer.writerow(["Error", job.error])
+            yield writer.writerow([])
+            yield writer.writerow(["Row", "Column", "Reason"])
+            for row, column, reason in job.errors.values_list("row", "column", "reason").iterator():
+                yield writer.writerow([row if row is not None else "", column, reason])
+
+        response = StreamingHttpResponse(rows(), content_type="text/csv")
+        response["Content-Disposition"] = f'attachment; filename="{job.kind}_import_{job.id}.csv"'
+        return response
@@ -0,0 +1,203 @@
+"""
+Streaming readers for the uploaded CSV/Excel files.
+"""
+
+import codecs
+import csv
+import json
+import os
+from itertools import chain
+from typing import Any, Callable, Iterator
+
+import pandas as pd
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from openpyxl import load_workbook
+
+
+class SpreadsheetError(ValueError):
+    """Raised when an uploaded file can't be read, the message can be shown to the user."""
+
+
+def iter_lines(file: File) -> Iterator[str]:
+    """
+    Read the lines of an uploaded file one chunk at a time.
+
+    NOTE: Each line is decoded as UTF-8, falling back to Latin-1 for files exported with a Windows code page, so
+    only one chunk and the current line are held in memory.
+
+    :param file: Uploaded file.
+    :return: Iterator over the decoded lines, line endings included.
+    """
+    remainder = b""
+    for index, chunk in enumerate(file.chunks()):
+        if index == 0 and chunk.startswith(codecs.BOM_UTF8):
+            chunk = chunk[len(codecs.BOM_UTF8) :]
+
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            yield _decode(line + b"\n")
+
+    if remainder:
+        yield _decode(remainder)
+
+
+def _decode(line: bytes) -> str:
+    try:
+        return line.decode("utf-8")
+    except UnicodeDecodeError:
+        return line.decode("latin-1")
+
+
+class SpreadsheetReader:
+    """
+    Read the rows of an uploaded .csv, .xlsx or .xls file as dictionaries keyed by the header row.
+
+    Rows are read lazily (`csv` for CSV files, openpyxl in read-only mode for .xlsx files), so the file is never
+    loaded in memory as a whole. Like `DataFrame.fillna("")`, empty cells are returned as "" and blank rows are
+    skipped.
+
+    NOTE: .xls files are still read with `pd.read_excel`, openpyxl doesn't support the legacy format.
+
+    `columns` is the header row, without surrounding whitespace, and `empty` is True when the file has no data rows.
+    While iterating, `row_number` is the row number of the current record in the file (the header is row 1 when
+    the file doesn't start with blank rows), so errors can point to the row to fix.
+
+    Usage::
+
+        reader = SpreadsheetReader(file)
+        if set(reader.columns) != expected_columns:
+            ...
+        for record in reader:
+            ...
+    """
+
+    def __init__(self, file: File):
+        """
+        Open the file and read its header row.
+
+        :param file: Uploaded file.
+        :raises SpreadsheetError: If the file format isn't supported or the file can't be read.
+        """
+        self.extension = os.path.splitext(file.name)[1].lower()
+        self.sheet_count = 1
+        self.row_number = None
+
+        try:
+            if self.extension == ".csv":
+                rows = csv.reader(iter_lines(file))
+            elif self.extension == ".xlsx":
+                workbook = load_workbook(file, read_only=True, data_only=True)
+                self.sheet_count = len(workbook.sheetnames)
+                rows = self._iter_workbook(workbook)
+            elif self.extension == ".xls":
+                excel_file = pd.ExcelFile(file)
+                self.sheet_count = len(excel_file.sheet_names)
+                rows = self._iter_dataframe(pd.read_excel(excel_file, sheet_name=0, header=None, dtype=object))
+            else:
+                raise SpreadsheetError("Unsupported file format.")
+
+            self._rows = (
+                (number, row)
+                for number, row in enumerate(rows, start=1)
+                if any(value not in (None, "") for value in row)
+            )
+            _, header = next(self._rows, (0, ()))
+            self._first_row = next(self._rows, None)
+            self.empty = self._first_row is None
+        except SpreadsheetError:
+            raise
+        except Exception as e:
+            raise SpreadsheetError(f"Failed to process the file: {e}.") from e
+
+        # Drop the empty trailing columns of the header row
+        header = list(header)
+        while header and header[-1] in (None, ""):
+            header.pop()
+        self.columns = [str(column).strip() if column is not None else "" for column in header]
+
+    @staticmethod
+    def _iter_workbook(workbook) -> Iterator[tuple]:
+        try:
+            yield from workbook.worksheets[0].iter_rows(values_only=True)
+        finally:
+            workbook.close()
+
+    @staticmethod
+    def _iter_dataframe(df: pd.DataFrame) -> Iterator[tuple]:
+        for row in df.itertuples(index=False, name=None):
+            yield tuple(None if pd.isna(value) else value for value in row)
+
+    def __iter__(self) -> Iterator[dict]:
+        if self._first_row is None:
+            return
+
+        first_row, self._first_row = self._first_row, None
+        for self.row_number, row in chain([first_row], self._rows):
+            yield {
+                column: "" if index >= len(row) or row[index] is None else row[index]
+                for index, column in enumerate(self.columns)
+            }
+
+
+def write_chunks(reader: SpreadsheetReader, chunk_size: int, directory: str, key: Callable[[dict], Any] = None) -> dict:
+    """
+    Split the rows of a reader into chunk files of `chunk_size` rows in the default storage, so they can be
+    imported by several workers (see `ChunkReader`).
+
+    Each chunk is a JSON lines file: the header row, then `[row number, values]` for each row, so the errors of a
+    chunk still point to the row of the uploaded file.
+
+    NOTE: The keys are kept in memory to find the duplicates, one entry per row.
+
+    :param reader: Reader of the uploaded file.
+    :param chunk_size: Number of rows per chunk.
+    :param directory: Directory of the chunk files in the default storage.
+    :param key: Optional function returning the unique key of a record, or None if the record has no valid key.
+    :return: Dictionary with the chunk `paths` in file order, the set of `keys` and the `duplicates`, mapping the
+        keys found on several rows to the row number of their last occurrence.
+    """
+    paths, last_rows, duplicates, lines = [], {}, {}, []
+
+    def flush():
+        content = "\n".join([json.dumps(reader.columns), *lines])
+        path = f"{directory}/chunk-{len(paths) + 1:04d}.jsonl"
+        paths.append(default_storage.save(path, ContentFile(content.encode())))
+        lines.clear()
+
+    for record in reader:
+        lines.append(json.dumps([reader.row_number, [record[column] for column in reader.columns]], default=str))
+
+        value = key(record) if key else None
+        if value is not None:
+            if value in last_rows:
+                duplicates[value] = reader.row_number
+            last_rows[value] = reader.row_number
+
+        if len(lines) >= chunk_size:
+            flush()
+
+    if lines:
+        flush()
+
+    return {"paths": paths, "keys": set(last_rows), "duplicates": duplicates}
+
+
+class ChunkReader:
+    """
+    Read a chunk file written by `write_chunks`, with the same interface as `SpreadsheetReader`.
+    """
+
+    sheet_count = 1
+
+    def __init__(self, file: File):
+        self._lines = iter_lines(file)
+        self.columns = json.loads(next(self._lines))
+        self.row_number = None
+
+    def __iter__(self) -> Iterator[dict]:
+        for line in self._lines:
+            self.row_number, values = json.loads(line)
+            yield dict(zip(self.columns, values))
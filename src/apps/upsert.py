@@ -0,0 +1,233 @@
+"""
+Bulk insert-or-update of catalog rows, shared by the CSV/Excel importers.
+"""
+
+import hashlib
+import json
+from decimal import Decimal
+from typing import Callable, Iterable, NamedTuple, Optional
+
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, models, transaction
+
+from apps.constants import BULK_CREATE_BATCH_SIZE, LOGGER
+
+
+class RowError(NamedTuple):
+    """An invalid row of an import: its row number in the file (None if unknown), the column and the reason."""
+
+    row: Optional[int]
+    column: str
+    reason: str
+
+
+def _normalize(field: models.Field, value):
+    """
+    Convert a value to the Python type of the field, the way it is stored in the database.
+
+    :raises ValidationError: If the value can't be converted.
+    """
+    value = field.to_python(value)
+    if isinstance(field, models.DecimalField) and isinstance(value, Decimal):
+        value = value.quantize(Decimal(1).scaleb(-field.decimal_places))
+    return value
+
+
+def row_hash(values: dict, fields: list) -> str:
+    """
+    Hash the normalized values of the given fields, used to detect changed rows without comparing every field.
+    """
+    return hashlib.sha256(json.dumps([values[name] for name in fields], default=str).encode()).hexdigest()
+
+
+def bulk_upsert(
+    model,
+    rows: Iterable,
+    unique_field: str,
+    update_fields: list,
+    hash_field: str = None,
+    row_number: Callable[[], int] = None,
+    columns: dict = None,
+) -> dict:
+    """
+    Insert or update rows of a model matched on a unique field, in batches.
+
+    Rows are consumed lazily, so passing a generator keeps memory flat for large files. The existing rows of each
+    batch are fetched with one query and compared with the incoming values, only new and changed rows are written
+    with `bulk_create(update_conflicts=True)`. If a batch fails (e.g. a value is too long for its column), its rows
+    are written one by one the same way, so only the invalid rows are skipped.
+
+    NOTE: Rows are written with `bulk_create` on both paths, so no `pre_save`/`post_save` signal is sent. Callers
+    do the work of their model's receivers themselves, e.g. the invoices of the imported opportunities.
+
+    With `hash_field`, the hash of the incoming values (see `row_hash`) is stored with each row and only the
+    hashes are fetched and compared. Rows without a stored hash (never imported, or edited since, see
+    `ImportedModel`) are compared field by field and their hash is filled in.
+
+    NOTE: When a key appears several times, the last row wins, like consecutive `update_or_create` calls.
+
+    :param model: Model class to upsert, `unique_field` must have a unique constraint.
+    :param rows: Iterable of dictionaries of field values, including `unique_field`.
+    :param unique_field: Name of the field used to match existing rows.
+    :param update_fields: Names of the fields to update on existing rows.
+    :param hash_field: Optional name of the field storing the row hash.
+    :param row_number: Optional function returning the row number of the row being read, e.g.
+        `lambda: reader.row_number` for a `SpreadsheetReader`.
+    :param columns: Optional file column names of the fields, used in the errors instead of the field names.
+    :return: Dictionary with the `created`, `updated` and `unchanged` counts, the keys of the `added` and
+        `changed` rows, the set of all imported `keys` and the `errors` as a list of `RowError`.
+    """
+    result = {"created": 0, "updated": 0, "unchanged": 0, "added": [], "changed": [], "keys": set(), "errors": []}
+    fields = {name: model._meta.get_field(name) for name in [unique_field, *update_fields]}
+    write_fields = list(update_fields)
+    if hash_field:
+        write_fields.append(hash_field)
+    if any(field.name == "updated_at" for field in model._meta.concrete_fields):
+        write_fields.append("updated_at")
+
+    columns = columns or {}
+    batch, row_numbers = {}, {}
+    for row in rows:
+        number = row_number() if row_number else None
+        values = {}
+        try:
+            for name, field in fields.items():
+                values[name] = _normalize(field, row[name])
+        except ValidationError as e:
+            result["errors"].append(RowError(number, columns.get(name, name), "; ".join(e.messages)))
+            continue
+        if hash_field:
+            values[hash_field] = row_hash(values, update_fields)
+
+        key = values[unique_field]
+        result["keys"].add(key)
+        batch.pop(key, None)
+        batch[key] = values
+        row_numbers[key] = number
+        if len(batch) >= BULK_CREATE_BATCH_SIZE:
+            _upsert_batch(model, batch, row_numbers, unique_field, update_fields, write_fields, hash_field, result)
+            batch, row_numbers = {}, {}
+
+    if batch:
+        _upsert_batch(model, batch, row_numbers, unique_field, update_fields, write_fields, hash_field, result)
+
+    return result
+
+
+def _upsert_batch(
+    model,
+    batch: dict,
+    row_numbers: dict,
+    unique_field: str,
+    update_fields: list,
+    write_fields: list,
+    hash_field: str,
+    result: dict,
+) -> None:
+    """
+    Write one batch of `bulk_upsert`, `batch` maps the keys to the normalized values and `row_numbers` to the
+    row numbers in the file.
+    """
+    existing = {
+        row[unique_field]: row
+        for row in model.objects.filter(**{f"{unique_field}__in": batch}).values(
+            unique_field, *(["pk", hash_field] if hash_field else update_fields)
+        )
+    }
+
+    if hash_field:
+        # Compare the rows without a stored hash field by field
+        unhashed = [key for key, row in existing.items() if row[hash_field] is None]
+        for row in model.objects.filter(**{f"{unique_field}__in": unhashed}).values(unique_field, *update_fields):
+            existing[row[unique_field]].update(row)
+
+    created, changed, rehashed = [], [], []
+    for key, values in batch.items():
+        if key not in existing:
+            created.append(values)
+        elif hash_field and existing[key][hash_field] is not None:
+            if existing[key][hash_field] == values[hash_field]:
+                result["unchanged"] += 1
+            else:
+                changed.append(values)
+        elif any(existing[key][name] != values[name] for name in update_fields):
+            changed.append(values)
+        else:
+            result["unchanged"] += 1
+            if hash_field:
+                rehashed.append(model(pk=existing[key]["pk"], **{hash_field: values[hash_field]}))
+
+    if rehashed:
+        # Store the missing hashes without touching `updated_at`
+        model.objects.bulk_update(rehashed, [hash_field])
+
+    if not created and not changed:
+        return
+
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(
+                [model(**values) for values in created + changed],
+                update_conflicts=True,
+                unique_fields=[unique_field],
+                update_fields=write_fields,
+            )
+    except DatabaseError as e:
+        LOGGER.warning(f"[bulk_upsert] {model.__name__} batch failed, saving rows one by one: {e}")
+        _upsert_one_by_one(model, created, changed, row_numbers, unique_field, write_fields, result)
+        return
+
+    result["created"] += len(created)
+    result["updated"] += len(changed)
+    result["added"].extend(values[unique_field] for values in created)
+    result["changed"].extend(values[unique_field] for values in changed)
+
+
+def _upsert_one_by_one(
+    model, created: list, changed: list, row_numbers: dict, unique_field: str, write_fields: list, result: dict
+) -> None:
+    """
+    Fallback of `bulk_upsert` for a failed batch, collecting the errors of the invalid rows.
+
+    Each row is written like the batch (`bulk_create(update_conflicts=True)`), so both paths save the same fields
+    and send no signals.
+    """
+    for is_created, rows in ((True, created), (False, changed)):
+        for values in rows:
+            try:
+                with transaction.atomic():
+                    model.objects.bulk_create(
+                        [model(**values)],
+                        update_conflicts=True,
+                        unique_fields=[unique_field],
+                        update_fields=write_fields,
+                    )
+            except DatabaseError as e:
+                result["errors"].append(RowError(row_numbers[values[unique_field]], "", str(e)))
+                continue
+
+            result["created" if is_created else "updated"] += 1
+            result["added" if is_created else "changed"].append(values[unique_field])
+
+
+def removed_keys(model, unique_field: str, keys: set) -> list:
+    """
+    Return the keys of the rows of a model that are not in an import, e.g. items deleted from the NetSuite export.
+
+    :param model: Imported model class.
+    :param unique_field: Name of the field identifying the rows.
+    :param keys: The imported keys, see `bulk_upsert`.
+    :return: Sorted list of the missing keys.
+    """
+    return sorted(set(model.objects.values_list(unique_field, flat=True)) - keys)
+
+
+def format_upsert_result(result: dict) -> str:
+    """
+    Summarize the counts of an import, e.g. "12 created, 3 updated, 950 unchanged", followed by the number of
+    removed rows when the import returned its `changes`.
+    """
+    summary = f"{result['created']:,} created, {result['updated']:,} updated, {result['unchanged']:,} unchanged"
+    if result.get("changes"):
+        summary += f", {len(result['changes']['removed']):,} no longer in the file"
+    return summary
@@ -7,3 +7,22 @@ class BaseModel(models.Model):
 
     class Meta:
         abstract = True
+
+
+class ImportedModel(BaseModel):
+    """
+    Base model for the catalogs imported from NetSuite exports.
+
+    `import_hash` is the hash of the imported values (see `apps.upsert.bulk_upsert`), so unchanged rows can be
+    skipped without comparing every field.
+    """
+
+    import_hash = models.CharField(max_length=64, blank=True, null=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        # The row may no longer match the imported values, compare it field by field on the next import
+        self.import_hash = None
+        super().save(*args, **kwargs)
+
+    class Meta:
+        abstract = True
@@ -56,6 +56,7 @@ DJANGO_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
 ]
 THIRD_PARTY_APPS = [
     "crispy_forms",
@@ -275,3 +276,13 @@ CELERY_TIMEZONE = "Asia/Kolkata"
 CELERY_RESULT_EXTENDED = True
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
 CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
+
+# Cache
+# The estimate cache (see `apps.proposal.opportunity.estimate_cache`) is shared by the workers through the Redis
+# server used by Celery, on its own database
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.getenv("CACHE_URL") or "redis://localhost:6379/1",
+    }
+}
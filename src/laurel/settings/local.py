@@ -13,3 +13,6 @@ DATABASES = {
         'NAME': os.path.join(ROOT_DIR, 'db.sqlite3'),
     }
 }
+
+# Local-memory cache, no Redis server needed (also enough for the tests)
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
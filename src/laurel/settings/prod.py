@@ -33,3 +33,6 @@ MIDDLEWARE = [
 
 # Static files configuration for Vercel
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+
+# Local-memory cache, there is no Redis server on Vercel
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
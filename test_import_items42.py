@@ -33,20 +33,22 @@ with open(items_file, "rb") as f:
     if "error" in result:
         print(f"❌ Error: {result['error']}")
     else:
-        messages = result.get("messages", [])
-        created_count = sum(1 for msg in messages if "Created" in msg)
-        updated_count = sum(1 for msg in messages if "Updated" in msg)
+        errors = result.get("errors", [])
+        created_count = result["created"]
+        updated_count = result["updated"]
+        unchanged_count = result["unchanged"]
 
         print(f"\n✅ Import complete!")
-        print(f"   Created: {created_count:,}")
-        print(f"   Updated: {updated_count:,}")
-        print(f"   Total:   {created_count + updated_count:,}")
+        print(f"   Created:   {created_count:,}")
+        print(f"   Updated:   {updated_count:,}")
+        print(f"   Unchanged: {unchanged_count:,}")
+        print(f"   Total:     {created_count + updated_count + unchanged_count:,}")
 
         # Show sample
-        if messages[:3]:
-            print(f"\n   Sample messages:")
-            for msg in messages[:3]:
-                print(f"     • {msg}")
+        if errors[:3]:
+            print(f"\n   Sample errors:")
+            for row, column, reason in errors[:3]:
+                print(f"     • Row {row} ({column}): {reason}")
 
 # Verify in database
 from apps.proposal.product.models import Product